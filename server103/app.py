@@ -16,6 +16,24 @@ import io
 import json
 import time
 import threading
+import queue
+import socket
+import sqlite3
+import shlex
+import posixpath
+import base64
+import bisect
+import errno
+import fnmatch
+import mimetypes
+import tarfile
+import zipfile
+import zlib
+from urllib.parse import quote
+from email.utils import formatdate
+import hashlib
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 import stat
 import stat
@@ -41,6 +59,1118 @@ CURRENT_SERVER = 'server103'
 # Sudo密码
 SUDO_PASSWORD = '1234567'
 
+# 目录传输方式：sftp 逐文件复制 / tar 源端打包、经 server103 流式转发到目标端解包
+TRANSFER_TRANSPORTS = ('sftp', 'tar')
+
+# tar 流传输时每次从源通道读取的字节数
+TAR_STREAM_BUFFER_SIZE = 256 * 1024
+
+# 多通道并行 SFTP 传输配置：每个通道是一对独立的源/目标连接，由工作线程从共享队列取文件复制
+PARALLEL_TRANSFER_CONFIG = {
+    'default_channels': 4,                # 未单独配置的服务器对使用的通道数
+    'server_pairs': {                     # (源服务器, 目标服务器) -> 通道数
+        ('server101', 'server102'): 6,
+        ('server102', 'server104'): 4,
+    },
+}
+
+# SFTP 单文件复制参数：源端预取读 + 目标端流水线写，读写由两个线程经有界队列交替进行（双缓冲）
+SFTP_COPY_CONFIG = {
+    'block_size': 256 * 1024,        # 每次从源文件读取并交给写线程的块大小（字节）
+    'window': 8,                     # 读写线程之间最多缓冲的块数（内存占用约 block_size * window）
+    'prefetch_requests': 64,         # 源端同时在途的读请求数（每个请求最多 32KB）
+    'threaded_min_size': 1024 * 1024,  # 小于该大小的文件不启用读写线程，直接顺序复制
+}
+
+# 节点间直连传输配置：由源节点直接 ssh 推送到目标节点（rsync 或 tar 管道），server103 只负责编排
+DIRECT_TRANSFER_CONFIG = {
+    'probe_ttl': 300,        # 直连可用性探测结果的缓存时间（秒）
+    'connect_timeout': 10,   # 源节点 ssh 到目标节点的连接超时（秒）
+    'identity_file': None,   # 源节点上登录目标节点使用的私钥路径，None 表示使用 ssh 默认私钥
+}
+
+# 每次运行在 server102 上的独立工作目录：从同步好的共享项目副本快速复制出来，互不干扰
+RUN_WORKDIR_CONFIG = {
+    'root': '/home/user/{username}/runs/{projectname}',  # 运行目录的上级目录，运行目录为 {root}/{run_id}
+    # 是否允许用硬链接创建运行目录。硬链接的文件与共享副本及其他并发运行共用内容，程序原地改写项目中的
+    # 已有文件（'w'/'a' 模式打开、SQLite 数据库、代码旁的缓存等）会同时改掉它们，因此默认关闭，
+    # 只在确认程序只新建/整体替换文件时开启
+    'allow_hardlink': False,
+    'private_dirs': ('output',),  # 硬链接方式下仍然完整复制的子目录（运行时会原地改写的文件所在目录）
+    'keep_after_archive': False,  # 归档到 server104 后是否保留运行目录
+}
+
+# 同步 / 异步执行接口中项目命令的运行限制。等待命令结束时不设读取超时（命令输出写入日志文件，SSH 通道上
+# 可能长时间没有数据）；需要限制运行时间时由执行节点上的 timeout 命令终止进程，退出码为 124
+PROJECT_RUN_CONFIG = {
+    'timeout': None,   # 最长运行时间（秒），None 表示不限制
+    'kill_after': 30,  # 超时发送 TERM 后仍未退出时，再等待多少秒发送 KILL
+}
+
+# 运行目录归档到 server104 的方式：full 复制整个运行目录 / changed 只传输本次运行新增或修改的文件 /
+# dedup 内容寻址存储，只上传 server104 上还没有的文件内容
+ARCHIVE_MODES = ('full', 'changed', 'dedup')
+
+RUN_ARCHIVE_CONFIG = {
+    'default_mode': 'full',                 # 请求未指定 archive_mode 时使用的方式
+    'snapshot_file': '.run_snapshot.json',  # changed 方式下记录源快照引用与未改动文件清单的文件（位于归档目录中）
+}
+
+# 项目同步（10.1 -> 10.2）与运行归档（10.2 -> 10.4）的忽略规则：server101 项目根目录下的 .syncignore，
+# 按「默认规则 -> .syncignore -> 请求中的 sync_ignore」的顺序合并，语法见 SyncIgnore
+SYNC_IGNORE_CONFIG = {
+    'file': '.syncignore',
+    'default_patterns': [],  # 所有项目都适用的规则，如 ['.git/', '__pycache__/']
+}
+
+# 从基线虚拟环境克隆用户环境（/env/create）：依次尝试 reflink、硬链接、普通复制，
+# 硬链接方式下 site-packages 等不会被原地改写的文件与基线共用，只有环境会改写的文件单独复制
+ENV_CLONE_CONFIG = {
+    'base_venv_path': '/home/user/common/basevenv/venv',  # 10.2 上的基线虚拟环境
+    'mutable_files': ('pyvenv.cfg', 'bin/activate*', 'bin/Activate.ps1'),  # 硬链接方式下仍然单独复制的文件（相对环境目录，可用通配符）
+    'rewrite_paths': True,  # 是否把 bin/ 脚本与 mutable_files 中的基线路径改写为新环境路径（改写的文件同样单独复制）
+}
+ENV_CLONE_MODES = ('auto', 'copy')  # auto 依次尝试 reflink / 硬链接 / 复制；copy 总是完整复制
+
+# 共享虚拟环境存储（server102）：按解析后的依赖集合（基线指纹 + 排序后的「包名==版本」）的 sha256 存放，
+# 同一依赖集合只构建一次，用户环境是指向它的符号链接，共享环境本身只读
+ENV_STORE_CONFIG = {
+    'root': '/home/user/common/envstore',           # 共享环境为 {root}/{hash}，构建中的环境位于 {root}/.building/{hash}
+    'resolved_file': '.resolved-requirements.txt',  # 共享环境中记录解析结果（包名==版本）的文件
+}
+
+# 预热环境池（server102）：后台预先克隆好若干环境，/env/create 直接 rename 取用
+ENV_POOL_CONFIG = {
+    'root': '/home/user/common/envpool',  # 预热环境所在目录（须与 /home/user/{username}/envs 在同一文件系统上，rename 才是瞬时的）
+    'size': 2,                            # 池中保持的就绪环境数，0 表示不使用环境池
+    'retry_interval': 60,                 # 补充失败后的重试间隔，也是定期校验基线是否更新的间隔（秒）
+}
+
+# server104 上的内容寻址归档存储（archive_mode='dedup'）：文件内容按 sha256 存为只读对象，
+# 各次运行的归档目录由指向对象的硬链接组成（对象与归档目录须在同一文件系统上）
+ARCHIVE_STORE_CONFIG = {
+    'objects_root': '/home/user/{username}/outputs/.objects',                     # 对象路径为 {objects_root}/{hash[:2]}/{hash}
+    'manifests_root': '/home/user/{username}/outputs/.manifests/{projectname}',   # 每次运行的清单为 {manifests_root}/{run_id}.json
+}
+
+# 执行前安装 requirements.txt 的配置；安装成功后在虚拟环境中写入标记文件，依赖与环境未变化时跳过安装
+PIP_INSTALL_CONFIG = {
+    'index_url': 'http://192.168.140.202:8087/simple/',
+    'trusted_host': '192.168.140.202',
+    'marker_file': '.requirements.sha256',   # 位于虚拟环境根目录，内容为 "缓存键 安装耗时(毫秒)"
+}
+
+# 依赖安装缓存结果在命令输出中的标记行前缀
+REQUIREMENTS_CACHE_TAG = '__REQUIREMENTS_CACHE__'
+
+# 任务登记表（SQLite，保存在 server103 本地），记录异步/后台/同步执行的全部运行
+JOB_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db')
+
+# 异步任务调度配置：超出并发上限的任务排队等待，而不是同时压到执行节点上
+SCHEDULER_CONFIG = {
+    'max_workers': 4,                    # 全局同时执行的异步任务数
+    'max_per_user': 2,                   # 单个用户同时执行的异步任务数
+    'max_per_node': {'server102': 3},    # 单个执行节点同时执行的异步任务数
+    'default_max_per_node': 2,           # 未单独配置的执行节点使用的上限
+}
+
+# 运行日志搬运配置：命令运行期间把执行节点上的临时日志按批追加到 server104 的 log 文件
+LOG_SHIPPER_CONFIG = {
+    'batch_size': 1024 * 1024,   # 每批读取并追加的最大字节数（server103 上的内存占用上界）
+    'interval': 2,               # 两轮搬运之间的间隔（秒）
+    'tail_bytes': 64 * 1024,     # 同步执行接口在响应 stdout 中返回的日志末尾字节数
+}
+
+# 实时日志推送（SSE）配置
+LOG_STREAM_CONFIG = {
+    'read_size': 64 * 1024,      # 每次从 tail 通道 / 日志文件读取的最大字节数
+    'poll_interval': 2,          # 没有新输出时检查一次任务状态的间隔（秒）
+    'keepalive_interval': 15,    # 没有新输出时发送 SSE 心跳注释的间隔（秒）
+    'default_tail_lines': 200,   # 未指定 offset 时先推送的最后若干行
+}
+
+# 目录列表缓存（/list、/project/list、/env/list）：按 (服务器, 目录) 缓存，修改远程文件的接口写后失效
+METADATA_CACHE_CONFIG = {
+    'ttl': 30,            # 缓存有效期（秒），0 表示不缓存
+    'max_entries': 1024,  # 最多缓存的列表数，超出时淘汰最久未使用的
+    'max_items': 200000,  # 所有缓存列表的条目总数上限（限制内存占用），超出时淘汰最久未使用的
+    'max_list_items': 50000,  # 单个列表超过该条目数时不缓存（超大目录每次都读取远程）
+}
+
+# /list 目录列表分页配置
+LIST_CONFIG = {
+    'default_limit': 500,   # 每页默认条目数
+    'max_limit': 5000,      # 每页最多条目数（单次响应大小上限）
+}
+LIST_SORTS = ('name', 'size', 'mtime')  # name 目录在前按名称 / size 按大小 / mtime 按修改时间
+
+# /file/download 流式下载配置：按窗口并发读取远程文件，读一块写一块，server103 内存占用与文件大小无关
+DOWNLOAD_CONFIG = {
+    'chunk_size': 256 * 1024,  # 每次写入 HTTP 响应的块大小（字节）
+    'window': 8,               # 每轮并发读取的块数（内存占用约 chunk_size * window）
+}
+
+# /run/archive 打包下载配置：边遍历运行归档目录边生成 tar / zip 写入响应，不在任何节点上生成临时压缩包
+RUN_ARCHIVE_DOWNLOAD_FORMATS = {
+    'tar': ('none', 'gzip'),     # format -> 可用的 compression（第一个为默认值）
+    'zip': ('none', 'deflate'),  # gzip / deflate 均使用 zlib 默认压缩级别
+}
+
+# 分块断点续传上传（/file/upload/*）：每块直接写入 server101 项目目录下的临时文件，提交时校验 sha256 后原子改名
+UPLOAD_CONFIG = {
+    'server': 'server101',
+    'chunk_size': 8 * 1024 * 1024,       # 建议的分块大小（init 时返回给客户端）
+    'max_chunk_size': 64 * 1024 * 1024,  # 单块大小上限
+    'write_block': 256 * 1024,           # 从请求体读取并写入远程文件的块大小，server103 不缓存整块
+}
+
+# SSH连接池配置
+SSH_POOL_CONFIG = {
+    'max_connections_per_server': 8,  # 单个节点最多保持的SSH连接数（空闲 + 借出）
+    'keepalive_interval': 30,         # Transport 心跳间隔（秒）
+    'idle_timeout': 300,              # 空闲连接超过该时间未被使用则关闭（秒）
+    'acquire_timeout': 60,            # 连接数达到上限时等待归还的最长时间（秒）
+    'connect_timeout': 30,            # 新建连接的握手超时（秒）
+}
+
+# 长时间占用连接的流式接口（任务日志 SSE、文件下载、运行目录打包下载）使用的独立连接池，
+# 与执行 / 同步 / 归档共用的 SSH_POOL 分开计数，打开再多的日志页面或慢速下载也不会占满 SSH_POOL
+STREAM_SSH_POOL_CONFIG = {
+    'max_connections_per_server': 8,  # 单个节点同时进行的流式请求数上限
+    'keepalive_interval': 30,
+    'idle_timeout': 60,
+    'acquire_timeout': 10,            # 达到上限时等待其他流结束的最长时间（秒）
+    'connect_timeout': 30,
+}
+
+
+class _PooledConnection:
+    """连接池中的一条SSH连接及其缓存的SFTP会话"""
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.sftp = None
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.depth = 0
+        self.broken = False
+
+
+class SSHConnectionPool:
+    """
+    进程级 SSH/SFTP 连接池（按服务器名称分组）
+
+    - 复用已认证的 Transport，避免每个请求重新做密码握手
+    - 每个 Transport 开启 keepalive，借出前做健康检查，剔除失效连接
+    - 限制单个节点的最大连接数，达到上限时等待其他请求归还
+    - 同一线程对同一服务器的重复借用返回同一连接（引用计数），避免嵌套调用时自我死锁
+    """
+
+    def __init__(self, server_config, max_connections_per_server=8, keepalive_interval=30,
+                 idle_timeout=300, acquire_timeout=60, connect_timeout=30):
+        self._server_config = server_config
+        self._adhoc_config = {}
+        self.max_connections_per_server = max_connections_per_server
+        self.keepalive_interval = keepalive_interval
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.connect_timeout = connect_timeout
+        self._cond = threading.Condition()
+        self._idle = {}      # key -> [_PooledConnection]
+        self._total = {}     # key -> 当前连接总数（空闲 + 借出）
+        self._borrowed = {}  # id(client) -> _PooledConnection
+        self._local = threading.local()
+
+    def _get_config(self, key):
+        if key in self._server_config:
+            return self._server_config[key]
+        if key in self._adhoc_config:
+            return self._adhoc_config[key]
+        raise paramiko.SSHException(f'未知的服务器: {key}')
+
+    def resolve_key(self, host, port, user, password):
+        """根据连接参数找到对应的服务器名称，不在 SERVER_CONFIG 中的按 user@host:port 登记"""
+        for name, config in self._server_config.items():
+            if config['host'] == host and config['port'] == port and config['user'] == user:
+                return name
+        key = f'{user}@{host}:{port}'
+        with self._cond:
+            self._adhoc_config[key] = {'host': host, 'port': port, 'user': user, 'password': password}
+        return key
+
+    def _held(self):
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        return held
+
+    def _is_healthy(self, conn):
+        """检查连接是否仍然可用：Transport 存活且能发送数据包"""
+        if conn.broken:
+            return False
+        transport = conn.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def _close_conn(self, conn):
+        try:
+            if conn.sftp:
+                conn.sftp.close()
+        except Exception:
+            pass
+        try:
+            conn.client.close()
+        except Exception:
+            pass
+
+    def _connect(self, key):
+        config = self._get_config(key)
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        logger.info(f"[ssh_pool] 新建连接 {key} ({config['user']}@{config['host']}:{config['port']})")
+        client.connect(
+            hostname=config['host'],
+            port=config['port'],
+            username=config['user'],
+            password=config['password'],
+            timeout=self.connect_timeout
+        )
+        client.get_transport().set_keepalive(self.keepalive_interval)
+        return _PooledConnection(key, client)
+
+    def _prune_idle_locked(self, key):
+        """
+        摘除超时的空闲连接（需持有锁）
+
+        Returns:
+            list: 被摘除的连接，由调用方在锁外关闭
+        """
+        now = time.time()
+        idle = self._idle.get(key, [])
+        keep = []
+        expired = []
+        for conn in idle:
+            if now - conn.last_used > self.idle_timeout:
+                expired.append(conn)
+                self._total[key] -= 1
+            else:
+                keep.append(conn)
+        self._idle[key] = keep
+        return expired
+
+    def acquire(self, server_name):
+        """借出一条到指定服务器的SSH连接（paramiko.SSHClient），用完必须调用 release"""
+        key = server_name
+        held = self._held()
+        if key in held:
+            conn = held[key]
+            conn.depth += 1
+            return conn.client
+
+        conn, reserved = self._take(key, time.time() + self.acquire_timeout)
+        if not (conn or reserved):
+            raise paramiko.SSHException(
+                f'连接池已满: {key}（上限 {self.max_connections_per_server}），等待超时'
+            )
+        return self._checkout(key, conn)
+
+    def try_acquire(self, server_name):
+        """
+        不等待地借出连接：连接数已达上限且没有空闲连接时立即返回 None（用于可选的额外并行通道）
+
+        Returns:
+            paramiko.SSHClient | None: 借到的连接，用完必须调用 release
+        """
+        key = server_name
+        held = self._held()
+        if key in held:
+            held[key].depth += 1
+            return held[key].client
+        conn, reserved = self._take(key)
+        if not (conn or reserved):
+            return None
+        return self._checkout(key, conn)
+
+    def available(self, server_name):
+        """当前是否还能借出到该服务器的连接（有空闲连接或未达上限；只作提前判断，不占位）"""
+        with self._cond:
+            return (bool(self._idle.get(server_name))
+                    or self._total.get(server_name, 0) < self.max_connections_per_server)
+
+    def _take(self, key, deadline=None):
+        """
+        取一条健康的空闲连接，没有时在未达上限的情况下为新连接占位
+
+        健康检查（会发包）和关闭失效连接都在锁外进行，避免一台慢主机阻塞其他服务器的借出。
+
+        Args:
+            deadline: 连接数已满时等待到的时间点，为 None 时不等待
+
+        Returns:
+            tuple: (空闲连接 | None, 是否已为新连接占位)；两者皆空表示已满（或等待超时）
+        """
+        while True:
+            with self._cond:
+                expired = self._prune_idle_locked(key)
+                conn, reserved = self._take_locked(key)
+                if not (conn or reserved or expired) and deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        self._cond.wait(remaining)
+                        continue
+            for stale in expired:
+                self._close_conn(stale)
+            if conn is None:
+                if reserved or not expired:
+                    return None, reserved
+                continue
+            if self._is_healthy(conn):
+                return conn, False
+            logger.info(f"[ssh_pool] 剔除失效连接: {key}")
+            self._close_conn(conn)
+            with self._cond:
+                self._total[key] -= 1
+                self._cond.notify()
+
+    def _take_locked(self, key):
+        """
+        弹出一条空闲连接（不做健康检查），没有时在未达上限的情况下为新连接占位（需持有锁）
+
+        Returns:
+            tuple: (空闲连接 | None, 是否已为新连接占位)
+        """
+        idle = self._idle.get(key, [])
+        if idle:
+            return idle.pop(), False
+        if self._total.get(key, 0) < self.max_connections_per_server:
+            # 先占位，连接在锁外建立
+            self._total[key] = self._total.get(key, 0) + 1
+            return None, True
+        return None, False
+
+    def _checkout(self, key, conn):
+        """登记借出（conn 为 None 时按已占的位置新建连接）"""
+        if conn is None:
+            try:
+                conn = self._connect(key)
+            except Exception:
+                with self._cond:
+                    self._total[key] -= 1
+                    self._cond.notify()
+                raise
+
+        conn.depth = 1
+        conn.broken = False
+        self._held()[key] = conn
+        with self._cond:
+            self._borrowed[id(conn.client)] = conn
+        return conn.client
+
+    def acquire_for(self, host, port, user, password):
+        """按连接参数借出连接（供仍以 host/port/user/password 传参的复制函数使用）"""
+        return self.acquire(self.resolve_key(host, port, user, password))
+
+    def release(self, client, discard=False):
+        """
+        归还连接
+
+        Args:
+            client: acquire 返回的 SSHClient
+            discard: 为 True 时直接关闭该连接而不放回池中
+        """
+        if client is None:
+            return
+        with self._cond:
+            conn = self._borrowed.get(id(client))
+        if conn is None:
+            logger.warning("[ssh_pool] 归还了未借出的连接，已忽略")
+            return
+
+        if discard:
+            conn.broken = True
+        conn.depth -= 1
+        if conn.depth > 0:
+            return
+
+        held = self._held()
+        if held.get(conn.key) is conn:
+            del held[conn.key]
+
+        healthy = not conn.broken
+        if healthy:
+            transport = conn.client.get_transport()
+            healthy = transport is not None and transport.is_active()
+
+        with self._cond:
+            self._borrowed.pop(id(client), None)
+            if healthy:
+                conn.last_used = time.time()
+                self._idle.setdefault(conn.key, []).append(conn)
+            else:
+                self._total[conn.key] -= 1
+            self._cond.notify()
+        if not healthy:
+            self._close_conn(conn)
+
+    def open_sftp(self, client):
+        """获取连接上缓存的SFTP会话（不存在或已失效时新建），调用方不要关闭它"""
+        with self._cond:
+            conn = self._borrowed.get(id(client))
+        if conn is None:
+            return client.open_sftp()
+        sftp = conn.sftp
+        if sftp is None or sftp.sock is None or sftp.sock.closed:
+            conn.sftp = client.open_sftp()
+        return conn.sftp
+
+    def stats(self):
+        """返回各服务器连接池状态"""
+        with self._cond:
+            result = {}
+            for key, total in self._total.items():
+                idle = len(self._idle.get(key, []))
+                result[key] = {
+                    'total': total,
+                    'idle': idle,
+                    'in_use': total - idle,
+                    'max': self.max_connections_per_server
+                }
+            return result
+
+
+SSH_POOL = SSHConnectionPool(SERVER_CONFIG, **SSH_POOL_CONFIG)
+STREAM_SSH_POOL = SSHConnectionPool(SERVER_CONFIG, **STREAM_SSH_POOL_CONFIG)
+
+
+class JobRegistry:
+    """
+    持久化的任务登记表
+
+    每次执行（/project/execute、/project/execute/async、/project/execute/background）登记为一条记录，
+    job_id 与运行ID（run_id）相同。server103 重启后仍可查询历史任务，并据此恢复未结束任务的状态。
+
+    状态流转: pending -> [queued ->] syncing -> running -> archiving -> completed / failed；
+    异步任务先进入 JOB_SCHEDULER 排队（queued）；server103 重启时中断的任务标记为 lost。
+    """
+
+    TERMINAL_STATUSES = ('completed', 'failed', 'lost')
+
+    # 进入某个状态时同时记录的时间字段
+    PHASE_TIMESTAMPS = {
+        'queued': 'queued_at',
+        'syncing': 'sync_started_at',
+        'running': 'run_started_at',
+        'archiving': 'archive_started_at',
+        'completed': 'finished_at',
+        'failed': 'finished_at',
+        'lost': 'finished_at',
+    }
+
+    COLUMNS = (
+        'job_id', 'mode', 'username', 'projectname', 'env_name', 'command', 'node', 'pid',
+        'run_dir', 'log_file', 'archive_path', 'status', 'error', 'exit_code',
+        'created_at', 'sync_started_at', 'run_started_at', 'run_finished_at',
+        'archive_started_at', 'finished_at', 'updated_at', 'priority', 'queued_at', 'archive_mode',
+        'requirements_cache', 'requirements_install_seconds', 'requirements_saved_seconds', 'sync_ignore'
+    )
+
+    # 旧版本数据库中缺少的列，启动时自动补齐
+    ADDED_COLUMNS = {
+        'priority': 'INTEGER DEFAULT 0',
+        'queued_at': 'TEXT',
+        'archive_mode': 'TEXT',
+        'requirements_cache': 'TEXT',
+        'requirements_install_seconds': 'REAL',
+        'requirements_saved_seconds': 'REAL',
+        'sync_ignore': 'TEXT',  # 本次运行生效的忽略规则（JSON 数组），后台任务归档时使用
+    }
+
+    def __init__(self, db_path):
+        # 数据库在第一次使用时才打开，导入模块（以及 Werkzeug reloader 的父进程）不会创建连接
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self):
+        """打开数据库并补齐表结构（重复调用无副作用）"""
+        with self._lock:
+            self._connection()
+
+    def _connection(self):
+        """返回数据库连接，第一次调用时创建；调用方需持有 self._lock"""
+        if self._conn is None:
+            conn = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_id TEXT PRIMARY KEY, mode TEXT NOT NULL, username TEXT, projectname TEXT, '
+                'env_name TEXT, command TEXT, node TEXT, pid INTEGER, run_dir TEXT, log_file TEXT, '
+                'archive_path TEXT, status TEXT NOT NULL, error TEXT, exit_code INTEGER, '
+                'created_at TEXT, sync_started_at TEXT, run_started_at TEXT, run_finished_at TEXT, '
+                'archive_started_at TEXT, finished_at TEXT, updated_at TEXT)'
+            )
+            existing = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, column_type in self.ADDED_COLUMNS.items():
+                if column not in existing:
+                    conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} {column_type}')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (username, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_pid ON jobs (node, pid)')
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _now():
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def create(self, job_id, mode, username, projectname, env_name, command, node='server102', **fields):
+        """登记一个新任务，初始状态为 pending"""
+        record = {
+            'job_id': job_id,
+            'mode': mode,
+            'username': username,
+            'projectname': projectname,
+            'env_name': env_name,
+            'command': command,
+            'node': node,
+            'status': 'pending',
+            'created_at': self._now(),
+            'updated_at': self._now(),
+        }
+        record.update(fields)
+        columns = ', '.join(record)
+        placeholders = ', '.join('?' for _ in record)
+        with self._lock:
+            self._connection().execute(f'INSERT INTO jobs ({columns}) VALUES ({placeholders})', list(record.values()))
+        return job_id
+
+    def update(self, job_id, **fields):
+        """更新任务字段（只接受 COLUMNS 中的字段）"""
+        fields = {k: v for k, v in fields.items() if k in self.COLUMNS and k != 'job_id'}
+        fields['updated_at'] = self._now()
+        assignments = ', '.join(f'{k} = ?' for k in fields)
+        with self._lock:
+            self._connection().execute(f'UPDATE jobs SET {assignments} WHERE job_id = ?', list(fields.values()) + [job_id])
+
+    def set_status(self, job_id, status, **fields):
+        """切换任务状态，并记录进入该阶段的时间"""
+        timestamp_field = self.PHASE_TIMESTAMPS.get(status)
+        if timestamp_field and timestamp_field not in fields:
+            fields[timestamp_field] = self._now()
+        self.update(job_id, status=status, **fields)
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection().execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_by_pid(self, node, pid):
+        """按执行节点 + PID 查找最近的后台任务"""
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT * FROM jobs WHERE node = ? AND pid = ? ORDER BY created_at DESC LIMIT 1',
+                (node, int(pid))
+            ).fetchone()
+        return dict(row) if row else None
+
+    def list(self, username=None, projectname=None, status=None, mode=None, limit=50, offset=0):
+        """
+        按条件查询任务（按创建时间倒序）
+
+        Returns:
+            tuple: (jobs: list[dict], total: int)
+        """
+        conditions = []
+        params = []
+        for column, value in (('username', username), ('projectname', projectname),
+                              ('status', status), ('mode', mode)):
+            if value:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self._lock:
+            total = self._connection().execute(f'SELECT COUNT(*) FROM jobs {where}', params).fetchone()[0]
+            rows = self._connection().execute(
+                f'SELECT * FROM jobs {where} ORDER BY created_at DESC, job_id DESC LIMIT ? OFFSET ?',
+                params + [int(limit), int(offset)]
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def unfinished(self):
+        """所有未结束的任务"""
+        placeholders = ', '.join('?' for _ in self.TERMINAL_STATUSES)
+        with self._lock:
+            rows = self._connection().execute(
+                f'SELECT * FROM jobs WHERE status NOT IN ({placeholders})', self.TERMINAL_STATUSES
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+JOB_REGISTRY = JobRegistry(JOB_DB_PATH)
+
+
+class UploadRegistry:
+    """
+    分块上传会话登记表（与任务登记表共用同一个 SQLite 文件）
+
+    已接收的字节数以 server101 上临时文件的实际大小为准：每块写完才算接收，写入失败或校验不通过时
+    截回该块的起点，因此临时文件大小就是可以继续上传的偏移量。server103 重启后仍可凭 upload_id 继续上传。
+
+    状态流转: uploading -> committed / aborted
+    """
+
+    COLUMNS = (
+        'upload_id', 'username', 'projectname', 'path', 'target_path', 'temp_path', 'size', 'sha256',
+        'received', 'status', 'error', 'created_at', 'updated_at', 'committed_at'
+    )
+
+    def __init__(self, db_path):
+        # 与 JobRegistry 相同，第一次使用时才打开数据库
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def open(self):
+        """打开数据库并补齐表结构（重复调用无副作用）"""
+        with self._lock:
+            self._connection()
+
+    def _connection(self):
+        """返回数据库连接，第一次调用时创建；调用方需持有 self._lock"""
+        if self._conn is None:
+            conn = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                'upload_id TEXT PRIMARY KEY, username TEXT, projectname TEXT, path TEXT, '
+                'target_path TEXT NOT NULL, temp_path TEXT NOT NULL, size INTEGER, sha256 TEXT, '
+                'received INTEGER DEFAULT 0, status TEXT NOT NULL, error TEXT, '
+                'created_at TEXT, updated_at TEXT, committed_at TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_target ON uploads (target_path, status)')
+            self._conn = conn
+        return self._conn
+
+    def create(self, upload_id, **fields):
+        """登记一个新的上传会话，初始状态为 uploading"""
+        record = {'upload_id': upload_id, 'status': 'uploading', 'received': 0,
+                  'created_at': JobRegistry._now(), 'updated_at': JobRegistry._now()}
+        record.update({k: v for k, v in fields.items() if k in self.COLUMNS})
+        columns = ', '.join(record)
+        placeholders = ', '.join('?' for _ in record)
+        with self._lock:
+            self._connection().execute(f'INSERT INTO uploads ({columns}) VALUES ({placeholders})', list(record.values()))
+        return upload_id
+
+    def update(self, upload_id, **fields):
+        """更新上传会话字段（只接受 COLUMNS 中的字段）"""
+        fields = {k: v for k, v in fields.items() if k in self.COLUMNS and k != 'upload_id'}
+        fields['updated_at'] = JobRegistry._now()
+        assignments = ', '.join(f'{k} = ?' for k in fields)
+        with self._lock:
+            self._connection().execute(f'UPDATE uploads SET {assignments} WHERE upload_id = ?',
+                               list(fields.values()) + [upload_id])
+
+    def get(self, upload_id):
+        with self._lock:
+            row = self._connection().execute('SELECT * FROM uploads WHERE upload_id = ?', (upload_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_active(self, target_path):
+        """同一目标文件最近一个未完成的上传会话（用于中断后重新 init 时继续上传）"""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT * FROM uploads WHERE target_path = ? AND status = 'uploading' "
+                'ORDER BY created_at DESC LIMIT 1', (target_path,)
+            ).fetchone()
+        return dict(row) if row else None
+
+
+UPLOAD_REGISTRY = UploadRegistry(JOB_DB_PATH)
+_UPLOAD_LOCKS = {}  # upload_id -> threading.Lock，同一上传同一时刻只写一个分块
+
+
+def get_upload_offset(sftp_client, upload):
+    """上传会话可以继续写入的偏移量（临时文件的实际大小），临时文件不存在时返回 None"""
+    try:
+        return sftp_client.stat(upload['temp_path']).st_size or 0
+    except IOError:
+        return None
+
+
+def upload_status_payload(upload, offset=None):
+    """上传会话的响应字段"""
+    return {
+        'upload_id': upload['upload_id'],
+        'status': upload['status'],
+        'username': upload['username'],
+        'projectname': upload['projectname'],
+        'path': upload['path'],
+        'target_path': upload['target_path'],
+        'size': upload['size'],
+        'offset': upload['received'] if offset is None else offset,
+        'created_at': upload['created_at'],
+        'updated_at': upload['updated_at'],
+        'committed_at': upload['committed_at'],
+    }
+
+
+class JobScheduler:
+    """
+    有界任务调度器
+
+    - 固定数量的工作线程（全局并发上限）
+    - 优先级队列：priority 大的先执行，同优先级按提交顺序（FIFO）
+    - 单用户、单执行节点并发上限：队首任务因上限无法执行时，跳过它调度后面可执行的任务
+    """
+
+    def __init__(self, max_workers, max_per_user, max_per_node, default_max_per_node):
+        self.max_workers = max_workers
+        self.max_per_user = max_per_user
+        self.max_per_node = dict(max_per_node)
+        self.default_max_per_node = default_max_per_node
+        self._cond = threading.Condition()
+        self._queue = []           # [(排序键, 任务)]，按排序键升序
+        self._seq = 0
+        self._running = {}         # job_id -> 任务
+        self._running_by_user = {}
+        self._running_by_node = {}
+        self._workers = []
+
+    def _node_limit(self, node):
+        return self.max_per_node.get(node, self.default_max_per_node)
+
+    def _start_workers_locked(self):
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name=f'job-worker-{len(self._workers)}', daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def submit(self, job_id, username, node, func, priority=0):
+        """
+        提交任务
+
+        Args:
+            job_id: 任务ID
+            username: 提交用户（用于单用户并发上限）
+            node: 执行节点（用于单节点并发上限）
+            func: 任务函数（无参数）
+            priority: 优先级，越大越先执行
+
+        Returns:
+            int: 提交后的排队位置（从 1 开始）
+        """
+        with self._cond:
+            self._seq += 1
+            entry = ((-int(priority), self._seq), {
+                'job_id': job_id, 'username': username, 'node': node, 'func': func
+            })
+            self._queue.append(entry)
+            self._queue.sort(key=lambda e: e[0])
+            self._start_workers_locked()
+            self._cond.notify_all()
+            return self._position_locked(job_id)
+
+    def _position_locked(self, job_id):
+        for index, (_, task) in enumerate(self._queue):
+            if task['job_id'] == job_id:
+                return index + 1
+        return None
+
+    def queue_position(self, job_id):
+        """任务在队列中的位置（从 1 开始），已开始执行或不在队列中时返回 None"""
+        with self._cond:
+            return self._position_locked(job_id)
+
+    def _pick_locked(self):
+        for index, (_, task) in enumerate(self._queue):
+            if self._running_by_user.get(task['username'], 0) >= self.max_per_user:
+                continue
+            if self._running_by_node.get(task['node'], 0) >= self._node_limit(task['node']):
+                continue
+            return self._queue.pop(index)[1]
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._pick_locked()
+                while task is None:
+                    self._cond.wait()
+                    task = self._pick_locked()
+                self._running[task['job_id']] = task
+                self._running_by_user[task['username']] = self._running_by_user.get(task['username'], 0) + 1
+                self._running_by_node[task['node']] = self._running_by_node.get(task['node'], 0) + 1
+            try:
+                task['func']()
+            except Exception as e:
+                logger.error(f"[job_scheduler] 任务 {task['job_id']} 执行出错: {str(e)}", exc_info=True)
+            finally:
+                with self._cond:
+                    self._running.pop(task['job_id'], None)
+                    self._running_by_user[task['username']] -= 1
+                    self._running_by_node[task['node']] -= 1
+                    self._cond.notify_all()
+
+    def stats(self):
+        """返回调度器状态"""
+        with self._cond:
+            return {
+                'max_workers': self.max_workers,
+                'max_per_user': self.max_per_user,
+                'running': len(self._running),
+                'queued': len(self._queue),
+                'running_by_user': {k: v for k, v in self._running_by_user.items() if v},
+                'running_by_node': {k: v for k, v in self._running_by_node.items() if v},
+                'queue': [task['job_id'] for _, task in self._queue],
+            }
+
+
+JOB_SCHEDULER = JobScheduler(**SCHEDULER_CONFIG)
+
+
+class LogShipper:
+    """
+    运行日志搬运器：命令运行期间由后台线程按批把执行节点上的临时日志追加到 server104 的 log 文件
+
+    - 按字节偏移增量读取（SFTP seek），每批最多 batch_size 字节，读一批写一批，server103 内存占用有上界；
+    - 日志在运行过程中就出现在 server104 上，server103 中途崩溃时已搬运的部分不会丢失；
+    - 写入失败时偏移不前进，下一轮从同一位置重写；
+    - 只保留最后 tail_bytes 字节，供同步执行接口在响应中返回。
+    """
+
+    def __init__(self, source_server, source_path, target_server, target_path,
+                 batch_size=None, interval=None, tail_bytes=None):
+        self.source_server = source_server
+        self.source_path = source_path
+        self.target_server = target_server
+        self.target_path = target_path
+        self.batch_size = batch_size or LOG_SHIPPER_CONFIG['batch_size']
+        self.interval = interval or LOG_SHIPPER_CONFIG['interval']
+        self.tail_bytes = tail_bytes or LOG_SHIPPER_CONFIG['tail_bytes']
+        self.offset = 0          # 已写入 server104 的字节数
+        self.source_seen = False  # 是否见到过临时日志文件
+        self.error = None
+        self._tail = b''
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'log-shipper-{os.path.basename(self.source_path)}',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.ship()
+
+    def ship(self):
+        """把临时日志中尚未搬运的部分追加到 server104，返回本轮搬运的字节数"""
+        ssh_source = None
+        ssh_target = None
+        shipped = 0
+        try:
+            ssh_source = SSH_POOL.acquire(self.source_server)
+            source_sftp = SSH_POOL.open_sftp(ssh_source)
+            try:
+                size = source_sftp.stat(self.source_path).st_size
+            except IOError:
+                return 0  # 命令还没开始写日志
+            self.source_seen = True
+            if size <= self.offset:
+                return 0
+
+            ssh_target = SSH_POOL.acquire(self.target_server)
+            target_sftp = SSH_POOL.open_sftp(ssh_target)
+            with source_sftp.open(self.source_path, 'rb') as src, \
+                    target_sftp.open(self.target_path, 'r+b' if self.offset else 'wb') as dst:
+                src.seek(self.offset)
+                src.prefetch(size)
+                dst.seek(self.offset)
+                while self.offset < size:
+                    data = src.read(min(self.batch_size, size - self.offset))
+                    if not data:
+                        break
+                    dst.write(data)
+                    dst.flush()
+                    self.offset += len(data)
+                    shipped += len(data)
+                    self._tail = (self._tail + data)[-self.tail_bytes:]
+            self.error = None
+        except Exception as e:
+            self.error = str(e)
+            logger.warning(f"[log_shipper] 搬运日志失败 {self.source_server}:{self.source_path} "
+                           f"-> {self.target_server}:{self.target_path}: {str(e)}")
+        finally:
+            SSH_POOL.release(ssh_target)
+            SSH_POOL.release(ssh_source)
+        return shipped
+
+    def finish(self, fallback_text=None):
+        """
+        停止后台线程并搬运剩余的日志
+
+        Args:
+            fallback_text: 临时日志始终不存在时（命令未能启动）写入 server104 log 文件的内容
+
+        Returns:
+            dict: bytes（搬运的总字节数）/ truncated（tail_text 是否只是日志末尾）/ error（最后一次失败的原因）
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.ship()
+        if not self.source_seen and fallback_text:
+            ssh_target = None
+            try:
+                ssh_target = SSH_POOL.acquire(self.target_server)
+                with SSH_POOL.open_sftp(ssh_target).open(self.target_path, 'w') as f:
+                    f.write(fallback_text)
+                self._tail = fallback_text.encode('utf-8')[-self.tail_bytes:]
+            except Exception as e:
+                self.error = str(e)
+                logger.warning(f"[log_shipper] 保存log文件到 {self.target_server} 失败: {str(e)}")
+            finally:
+                SSH_POOL.release(ssh_target)
+        return {'bytes': self.offset, 'truncated': self.offset > len(self._tail), 'error': self.error}
+
+    def tail_text(self):
+        """最后 tail_bytes 字节的日志文本"""
+        return self._tail.decode('utf-8', errors='ignore')
+
+
+class MetadataCache:
+    """
+    目录列表缓存
+
+    - 键为 (服务器, 目录, 列表类型)，同一目录在不同接口中的列表分别缓存；
+    - 超过 ttl 秒的条目视为过期，列表数超过 max_entries 或所有列表的条目总数超过 max_items 时
+      淘汰最久未使用的（LRU）；单个列表超过 max_list_items 条时不缓存；
+    - 修改远程文件的接口调用 invalidate(server, path)：删除该路径自身、其下所有目录以及父目录的列表；
+    - 读取远程列表前取 generation，写入时若期间发生过失效则不写入，避免把失效前读到的旧列表放回缓存。
+    """
+
+    def __init__(self, ttl, max_entries, max_items, max_list_items):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_items = max_items
+        self.max_list_items = max_list_items
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (server, path, kind) -> (缓存时间戳, 响应内容, 条目数)
+        self._items = 0  # 所有缓存列表的条目总数
+        self._skipped = 0  # 因超过 max_list_items 而未缓存的次数
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def _normalize(path):
+        return posixpath.normpath(path or '/')
+
+    @staticmethod
+    def _format_time(timestamp):
+        return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+    @staticmethod
+    def _count_items(payload):
+        """响应内容中列表的条目数（entries / envs / projects 等）"""
+        return sum(len(value) for value in payload.values() if isinstance(value, list))
+
+    def _drop_locked(self, key):
+        """删除一条缓存（需持有锁）"""
+        self._items -= self._entries.pop(key)[2]
+
+    def get(self, server, path, kind):
+        """
+        读取缓存的列表
+
+        Returns:
+            dict | None: 响应内容（附加 cached=True 与 cached_at），未命中或已过期时返回 None
+        """
+        if self.ttl <= 0:
+            return None
+        key = (server, self._normalize(path), kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self._drop_locked(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return dict(entry[1], cached=True, cached_at=self._format_time(entry[0]))
+
+    def put(self, server, path, kind, payload, generation):
+        """
+        写入列表（generation 为读取远程列表前的 self.generation）
+
+        Returns:
+            dict: 响应内容（附加 cached=False 与 cached_at）
+        """
+        now = time.time()
+        if self.ttl > 0 and self.max_entries > 0:
+            key = (server, self._normalize(path), kind)
+            items = self._count_items(payload)
+            with self._lock:
+                if items > min(self.max_list_items, self.max_items):
+                    self._skipped += 1
+                    if key in self._entries:
+                        self._drop_locked(key)
+                elif generation == self.generation:
+                    if key in self._entries:
+                        self._drop_locked(key)
+                    self._entries[key] = (now, payload, items)
+                    self._items += items
+                    while len(self._entries) > self.max_entries or self._items > self.max_items:
+                        self._drop_locked(next(iter(self._entries)))
+        return dict(payload, cached=False, cached_at=self._format_time(now))
+
+    def invalidate(self, server, path):
+        """路径被修改（创建/写入/删除）后调用：删除该路径、其子目录与父目录的缓存列表"""
+        path = self._normalize(path)
+        parent = posixpath.dirname(path)
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            self.generation += 1
+            stale = [
+                key for key in self._entries
+                if key[0] == server and (key[1] in (path, parent) or key[1].startswith(prefix))
+            ]
+            for key in stale:
+                self._drop_locked(key)
+            self._invalidations += 1
+
+    def stats(self):
+        """返回缓存状态"""
+        with self._lock:
+            return {
+                'ttl': self.ttl,
+                'max_entries': self.max_entries,
+                'entries': len(self._entries),
+                'max_items': self.max_items,
+                'items': self._items,
+                'max_list_items': self.max_list_items,
+                'skipped': self._skipped,
+                'hits': self._hits,
+                'misses': self._misses,
+                'invalidations': self._invalidations,
+            }
+
+
+METADATA_CACHE = MetadataCache(**METADATA_CACHE_CONFIG)
+
 
 def execute_ssh_command(ssh_client, command, use_sudo=False):
     """
@@ -54,6 +1184,39 @@ def execute_ssh_command(ssh_client, command, use_sudo=False):
     Returns:
         tuple: (success: bool, stdout: str, stderr: str)
     """
+    exit_status, stdout_text, stderr_text = execute_ssh_command_with_code(ssh_client, command, use_sudo)
+    return exit_status == 0, stdout_text, stderr_text
+
+
+def build_project_run_cmd(command, temp_log):
+    """
+    生成执行项目命令并把输出写入临时日志的 shell 片段（按 PROJECT_RUN_CONFIG 限制运行时间）
+
+    Args:
+        command: 用户命令
+        temp_log: 执行节点上的临时日志文件
+
+    Returns:
+        str: shell 片段
+    """
+    if PROJECT_RUN_CONFIG['timeout']:
+        return (
+            f'timeout -k {int(PROJECT_RUN_CONFIG["kill_after"])} {int(PROJECT_RUN_CONFIG["timeout"])} '
+            f'bash -c {shlex.quote(command)} > "{temp_log}" 2>&1'
+        )
+    return f'({command}) > "{temp_log}" 2>&1'
+
+
+def execute_ssh_command_with_code(ssh_client, command, use_sudo=False, timeout=300):
+    """
+    执行SSH命令并返回退出码（参数同 execute_ssh_command）
+
+    timeout 为通道上两次收到数据之间的最长等待时间（秒），超时按执行出错处理；
+    长时间运行且没有输出的命令应传 None，一直等到远端进程退出。
+
+    Returns:
+        tuple: (exit_code: int, stdout: str, stderr: str)，执行出错时 exit_code 为 -1
+    """
     try:
         if use_sudo:
             # 使用sudo执行命令
@@ -61,20 +1224,16 @@ def execute_ssh_command(ssh_client, command, use_sudo=False):
         else:
             full_command = command
         
-        stdin, stdout, stderr = ssh_client.exec_command(full_command, timeout=300)
-        exit_status = stdout.channel.recv_exit_status()
-        
+        stdin, stdout, stderr = ssh_client.exec_command(full_command, timeout=timeout)
+        # 先读完输出再取退出码：输出超过SSH窗口大小时，不读取会导致远端写阻塞、永远不退出
         stdout_text = stdout.read().decode('utf-8', errors='ignore')
         stderr_text = stderr.read().decode('utf-8', errors='ignore')
-        
-        if exit_status == 0:
-            return True, stdout_text, stderr_text
-        else:
-            return False, stdout_text, stderr_text
+        exit_status = stdout.channel.recv_exit_status()
+        return exit_status, stdout_text, stderr_text
     
     except Exception as e:
         logger.error(f"执行SSH命令失败: {str(e)}", exc_info=True)
-        return False, "", str(e)
+        return -1, "", str(e)
 
 
 def ensure_remote_directory(ssh_client, remote_path, use_sudo=False):
@@ -151,31 +1310,13 @@ def copy_file_remote_to_remote(source_host, source_port, source_user, source_pas
             f"{source_user}@{source_host}:{source_port}{source_path} -> "
             f"{target_user}@{target_host}:{target_port}{target_path}"
         )
-        # 连接源服务器
-        ssh_source = paramiko.SSHClient()
-        ssh_source.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_source.connect(
-            hostname=source_host,
-            port=source_port,
-            username=source_user,
-            password=source_password,
-            timeout=30
-        )
-        
-        # 连接目标服务器
-        ssh_target = paramiko.SSHClient()
-        ssh_target.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_target.connect(
-            hostname=target_host,
-            port=target_port,
-            username=target_user,
-            password=target_password,
-            timeout=30
-        )
+        # 从连接池借用源/目标服务器连接
+        ssh_source = SSH_POOL.acquire_for(source_host, source_port, source_user, source_password)
+        ssh_target = SSH_POOL.acquire_for(target_host, target_port, target_user, target_password)
 
         # 打开 SFTP
-        sftp_source = ssh_source.open_sftp()
-        sftp_target = ssh_target.open_sftp()
+        sftp_source = SSH_POOL.open_sftp(ssh_source)
+        sftp_target = SSH_POOL.open_sftp(ssh_target)
 
         # 确保目标目录存在
         target_dir = os.path.dirname(target_path)
@@ -196,12 +1337,7 @@ def copy_file_remote_to_remote(source_host, source_port, source_user, source_pas
 
         # 复制文件
         logger.info(f"[copy_file_remote_to_remote] 复制文件: {source_path} -> {target_path}")
-        with sftp_source.open(source_path, 'rb') as f_src, sftp_target.open(target_path, 'wb') as f_dst:
-            while True:
-                chunk = f_src.read(32768)
-                if not chunk:
-                    break
-                f_dst.write(chunk)
+        sftp_copy_file_data(sftp_source, source_path, sftp_target, target_path)
 
         return True, f"文件传输成功: {source_host}:{source_path} -> {target_host}:{target_path}"
     
@@ -214,33 +1350,24 @@ def copy_file_remote_to_remote(source_host, source_port, source_user, source_pas
         return False, f"传输过程出错: {str(e)}"
     
     finally:
-        # 安全关闭连接
-        if sftp_source:
-            try:
-                sftp_source.close()
-            except Exception as e:
-                logger.warning(f"关闭源SFTP失败: {str(e)}")
-        if sftp_target:
-            try:
-                sftp_target.close()
-            except Exception as e:
-                logger.warning(f"关闭目标SFTP失败: {str(e)}")
-        if ssh_source:
-            try:
-                ssh_source.close()
-            except Exception as e:
-                logger.warning(f"关闭源SSH连接失败: {str(e)}")
-        if ssh_target:
-            try:
-                ssh_target.close()
-            except Exception as e:
-                logger.warning(f"关闭目标SSH连接失败: {str(e)}")
+        # 归还连接（SFTP 会话由连接池缓存复用）
+        SSH_POOL.release(ssh_source)
+        SSH_POOL.release(ssh_target)
 
 
 def copy_folder_remote_to_remote(source_host, source_port, source_user, source_password, source_path,
-                                 target_host, target_port, target_user, target_password, target_path):
+                                 target_host, target_port, target_user, target_password, target_path,
+                                 transport='sftp', channels=None, direct=False, ignore=None):
     """
-    使用 paramiko SFTP 递归复制目录（方案 B）
+    递归复制目录（远程到远程），目标目录存在时先清空
+
+    Args:
+        transport: 'sftp' 多通道并行 SFTP 复制（方案 B，默认）；
+                   'tar' 源端 tar c 经 server103 管道直接接到目标端 tar x，整目录一个连续数据流
+        channels: sftp 方式的并行通道数，None 时按 PARALLEL_TRANSFER_CONFIG 配置
+        direct: 为 True 时先尝试让源节点直接推送到目标节点（rsync / tar 管道），
+                不可直连或推送失败时回退到经 server103 中转的 transport 方式
+        ignore: SyncIgnore，不为空时先取源目录清单去掉被忽略的条目，只复制其余的目录与文件
     """
     ssh_source = None
     ssh_target = None
@@ -253,142 +1380,2874 @@ def copy_folder_remote_to_remote(source_host, source_port, source_user, source_p
             f"{source_user}@{source_host}:{source_port}{source_path} -> "
             f"{target_user}@{target_host}:{target_port}{target_path}"
         )
-        # 连接源服务器
-        ssh_source = paramiko.SSHClient()
-        ssh_source.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_source.connect(
-            hostname=source_host,
-            port=source_port,
-            username=source_user,
-            password=source_password,
-            timeout=30
-        )
-        
-        # 连接目标服务器
-        ssh_target = paramiko.SSHClient()
-        ssh_target.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_target.connect(
-            hostname=target_host,
-            port=target_port,
-            username=target_user,
-            password=target_password,
-            timeout=30
-        )
+        # 从连接池借用源/目标服务器连接
+        ssh_source = SSH_POOL.acquire_for(source_host, source_port, source_user, source_password)
+        ssh_target = SSH_POOL.acquire_for(target_host, target_port, target_user, target_password)
 
         # 打开 SFTP
-        sftp_source = ssh_source.open_sftp()
-        sftp_target = ssh_target.open_sftp()
+        sftp_source = SSH_POOL.open_sftp(ssh_source)
+        sftp_target = SSH_POOL.open_sftp(ssh_target)
 
         # 统一去掉结尾的 /
         source_path_clean = source_path.rstrip('/')
         target_path_clean = target_path.rstrip('/')
 
-        def sftp_mkdir_p(sftp, remote_path):
-            remote_path = remote_path.rstrip('/')
-            if not remote_path:
+        def sftp_rmtree(sftp, remote_path):
+            """递归删除远程目录（如果不存在则忽略）"""
+            try:
+                for entry in sftp.listdir_attr(remote_path):
+                    name = entry.filename
+                    if name in ('.', '..'):
+                        continue
+                    full = f"{remote_path.rstrip('/')}/{name}"
+                    if stat.S_ISDIR(entry.st_mode):
+                        sftp_rmtree(sftp, full)
+                    else:
+                        sftp.remove(full)
+                sftp.rmdir(remote_path)
+            except IOError:
                 return
-            parts = remote_path.split('/')
-            cur = ''
-            for p in parts:
-                if not p:
-                    continue
-                cur += f'/{p}'
+
+        pushed = False
+        if ignore:
+            # 按过滤后的清单复制：被忽略的文件不传输，直连 / tar / sftp 由 copy_files_remote_to_remote 选择
+            manifest = build_remote_manifest(ssh_source, source_path_clean)
+            if manifest is None:
+                return False, f"源目录不存在: {source_host}:{source_path_clean}"
+            manifest, files_ignored, bytes_ignored = ignore.filter_manifest(manifest)
+            logger.info(
+                f"[copy_folder_remote_to_remote] 按忽略规则跳过 {files_ignored} 个文件（{bytes_ignored} 字节），"
+                f"清理目标目录（如果存在）: {target_path_clean}"
+            )
+            ok, _, err = execute_ssh_command(ssh_target, f'rm -rf "{target_path_clean}"', use_sudo=False)
+            if not ok:
+                execute_ssh_command(ssh_target, f'rm -rf "{target_path_clean}"', use_sudo=True)
+            ok, err = remote_mkdirs(ssh_target, [target_path_clean] + [
+                f"{target_path_clean}/{rel}" for rel, entry in manifest.items() if entry['type'] == 'd'
+            ])
+            if not ok:
+                return False, f"创建目标目录失败: {err}"
+            copy_files_remote_to_remote(
+                source_host, source_port, source_user, source_password, source_path_clean,
+                target_host, target_port, target_user, target_password, target_path_clean,
+                {rel: entry['size'] for rel, entry in manifest.items() if entry['type'] == 'f'},
+                transport=transport, channels=channels, direct=direct
+            )
+            pushed = True  # 已按清单复制完成，跳过下面的整目录复制
+        elif direct:
+            path = probe_direct_path(ssh_source, source_host, source_port, source_user, source_password,
+                                     target_host, target_port, target_user, target_password)
+            if path:
+                pushed, push_message = direct_push_remote_to_remote(
+                    ssh_source, source_path_clean, target_host, target_port, target_user, target_password,
+                    target_path_clean, path
+                )
+                logger.info(f"[copy_folder_remote_to_remote] {push_message}")
+            if not pushed:
+                logger.info(f"[copy_folder_remote_to_remote] 节点间无法直连，回退到经 server103 中转（{transport}）")
+
+        if not pushed and transport == 'tar':
+            # 一条 rm -rf 代替逐文件删除，再用单个 tar 数据流复制整个目录
+            logger.info(f"[copy_folder_remote_to_remote] 清理目标目录（如果存在）: {target_path_clean}")
+            ok, _, err = execute_ssh_command(ssh_target, f'rm -rf "{target_path_clean}"', use_sudo=False)
+            if not ok:
+                execute_ssh_command(ssh_target, f'rm -rf "{target_path_clean}"', use_sudo=True)
+            streamed = tar_stream_remote_to_remote(ssh_source, source_path_clean, ssh_target, target_path_clean)
+            logger.info(f"[copy_folder_remote_to_remote] tar 流传输完成: {streamed} 字节")
+        elif not pushed:
+            logger.info(f"[copy_folder_remote_to_remote] 清理目标目录（如果存在）: {target_path_clean}")
+            sftp_rmtree(sftp_target, target_path_clean)
+
+            # 先建好全部目录，再把文件分发到多个 SFTP 通道并行复制
+            logger.info(f"[copy_folder_remote_to_remote] 复制目录: {source_path_clean} -> {target_path_clean}")
+            dirs, file_pairs = sftp_walk_files(sftp_source, source_path_clean, target_path_clean)
+            sftp_mkdir_p(sftp_target, dirs[0])
+            for d in dirs[1:]:
+                sftp_target.mkdir(d)
+            results = parallel_sftp_copy(
+                source_host, source_port, source_user, source_password,
+                target_host, target_port, target_user, target_password,
+                file_pairs, channels=channels
+            )
+            failed = [r for r in results if not r['success']]
+            if failed:
+                return False, (
+                    f"文件夹传输失败: {len(failed)}/{len(results)} 个文件复制失败，"
+                    f"首个错误: {failed[0]['source']}: {failed[0]['message']}"
+                )
+
+        # 校验目标目录
+        list_cmd = f'ls -la "{target_path_clean}" 2>&1'
+        logger.info(f"[copy_folder_remote_to_remote] 目标目录校验命令: {list_cmd}")
+        ok, out, err = execute_ssh_command(ssh_target, list_cmd, use_sudo=False)
+        debug_info = out if ok else err
+
+        return True, (
+            f"文件夹传输成功: {source_host}:{source_path} -> {target_host}:{target_path}\n"
+            f"目标目录内容:\n{debug_info}"
+        )
+    
+    except paramiko.AuthenticationException:
+        return False, f"SSH认证失败: 用户名或密码错误"
+    except paramiko.SSHException as e:
+        return False, f"SSH连接错误: {str(e)}"
+    except Exception as e:
+        logger.error(f"传输过程出错: {str(e)}", exc_info=True)
+        return False, f"传输过程出错: {str(e)}"
+    
+    finally:
+        # 归还连接（SFTP 会话由连接池缓存复用）
+        SSH_POOL.release(ssh_source)
+        SSH_POOL.release(ssh_target)
+
+
+def sftp_mkdir_p(sftp, remote_path):
+    """递归创建远程目录（已存在则跳过）"""
+    remote_path = remote_path.rstrip('/')
+    if not remote_path:
+        return
+    cur = ''
+    for p in remote_path.split('/'):
+        if not p:
+            continue
+        cur += f'/{p}'
+        try:
+            sftp.stat(cur)
+        except IOError:
+            try:
+                sftp.mkdir(cur)
+            except Exception as e:
+                logger.warning(f"[sftp_mkdir_p] 创建目录失败 {cur}: {e}")
+
+
+def sftp_copy_file_data(src_sftp, src_path, dst_sftp, dst_path, block_size=None, window=None):
+    """
+    在两个SFTP会话之间复制单个文件的内容
+
+    源文件使用 prefetch 一次性发出多个并发读请求，目标文件开启 pipelined 写（不逐包等待确认），
+    较大的文件再由读线程和写线程通过有界队列双缓冲，使源端读取与目标端写入重叠进行。
+
+    Args:
+        block_size: 每块字节数，默认 SFTP_COPY_CONFIG['block_size']
+        window: 读写之间最多缓冲的块数，默认 SFTP_COPY_CONFIG['window']
+
+    Returns:
+        int: 复制的字节数
+    """
+    block_size = block_size or SFTP_COPY_CONFIG['block_size']
+    window = window or SFTP_COPY_CONFIG['window']
+    copied = 0
+    with src_sftp.open(src_path, 'rb', bufsize=block_size) as f_src, \
+            dst_sftp.open(dst_path, 'wb', bufsize=block_size) as f_dst:
+        file_size = f_src.stat().st_size
+        f_src.prefetch(file_size, max_concurrent_requests=SFTP_COPY_CONFIG['prefetch_requests'])
+        f_dst.set_pipelined(True)
+
+        if file_size < SFTP_COPY_CONFIG['threaded_min_size']:
+            while True:
+                chunk = f_src.read(block_size)
+                if not chunk:
+                    break
+                f_dst.write(chunk)
+                copied += len(chunk)
+            return copied
+
+        blocks = queue.Queue(maxsize=window)
+        read_error = []
+        stop = threading.Event()
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    chunk = f_src.read(block_size)
+                    blocks.put(chunk)
+                    if not chunk:
+                        return
+            except Exception as e:
+                read_error.append(e)
+                blocks.put(b'')
+
+        reader_thread = threading.Thread(target=reader, daemon=True)
+        reader_thread.start()
+        try:
+            while True:
+                chunk = blocks.get()
+                if not chunk:
+                    break
+                f_dst.write(chunk)
+                copied += len(chunk)
+        finally:
+            # 写入出错时让读线程尽快退出（清空队列避免其阻塞在 put 上）
+            stop.set()
+            while reader_thread.is_alive():
                 try:
-                    sftp.stat(cur)
-                except IOError:
-                    try:
-                        sftp.mkdir(cur)
-                    except Exception as e:
-                        logger.warning(f"[copy_folder_remote_to_remote] 创建目录失败 {cur}: {e}")
+                    blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            reader_thread.join()
+        if read_error:
+            raise read_error[0]
+    return copied
+
+
+def get_transfer_channels(source_key, target_key, channels=None):
+    """
+    决定一对服务器之间并行 SFTP 传输的通道数
+
+    Args:
+        source_key: 源服务器名称（SSH_POOL.resolve_key 的结果）
+        target_key: 目标服务器名称
+        channels: 调用方指定的通道数，None 时读取 PARALLEL_TRANSFER_CONFIG
+
+    Returns:
+        int: 通道数（至少 1；调用线程本身可能已占用一条连接，因此不超过单节点连接上限 - 1）
+    """
+    if channels is None:
+        channels = PARALLEL_TRANSFER_CONFIG['server_pairs'].get(
+            (source_key, target_key), PARALLEL_TRANSFER_CONFIG['default_channels']
+        )
+    return max(1, min(int(channels), SSH_POOL.max_connections_per_server - 1))
+
+
+def sftp_walk_files(sftp, src_root, dst_root):
+    """
+    遍历源目录，列出需要在目标端创建的目录和需要复制的文件
+
+    Returns:
+        tuple: (dirs: list[str], file_pairs: list[(源文件, 目标文件)])，dirs 按浅层在前排列
+    """
+    dirs = [dst_root]
+    file_pairs = []
+    for entry in sftp.listdir_attr(src_root):
+        name = entry.filename
+        if name in ('.', '..'):
+            continue
+        src_item = f"{src_root.rstrip('/')}/{name}"
+        dst_item = f"{dst_root.rstrip('/')}/{name}"
+        if stat.S_ISDIR(entry.st_mode):
+            sub_dirs, sub_files = sftp_walk_files(sftp, src_item, dst_item)
+            dirs.extend(sub_dirs)
+            file_pairs.extend(sub_files)
+        else:
+            file_pairs.append((src_item, dst_item))
+    return dirs, file_pairs
+
+
+def parallel_sftp_copy(source_host, source_port, source_user, source_password,
+                       target_host, target_port, target_user, target_password,
+                       file_pairs, channels=None, copy_func=None):
+    """
+    多通道并行复制文件（远程到远程）
+
+    调用线程自己作为第一个通道（沿用它已从连接池借出的连接），另外最多 N-1 个工作线程各自不等待地
+    借用一对独立的源/目标连接（各自的 SFTP 通道），借不到就不启动该通道，因此连接池繁忙时自动减少
+    并行度而不会等待超时。所有通道从共享队列中取文件复制，单个大文件或慢文件不会阻塞其他文件。
+
+    Args:
+        source_*/target_*: 同 copy_file_remote_to_remote
+        file_pairs: [(源文件路径, 目标文件路径), ...]，目标文件的父目录需已存在
+        channels: 最大并行通道数，None 时按 PARALLEL_TRANSFER_CONFIG 取该服务器对的配置
+        copy_func: 单文件复制函数 copy_func(sftp_source, src, sftp_target, dst) -> 字节数，
+                   默认 sftp_copy_file_data
+
+    Returns:
+        list: 与 file_pairs 顺序一致的结果列表，格式同 copy_multiple_remote_to_remote 的 results
+              （source / target / type / success / message），成功项额外带 bytes
+    """
+    if not file_pairs:
+        return []
+    copy_func = copy_func or sftp_copy_file_data
+    source_key = SSH_POOL.resolve_key(source_host, source_port, source_user, source_password)
+    target_key = SSH_POOL.resolve_key(target_host, target_port, target_user, target_password)
+    channels = min(get_transfer_channels(source_key, target_key, channels), len(file_pairs))
+
+    pending = queue.Queue()
+    for index, pair in enumerate(file_pairs):
+        pending.put((index, pair))
+    results = [None] * len(file_pairs)
+    active_channels = []
+    started = time.time()
+
+    def borrow(acquire):
+        """借一对源/目标连接，任一端借不到时归还另一端并返回 None"""
+        ssh_source = None
+        try:
+            ssh_source = acquire(source_key)
+            if ssh_source is None:
+                return None
+            ssh_target = acquire(target_key)
+            if ssh_target is None:
+                SSH_POOL.release(ssh_source)
+                return None
+            return ssh_source, ssh_target
+        except Exception as e:
+            logger.warning(f"[parallel_sftp_copy] 传输通道建立失败: {str(e)}")
+            SSH_POOL.release(ssh_source)
+            return None
+
+    def worker(pair=None):
+        if pair is None:
+            if pending.empty():
+                return
+            pair = borrow(SSH_POOL.try_acquire)
+            if pair is None:
+                return
+        ssh_source, ssh_target = pair
+        try:
+            sftp_source = SSH_POOL.open_sftp(ssh_source)
+            sftp_target = SSH_POOL.open_sftp(ssh_target)
+        except Exception as e:
+            # 打不开 SFTP 的通道直接退出，剩余文件由其他通道处理
+            logger.warning(f"[parallel_sftp_copy] 传输通道建立失败: {str(e)}")
+            SSH_POOL.release(ssh_source, discard=True)
+            SSH_POOL.release(ssh_target, discard=True)
+            return
+        active_channels.append(1)
+        try:
+            while True:
+                try:
+                    index, (src, dst) = pending.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    copied = copy_func(sftp_source, src, sftp_target, dst)
+                    results[index] = {
+                        'source': src,
+                        'target': dst,
+                        'type': 'file',
+                        'success': True,
+                        'message': '文件传输成功',
+                        'bytes': copied
+                    }
+                except Exception as e:
+                    logger.warning(f"[parallel_sftp_copy] 复制文件失败 {src} -> {dst}: {str(e)}")
+                    results[index] = {
+                        'source': src,
+                        'target': dst,
+                        'type': 'file',
+                        'success': False,
+                        'message': f'文件传输失败: {str(e)}'
+                    }
+                    # 连接已断开时本通道退出，剩余文件交给其他通道
+                    if not (ssh_source.get_transport().is_active() and ssh_target.get_transport().is_active()):
+                        break
+        finally:
+            SSH_POOL.release(ssh_source)
+            SSH_POOL.release(ssh_target)
+
+    # 调用线程先借到自己的通道（已借出的连接直接复用），额外通道只用连接池中剩余的连接
+    first_pair = borrow(SSH_POOL.acquire)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(channels - 1)]
+    for t in threads:
+        t.start()
+    if first_pair:
+        worker(first_pair)
+    for t in threads:
+        t.join()
+
+    # 所有通道都退出后仍未处理的文件
+    for index, (src, dst) in enumerate(file_pairs):
+        if results[index] is None:
+            results[index] = {
+                'source': src,
+                'target': dst,
+                'type': 'file',
+                'success': False,
+                'message': '文件传输失败: 没有可用的传输通道'
+            }
+
+    total_bytes = sum(r.get('bytes', 0) for r in results)
+    failed = sum(1 for r in results if not r['success'])
+    logger.info(
+        f"[parallel_sftp_copy] {source_key} -> {target_key}: {len(file_pairs)} 个文件，"
+        f"{len(active_channels)}/{channels} 个通道，失败 {failed} 个，{total_bytes} 字节，"
+        f"耗时 {time.time() - started:.3f}s"
+    )
+    return results
+
+
+def tar_stream_remote_to_remote(ssh_source, source_dir, ssh_target, target_dir, file_list=None):
+    """
+    用 tar 数据流复制目录：源端 tar c -> server103 中转 -> 目标端 tar x
+
+    整个目录只占用两个 SSH 通道、一个连续数据流，省去 SFTP 每个目录/文件的 stat/open/close 往返。
+    tar 会保留修改时间与权限；解包时已存在的同名文件会先被删除再创建（新 inode）。
+
+    Args:
+        ssh_source: 源服务器 SSH 客户端
+        source_dir: 源目录
+        ssh_target: 目标服务器 SSH 客户端
+        target_dir: 目标目录（不存在则创建）
+        file_list: 只打包这些相对路径（None 表示整个目录）
+
+    Returns:
+        int: 经过 server103 中转的 tar 流字节数
+
+    Raises:
+        IOError: 任一端 tar 失败
+    """
+    if file_list is None:
+        src_cmd = f'tar -C "{source_dir}" -cf - .'
+    else:
+        src_cmd = f'tar -C "{source_dir}" --null -T - -cf -'
+    dst_cmd = f'mkdir -p "{target_dir}" && tar -C "{target_dir}" --no-same-owner -xpf -'
+
+    src_chan = ssh_source.get_transport().open_session()
+    dst_chan = ssh_target.get_transport().open_session()
+    try:
+        src_chan.exec_command(src_cmd)
+        dst_chan.exec_command(dst_cmd)
+
+        if file_list is not None:
+            # 单独线程写入文件列表，避免列表很大时与 tar 输出互相等待
+            def feed_names():
+                try:
+                    for rel in file_list:
+                        src_chan.sendall(rel.encode('utf-8') + b'\0')
+                finally:
+                    src_chan.shutdown_write()
+            threading.Thread(target=feed_names, daemon=True).start()
+
+        streamed = 0
+        while True:
+            data = src_chan.recv(TAR_STREAM_BUFFER_SIZE)
+            if not data:
+                break
+            dst_chan.sendall(data)
+            streamed += len(data)
+        dst_chan.shutdown_write()
+
+        src_status = src_chan.recv_exit_status()
+        dst_status = dst_chan.recv_exit_status()
+        src_err = src_chan.recv_stderr(65536).decode('utf-8', errors='ignore') if src_chan.recv_stderr_ready() else ''
+        dst_err = dst_chan.recv_stderr(65536).decode('utf-8', errors='ignore') if dst_chan.recv_stderr_ready() else ''
+        # GNU tar 退出码 1 表示打包过程中文件发生变化，内容仍然完整，只记录警告
+        if src_status not in (0, 1):
+            raise IOError(f"源端 tar 打包失败（退出码 {src_status}）: {src_err.strip()}")
+        if src_status == 1:
+            logger.warning(f"[tar_stream_remote_to_remote] 源端打包时有文件发生变化: {src_err.strip()}")
+        if dst_status != 0:
+            raise IOError(f"目标端 tar 解包失败（退出码 {dst_status}）: {dst_err.strip()}")
+        return streamed
+    finally:
+        src_chan.close()
+        dst_chan.close()
+
+
+_DIRECT_PATH_CACHE = {}  # (源服务器, 目标服务器) -> (探测时间, 直连方式 dict 或 None)
+_DIRECT_PATH_LOCK = threading.Lock()
+
+
+def _direct_ssh_command(target_port, target_password, auth):
+    """
+    拼接在源节点上登录目标节点的 ssh 命令
+
+    Returns:
+        tuple: (env: str, ssh: str)。env 需放在整条命令最前面（sshpass 方式导出 SSHPASS），
+               ssh 可直接使用，也可作为 rsync -e 的参数
+    """
+    options = (
+        f"-p {int(target_port)} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null "
+        f"-o LogLevel=ERROR -o ConnectTimeout={DIRECT_TRANSFER_CONFIG['connect_timeout']}"
+    )
+    if DIRECT_TRANSFER_CONFIG['identity_file']:
+        options += f" -i {shlex.quote(DIRECT_TRANSFER_CONFIG['identity_file'])}"
+    if auth == 'key':
+        return '', f"ssh {options} -o BatchMode=yes"
+    return f"export SSHPASS={shlex.quote(target_password)}; ", f"sshpass -e ssh {options}"
+
+
+def probe_direct_path(ssh_source, source_host, source_port, source_user, source_password,
+                      target_host, target_port, target_user, target_password):
+    """
+    探测源节点能否直接 ssh 到目标节点，以及可用的推送工具
+
+    依次尝试免密登录与 sshpass 密码登录；两端都有 rsync 时用 rsync，否则用 tar 管道。
+    结果按服务器对缓存 DIRECT_TRANSFER_CONFIG['probe_ttl'] 秒。
+
+    Returns:
+        dict | None: {'auth': 'key'|'sshpass', 'tool': 'rsync'|'tar'}，不可直连时返回 None
+    """
+    source_key = SSH_POOL.resolve_key(source_host, source_port, source_user, source_password)
+    target_key = SSH_POOL.resolve_key(target_host, target_port, target_user, target_password)
+    cache_key = (source_key, target_key)
+    with _DIRECT_PATH_LOCK:
+        cached = _DIRECT_PATH_CACHE.get(cache_key)
+    if cached and time.time() - cached[0] < DIRECT_TRANSFER_CONFIG['probe_ttl']:
+        return cached[1]
+
+    ok, out, _ = execute_ssh_command(
+        ssh_source, 'command -v rsync >/dev/null && echo rsync; command -v sshpass >/dev/null && echo sshpass',
+        use_sudo=False
+    )
+    source_tools = out.split() if ok else []
+    candidates = ['key'] + (['sshpass'] if 'sshpass' in source_tools else [])
+
+    path = None
+    for auth in candidates:
+        env, ssh_cmd = _direct_ssh_command(target_port, target_password, auth)
+        probe_cmd = (
+            f"{env}{ssh_cmd} {shlex.quote(f'{target_user}@{target_host}')} "
+            f"{shlex.quote('command -v rsync >/dev/null && echo rsync || echo tar')}"
+        )
+        ok, out, err = execute_ssh_command(ssh_source, probe_cmd, use_sudo=False)
+        if ok and out.strip():
+            tool = 'rsync' if out.strip() == 'rsync' and 'rsync' in source_tools else 'tar'
+            path = {'auth': auth, 'tool': tool}
+            break
+        logger.info(f"[probe_direct_path] {source_key} -> {target_key} 无法以 {auth} 方式直连: {err.strip()}")
+
+    logger.info(f"[probe_direct_path] {source_key} -> {target_key} 直连方式: {path}")
+    with _DIRECT_PATH_LOCK:
+        _DIRECT_PATH_CACHE[cache_key] = (time.time(), path)
+    return path
+
+
+def direct_push_remote_to_remote(ssh_source, source_path, target_host, target_port, target_user,
+                                 target_password, target_path, path, replace=True, file_list=None):
+    """
+    让源节点直接把文件/目录推送到目标节点，数据不经过 server103
+
+    Args:
+        ssh_source: 源服务器 SSH 客户端
+        source_path: 源文件或目录
+        target_*: 目标服务器连接参数
+        target_path: replace=True 时为目标目录（先清空，内容与 source_path 目录一致）；
+                     replace=False 时为父目录，source_path 复制到其下同名位置
+        path: probe_direct_path 的返回值
+        file_list: 只推送 source_path 目录下的这些相对路径（增量同步用，目标目录不清空，统一用 tar 管道）
+
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    env, ssh_cmd = _direct_ssh_command(target_port, target_password, path['auth'])
+    login = shlex.quote(f'{target_user}@{target_host}')
+    source_path = source_path.rstrip('/')
+    target_path = target_path.rstrip('/')
+
+    list_path = None
+    if file_list is not None:
+        # 文件列表先写到源节点的临时文件，tar -T 从中读取
+        list_path = f"/tmp/.direct_push_{int(time.time() * 1000000)}_{threading.get_ident()}.list"
+        with SSH_POOL.open_sftp(ssh_source).open(list_path, 'wb') as f_list:
+            f_list.write(b''.join(rel.encode('utf-8') + b'\0' for rel in file_list))
+
+    if file_list is not None or (replace and path['tool'] == 'rsync'):
+        # rsync --delete 本身会让目标目录与源一致，保留已有文件以便只传差异
+        prepare = f'mkdir -p {shlex.quote(target_path)}'
+    elif replace:
+        prepare = f'rm -rf {shlex.quote(target_path)} && mkdir -p {shlex.quote(target_path)}'
+    else:
+        prepare = f'mkdir -p {shlex.quote(target_path)}'
+    if path['tool'] == 'rsync' and file_list is None:
+        src_arg = f"{source_path}/" if replace else source_path
+        push_cmd = (
+            f"rsync -a --delete -e {shlex.quote(ssh_cmd)} "
+            f"{shlex.quote(src_arg)} {login}:{shlex.quote(target_path + '/')}"
+        )
+    else:
+        if list_path:
+            tar_src = f'tar -C {shlex.quote(source_path)} --null -T {shlex.quote(list_path)} -cf -'
+        elif replace:
+            tar_src = f'tar -C {shlex.quote(source_path)} -cf - .'
+        else:
+            parent, name = os.path.split(source_path)
+            tar_src = f'tar -C {shlex.quote(parent or "/")} -cf - {shlex.quote(name)}'
+        untar = f'tar -C {shlex.quote(target_path)} --no-same-owner -xpf -'
+        push_cmd = f"{tar_src} | {ssh_cmd} {login} {shlex.quote(untar)}"
+
+    command = f"set -o pipefail; {env}{ssh_cmd} {login} {shlex.quote(prepare)} && {push_cmd}"
+    if list_path:
+        command = f"{command}; rc=$?; rm -f {shlex.quote(list_path)}; exit $rc"
+    started = time.time()
+    ok, out, err = execute_ssh_command(ssh_source, command, use_sudo=False)
+    if not ok:
+        return False, f"直连推送失败（{path['tool']}）: {(err or out).strip()}"
+    return True, f"直连推送成功（{path['tool']}，{path['auth']}），耗时 {time.time() - started:.3f}s"
+
+
+def build_remote_manifest(ssh_client, root_path, with_hash=False):
+    """
+    通过一次远程 find 调用获取目录清单（不逐个 stat）
+
+    Args:
+        ssh_client: paramiko SSH客户端
+        root_path: 远程目录
+        with_hash: 是否额外计算每个文件的 sha256
+
+    Returns:
+        dict | None: {相对路径: {'type': 'f'/'d', 'size', 'mtime', 'mode', 'hash'}}，目录不存在时返回 None
+    """
+    root = root_path.rstrip('/') or '/'
+    # 以 \0 分隔，避免文件名中的空格/换行破坏解析；-L 跟随符号链接，与原 SFTP 复制时按内容复制一致
+    list_cmd = (
+        f'if [ -d "{root}" ]; then cd "{root}" && '
+        f'find -L . -mindepth 1 -printf "%Y\\t%s\\t%T@\\t%m\\t%P\\0" 2>/dev/null; '
+        f'else echo "__NOT_EXISTS__"; fi'
+    )
+    success, stdout, stderr = execute_ssh_command(ssh_client, list_cmd, use_sudo=False)
+    if stdout.strip() == '__NOT_EXISTS__':
+        return None
+
+    manifest = {}
+    for record in stdout.split('\0'):
+        parts = record.split('\t', 4)
+        if len(parts) != 5 or not parts[4]:
+            continue
+        ftype, size, mtime, mode, rel = parts
+        if ftype not in ('f', 'd'):
+            # 失效链接（N）、循环链接（L）、设备文件等一律跳过
+            continue
+        manifest[rel] = {
+            'type': ftype,
+            'size': int(size) if size.isdigit() else 0,
+            'mtime': int(float(mtime)) if mtime else 0,
+            'mode': int(mode, 8) if mode else 0o644,
+            'hash': None
+        }
+
+    if with_hash:
+        hash_remote_manifest(ssh_client, root, manifest)
+
+    return manifest
+
+
+def hash_remote_manifest(ssh_client, root_path, manifest, only_listed=False):
+    """
+    计算清单中文件的 sha256，写入各条目的 'hash'
+
+    Args:
+        only_listed: 为 True 时只计算清单中列出的文件（文件列表经临时文件传给远端，用于按忽略规则过滤后的清单），
+                     否则对整个目录执行一次 find | sha256sum
+    """
+    root = root_path.rstrip('/') or '/'
+    if only_listed:
+        files = [rel for rel, entry in manifest.items() if entry['type'] == 'f']
+        if not files:
+            return
+        list_path = f'/tmp/.manifest_hash_{uuid.uuid4().hex[:12]}.list'
+        with SSH_POOL.open_sftp(ssh_client).open(list_path, 'wb') as f_list:
+            f_list.write(b''.join(rel.encode('utf-8') + b'\0' for rel in files))
+        hash_cmd = (
+            f'cd "{root}" && xargs -0 -r sha256sum -- < {shlex.quote(list_path)} 2>/dev/null; '
+            f'rm -f {shlex.quote(list_path)}'
+        )
+    else:
+        hash_cmd = f'cd "{root}" && find -L . -type f -print0 2>/dev/null | xargs -0 -r sha256sum'
+    ok, hash_out, _ = execute_ssh_command(ssh_client, hash_cmd, use_sudo=False)
+    for line in hash_out.splitlines():
+        # sha256sum 对含特殊字符的文件名会以 \ 开头转义，这类文件退回按 size/mtime 比较
+        if len(line) < 67 or line.startswith('\\'):
+            continue
+        digest, rel = line[:64], line[66:]
+        if rel.startswith('./'):
+            rel = rel[2:]
+        if rel in manifest:
+            manifest[rel]['hash'] = digest
+
+
+class SyncIgnore:
+    """
+    项目同步 / 运行归档的忽略规则（.syncignore，语法为 .gitignore 的常用子集）
+
+    - 每行一个 glob（* 可以跨越 /），空行与 # 开头的行忽略，行首的 \\ 用于转义 # 或 !；
+    - 以 / 结尾的模式只匹配目录；以 / 开头或中间含 / 的模式与相对项目根目录的完整路径比较，否则与任意层级的名称比较；
+    - 以 ! 开头表示重新包含，后面的规则覆盖前面的；
+    - 被忽略的目录整个跳过，其中的文件不能再用 ! 重新包含。
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = []
+        self._rules = []
+        for line in patterns:
+            line = str(line).rstrip()
+            if not line.strip() or line.startswith('#'):
+                continue
+            self.patterns.append(line)
+            negate = line.startswith('!')
+            if negate or line.startswith('\\'):
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if line.startswith('**/'):
+                line = line[3:]
+                if '/' in line:
+                    # **/a/b 既匹配根目录下的 a/b，也匹配任意层级下的 a/b
+                    self._rules.append((negate, dir_only, True, f'*/{line}'))
+                else:
+                    anchored = False
+            if line:
+                self._rules.append((negate, dir_only, anchored, line))
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def match(self, relative, is_dir=False):
+        """相对路径本身是否被忽略（不考虑上级目录）"""
+        name = relative.rsplit('/', 1)[-1]
+        ignored = False
+        for negate, dir_only, anchored, pattern in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if fnmatch.fnmatchcase(relative if anchored else name, pattern):
+                ignored = not negate
+        return ignored
+
+    def filter_manifest(self, manifest):
+        """
+        过滤 build_remote_manifest 的清单
+
+        Returns:
+            tuple: (保留的清单, 被忽略的文件数, 被忽略的字节数)
+        """
+        kept = {}
+        ignored_dirs = set()
+        files_ignored = 0
+        bytes_ignored = 0
+        for rel in sorted(manifest, key=lambda r: r.count('/')):
+            entry = manifest[rel]
+            parent = rel.rsplit('/', 1)[0] if '/' in rel else None
+            if parent in ignored_dirs or self.match(rel, entry['type'] == 'd'):
+                if entry['type'] == 'd':
+                    ignored_dirs.add(rel)
+                else:
+                    files_ignored += 1
+                    bytes_ignored += entry['size']
+                continue
+            kept[rel] = entry
+        return kept, files_ignored, bytes_ignored
+
+
+def parse_sync_ignore_patterns(value):
+    """
+    解析请求中的 sync_ignore（字符串数组，或与 .syncignore 格式相同的多行字符串）
+
+    Returns:
+        list | None: 规则列表，格式不正确时返回 None
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return value.splitlines()
+    if isinstance(value, list) and all(isinstance(p, str) for p in value):
+        return value
+    return None
+
+
+def load_sync_ignore(project_path_source, extra_patterns=None, use_file=True):
+    """
+    读取 server101 上项目根目录的 .syncignore，按「默认规则 -> 文件 -> extra_patterns」的顺序合并
+
+    Args:
+        project_path_source: server101 上的项目目录
+        extra_patterns: 请求中附加的规则（可用 ! 重新包含文件中忽略的路径）
+        use_file: 为 False 时不读取 .syncignore
+
+    Returns:
+        SyncIgnore
+    """
+    patterns = list(SYNC_IGNORE_CONFIG['default_patterns'])
+    if use_file:
+        ignore_path = f"{project_path_source.rstrip('/')}/{SYNC_IGNORE_CONFIG['file']}"
+        ssh_client = SSH_POOL.acquire('server101')
+        try:
+            with SSH_POOL.open_sftp(ssh_client).open(ignore_path, 'r') as f:
+                patterns.extend(f.read().decode('utf-8', errors='replace').splitlines())
+        except IOError as e:
+            # 没有 .syncignore 是常态；无权读取时用 sudo cat
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                success, stdout, stderr = execute_ssh_command(
+                    ssh_client, f'cat {shlex.quote(ignore_path)}', use_sudo=True
+                )
+                if success:
+                    patterns.extend(stdout.splitlines())
+                else:
+                    logger.warning(f"读取 {ignore_path} 失败，忽略该文件: {stderr}")
+        finally:
+            SSH_POOL.release(ssh_client)
+    patterns.extend(extra_patterns or [])
+    return SyncIgnore(patterns)
+
+
+def copy_files_remote_to_remote(source_host, source_port, source_user, source_password, source_root,
+                                target_host, target_port, target_user, target_password, target_root,
+                                files, transport='sftp', channels=None, direct=False, copy_func=None):
+    """
+    把源目录下的指定文件复制到目标目录下相同的相对路径（增量同步与按变化归档共用）
+
+    direct=True 时先尝试由源节点直接推送，失败时回退到 transport 方式：'tar' 把所有文件打成一个 tar 流，
+    'sftp' 多通道并行逐文件复制（此时目标端的上级目录需已存在）。
+
+    Args:
+        source_*/target_*: 同 copy_folder_remote_to_remote，source_root/target_root 为两端的根目录
+        files: {相对路径: 文件大小}
+        transport: 'sftp' / 'tar'
+        channels: sftp 方式的并行通道数，None 时按 PARALLEL_TRANSFER_CONFIG 配置
+        direct: 是否优先由源节点直接推送到目标节点
+        copy_func: sftp 方式的单文件复制函数，签名同 sftp_copy_file_data 的前四个参数
+
+    Returns:
+        tuple: (传输的文件数, 传输的字节数)；有文件传输失败时抛出 IOError
+    """
+    rel_files = list(files)
+    if not rel_files:
+        return 0, 0
+
+    if direct or transport == 'tar':
+        ssh_source = SSH_POOL.acquire_for(source_host, source_port, source_user, source_password)
+        ssh_target = None
+        try:
+            ssh_target = SSH_POOL.acquire_for(target_host, target_port, target_user, target_password)
+            if direct:
+                path = probe_direct_path(ssh_source, source_host, source_port, source_user, source_password,
+                                         target_host, target_port, target_user, target_password)
+                if path:
+                    pushed, push_message = direct_push_remote_to_remote(
+                        ssh_source, source_root, target_host, target_port, target_user, target_password,
+                        target_root, path, file_list=rel_files
+                    )
+                    logger.info(f"[copy_files_remote_to_remote] {push_message}")
+                    if pushed:
+                        return len(rel_files), sum(files.values())
+                logger.info(f"[copy_files_remote_to_remote] 节点间无法直连，回退到经 server103 中转（{transport}）")
+
+            if transport == 'tar':
+                logger.info(f"[copy_files_remote_to_remote] 以 tar 流传输 {len(rel_files)} 个文件")
+                tar_stream_remote_to_remote(ssh_source, source_root, ssh_target, target_root, file_list=rel_files)
+                return len(rel_files), sum(files.values())
+        finally:
+            SSH_POOL.release(ssh_source)
+            SSH_POOL.release(ssh_target)
+
+    logger.info(f"[copy_files_remote_to_remote] 以多通道 SFTP 传输 {len(rel_files)} 个文件")
+    results = parallel_sftp_copy(
+        source_host, source_port, source_user, source_password,
+        target_host, target_port, target_user, target_password,
+        [(f"{source_root}/{rel}", f"{target_root}/{rel}") for rel in rel_files],
+        channels=channels, copy_func=copy_func
+    )
+    failed = [r for r in results if not r['success']]
+    if failed:
+        raise IOError(
+            f"{len(failed)}/{len(results)} 个文件传输失败，首个错误: "
+            f"{failed[0]['source']}: {failed[0]['message']}"
+        )
+    return len(results), sum(r['bytes'] for r in results)
+
+
+def sync_folder_remote_to_remote(source_host, source_port, source_user, source_password, source_path,
+                                 target_host, target_port, target_user, target_password, target_path,
+                                 checksum=False, transport='sftp', channels=None, direct=False, ignore=None):
+    """
+    增量同步目录（远程到远程）：比较两端清单，只传输新增/变化的文件，只删除源端已不存在的文件
+
+    比较规则：大小不同 -> 传输；checksum=True 时比较 sha256，否则比较修改时间（秒）。
+    新文件先写到同目录临时文件再原子 rename，传输后把目标文件的 mtime/权限设置为与源一致，
+    下次同步即可直接跳过。
+
+    Args:
+        source_*/target_*: 同 copy_folder_remote_to_remote
+        checksum: 是否用 sha256 判断文件是否变化
+        transport: 'sftp' 多通道并行逐文件传输；'tar' 把所有需要传输的文件打成一个 tar 流传输
+        channels: sftp 方式的并行通道数，None 时按 PARALLEL_TRANSFER_CONFIG 配置
+        direct: 为 True 时先尝试由源节点直接把变化的文件推送到目标节点，失败时回退到 transport 方式
+        ignore: SyncIgnore，被忽略的源文件不传输，目标端已有的被忽略条目视为源端已删除而清理掉
+
+    Returns:
+        tuple: (success: bool, message: str, stats: dict)
+    """
+    ssh_source = None
+    ssh_target = None
+    stats = {
+        'files_sent': 0,
+        'bytes_sent': 0,
+        'files_skipped': 0,
+        'bytes_skipped': 0,
+        'files_deleted': 0,
+        'dirs_created': 0,
+        'dirs_deleted': 0,
+        'files_ignored': 0,
+        'bytes_ignored': 0,
+        'elapsed': 0.0
+    }
+    started = time.time()
+
+    try:
+        logger.info(
+            f"[sync_folder_remote_to_remote] 开始增量同步: "
+            f"{source_user}@{source_host}:{source_port}{source_path} -> "
+            f"{target_user}@{target_host}:{target_port}{target_path} (checksum={checksum})"
+        )
+        ssh_source = SSH_POOL.acquire_for(source_host, source_port, source_user, source_password)
+        ssh_target = SSH_POOL.acquire_for(target_host, target_port, target_user, target_password)
+        sftp_target = SSH_POOL.open_sftp(ssh_target)
+
+        source_path_clean = source_path.rstrip('/')
+        target_path_clean = target_path.rstrip('/')
+
+        # 有忽略规则时先过滤再计算哈希，被忽略的文件不读取
+        src_manifest = build_remote_manifest(ssh_source, source_path_clean, with_hash=checksum and not ignore)
+        if src_manifest is None:
+            return False, f"源目录不存在: {source_host}:{source_path_clean}", stats
+        if ignore:
+            src_manifest, stats['files_ignored'], stats['bytes_ignored'] = ignore.filter_manifest(src_manifest)
+            if checksum:
+                hash_remote_manifest(ssh_source, source_path_clean, src_manifest, only_listed=True)
+        dst_manifest = build_remote_manifest(ssh_target, target_path_clean, with_hash=checksum) or {}
+
+        def remove_target(rel, entry):
+            full = f"{target_path_clean}/{rel}"
+            try:
+                if entry['type'] == 'd':
+                    sftp_target.rmdir(full)
+                    stats['dirs_deleted'] += 1
+                else:
+                    sftp_target.remove(full)
+                    stats['files_deleted'] += 1
+            except IOError:
+                # SFTP 删除失败（如权限不足），退回 sudo rm
+                ok, _, err = execute_ssh_command(ssh_target, f'rm -rf "{full}"', use_sudo=True)
+                if not ok:
+                    raise IOError(f"删除目标文件失败 {full}: {err}")
+                if entry['type'] == 'd':
+                    stats['dirs_deleted'] += 1
+                else:
+                    stats['files_deleted'] += 1
+
+        # 1. 删除源端已不存在的条目，以及类型发生变化（文件 <-> 目录）的条目；深层路径先删
+        for rel in sorted(dst_manifest, key=lambda r: r.count('/'), reverse=True):
+            src_entry = src_manifest.get(rel)
+            if src_entry is None or src_entry['type'] != dst_manifest[rel]['type']:
+                remove_target(rel, dst_manifest[rel])
+                dst_manifest.pop(rel)
+
+        # 2. 创建缺失的目录（浅层先建）
+        sftp_mkdir_p(sftp_target, target_path_clean)
+        for rel in sorted((r for r, e in src_manifest.items() if e['type'] == 'd'), key=lambda r: r.count('/')):
+            if rel not in dst_manifest:
+                sftp_mkdir_p(sftp_target, f"{target_path_clean}/{rel}")
+                stats['dirs_created'] += 1
+
+        # 3. 找出新增/变化的文件
+        to_send = []
+        for rel, src_entry in src_manifest.items():
+            if src_entry['type'] != 'f':
+                continue
+            dst_entry = dst_manifest.get(rel)
+            if dst_entry is not None and dst_entry['size'] == src_entry['size']:
+                if checksum and src_entry['hash'] and src_entry['hash'] == dst_entry['hash']:
+                    unchanged = True
+                elif not checksum and dst_entry['mtime'] == src_entry['mtime']:
+                    unchanged = True
+                else:
+                    unchanged = False
+                if unchanged:
+                    stats['files_skipped'] += 1
+                    stats['bytes_skipped'] += src_entry['size']
+                    continue
+            to_send.append(rel)
+
+        # 4. 传输
+        def copy_to_temp_and_rename(src_sftp, src_item, dst_sftp, dst_item):
+            """写到同目录临时文件，设置 mtime/权限后原子替换目标文件"""
+            src_entry = src_manifest[src_item[len(source_path_clean) + 1:]]
+            dst_dir, dst_name = dst_item.rsplit('/', 1)
+            tmp_item = f"{dst_dir}/.{dst_name}.synctmp"
+            copied = sftp_copy_file_data(src_sftp, src_item, dst_sftp, tmp_item)
+            dst_sftp.chmod(tmp_item, src_entry['mode'] & 0o7777)
+            dst_sftp.utime(tmp_item, (src_entry['mtime'], src_entry['mtime']))
+            try:
+                dst_sftp.posix_rename(tmp_item, dst_item)
+            except IOError:
+                # 服务端不支持 posix-rename 扩展时，先删后改名
+                try:
+                    dst_sftp.remove(dst_item)
+                except IOError:
+                    pass
+                dst_sftp.rename(tmp_item, dst_item)
+            return copied
+
+        if to_send:
+            stats['files_sent'], stats['bytes_sent'] = copy_files_remote_to_remote(
+                source_host, source_port, source_user, source_password, source_path_clean,
+                target_host, target_port, target_user, target_password, target_path_clean,
+                {rel: src_manifest[rel]['size'] for rel in to_send},
+                transport=transport, channels=channels, direct=direct, copy_func=copy_to_temp_and_rename
+            )
+
+        stats['elapsed'] = round(time.time() - started, 3)
+        message = (
+            f"增量同步完成: {source_host}:{source_path} -> {target_host}:{target_path}，"
+            f"传输 {stats['files_sent']} 个文件（{stats['bytes_sent']} 字节），"
+            f"跳过 {stats['files_skipped']} 个未变化文件（{stats['bytes_skipped']} 字节），"
+            f"删除 {stats['files_deleted']} 个文件，按忽略规则跳过 {stats['files_ignored']} 个文件"
+            f"（{stats['bytes_ignored']} 字节），耗时 {stats['elapsed']}s"
+        )
+        logger.info(f"[sync_folder_remote_to_remote] {message}")
+        return True, message, stats
+
+    except paramiko.AuthenticationException:
+        return False, "SSH认证失败: 用户名或密码错误", stats
+    except paramiko.SSHException as e:
+        return False, f"SSH连接错误: {str(e)}", stats
+    except Exception as e:
+        logger.error(f"增量同步过程出错: {str(e)}", exc_info=True)
+        return False, f"增量同步过程出错: {str(e)}", stats
+
+    finally:
+        SSH_POOL.release(ssh_source)
+        SSH_POOL.release(ssh_target)
+
+
+def sync_project_to_server102(project_path_source, project_path, sync_mode='delta', checksum=False,
+                              transport='sftp', direct=False, ignore=None):
+    """
+    执行前把项目从 server101 同步到 server102
+
+    Args:
+        project_path_source: server101 上的项目目录
+        project_path: server102 上的项目目录
+        sync_mode: 'delta' 增量同步（默认）；'full' 清空后全量复制（旧行为）
+        checksum: 增量同步时是否用 sha256 判断文件变化
+        transport: 'sftp' 逐文件传输 / 'tar' tar 流传输
+        direct: 是否优先由 server101 直接推送到 server102（不可直连时回退到 transport 方式）
+        ignore: SyncIgnore（见 load_sync_ignore），被忽略的文件不传输，server102 副本中已有的也会被删除
+
+    Returns:
+        tuple: (success: bool, message: str, stats: dict | None)
+    """
+    with get_project_sync_lock(project_path):
+        try:
+            return _sync_project_to_server102(project_path_source, project_path, sync_mode, checksum,
+                                              transport, direct, ignore)
+        finally:
+            METADATA_CACHE.invalidate('server102', project_path)
+
+
+def _sync_project_to_server102(project_path_source, project_path, sync_mode, checksum, transport, direct,
+                               ignore):
+    server101_config = SERVER_CONFIG['server101']
+    server102_config = SERVER_CONFIG['server102']
+    if sync_mode == 'full':
+        success, message = copy_folder_remote_to_remote(
+            server101_config['host'],
+            server101_config['port'],
+            server101_config['user'],
+            server101_config['password'],
+            project_path_source,
+            server102_config['host'],
+            server102_config['port'],
+            server102_config['user'],
+            server102_config['password'],
+            project_path,
+            transport=transport,
+            direct=direct,
+            ignore=ignore
+        )
+        return success, message, None
+    return sync_folder_remote_to_remote(
+        server101_config['host'],
+        server101_config['port'],
+        server101_config['user'],
+        server101_config['password'],
+        project_path_source,
+        server102_config['host'],
+        server102_config['port'],
+        server102_config['user'],
+        server102_config['password'],
+        project_path,
+        checksum=checksum,
+        transport=transport,
+        direct=direct,
+        ignore=ignore
+    )
+
+
+def fail_job(job_id, error):
+    """把任务标记为失败（job_id 为 None 时忽略）"""
+    if job_id:
+        JOB_REGISTRY.set_status(job_id, 'failed', error=error)
+
+
+def refresh_background_job(job, ssh_client=None):
+    """
+    刷新后台任务的状态：进程已退出时读取运行目录旁的退出码文件（{run_dir}.exitcode），
+    更新为 completed / failed
+
+    Args:
+        job: JOB_REGISTRY 中的任务记录
+        ssh_client: 执行节点的 SSH 客户端（None 时从连接池借用）
+
+    Returns:
+        dict: 最新的任务记录
+    """
+    if job['mode'] != 'background' or job['status'] != 'running' or not job['pid']:
+        return job
+    borrowed = ssh_client is None
+    if borrowed:
+        ssh_client = SSH_POOL.acquire(job['node'])
+    try:
+        exit_file = shlex.quote(f"{job['run_dir']}.exitcode")
+        check_cmd = (
+            f"ps -p {int(job['pid'])} > /dev/null 2>&1 && echo running || "
+            f"cat {exit_file} 2>/dev/null || echo unknown"
+        )
+        ok, out, err = execute_ssh_command(ssh_client, check_cmd, use_sudo=False)
+        state = out.strip()
+        if not ok or state == 'running':
+            return job
+        if state.lstrip('-').isdigit():
+            exit_code = int(state)
+            JOB_REGISTRY.set_status(
+                job['job_id'], 'completed' if exit_code == 0 else 'failed',
+                exit_code=exit_code, run_finished_at=JOB_REGISTRY._now(),
+                error=None if exit_code == 0 else f'命令退出码: {exit_code}'
+            )
+        else:
+            JOB_REGISTRY.set_status(job['job_id'], 'failed', run_finished_at=JOB_REGISTRY._now(),
+                                    error='进程已退出，但未找到退出码（可能被强制终止）')
+    finally:
+        if borrowed:
+            SSH_POOL.release(ssh_client)
+    return JOB_REGISTRY.get(job['job_id'])
+
+
+def recover_jobs():
+    """
+    server103 启动时恢复未结束任务的状态
+
+    - 后台任务（nohup 运行在 server102 上，不依赖 server103 进程）：检查进程与退出码并更新状态；
+    - 其余任务由 server103 线程驱动，重启后已中断，标记为 lost。
+    """
+    for job in JOB_REGISTRY.unfinished():
+        if job['mode'] == 'background' and job['status'] == 'running' and job['pid']:
+            try:
+                refresh_background_job(job)
+            except Exception as e:
+                logger.warning(f"[recover_jobs] 刷新后台任务 {job['job_id']} 状态失败: {str(e)}")
+        else:
+            JOB_REGISTRY.set_status(job['job_id'], 'lost', error='server103 重启，任务已中断')
+            logger.info(f"[recover_jobs] 任务 {job['job_id']} 在 server103 重启前未完成，已标记为 lost")
+
+
+_PROJECT_SYNC_LOCKS = {}  # server102 上的共享项目目录 -> threading.RLock
+_PROJECT_SYNC_LOCKS_GUARD = threading.Lock()
+
+
+def get_project_sync_lock(project_path):
+    """
+    同一个共享项目目录的同步需要串行（并发同步会互相覆盖临时文件）；
+    执行接口在持有该锁期间完成「同步 + 创建运行目录」，保证运行目录取到的是完整的一次同步结果
+    """
+    with _PROJECT_SYNC_LOCKS_GUARD:
+        lock = _PROJECT_SYNC_LOCKS.get(project_path)
+        if lock is None:
+            lock = _PROJECT_SYNC_LOCKS[project_path] = threading.RLock()
+        return lock
+
+
+def build_pip_install_cmd(env_path, use_cache=True):
+    """
+    构建在运行目录中安装 requirements.txt 的 shell 片段（需在激活虚拟环境之后执行）
+
+    缓存键为 sha256(requirements.txt + 环境的 pyvenv.cfg + 环境路径 + 索引地址)。安装成功后把
+    "缓存键 安装耗时(毫秒)" 写入环境中的标记文件；下次缓存键一致时跳过 pip install。
+    片段会输出一行 "__REQUIREMENTS_CACHE__ hit|miss|shared|failed 毫秒"（hit 时为上次安装耗时，即本次节省的时间），
+    由 parse_requirements_cache 解析。安装失败时片段以非零状态结束，没有 requirements.txt 时不输出。
+
+    环境解析到共享环境存储（ENV_STORE_CONFIG['root']，只读）时不安装也不写标记文件：离线
+    pip install --dry-run 确认 requirements.txt 已被满足则输出 shared，否则在 stderr 说明原因并以失败结束。
+
+    Args:
+        env_path: 虚拟环境目录
+        use_cache: 为 False 时总是安装（仍会更新标记文件）
+    """
+    config = PIP_INSTALL_CONFIG
+    marker = f'{env_path}/{config["marker_file"]}'
+    pip_install = (
+        f'pip install -r requirements.txt --index-url {config["index_url"]} --trusted-host {config["trusted_host"]}'
+    )
+    cache_check = (
+        f'[ "$(cut -d" " -f1 "{marker}" 2>/dev/null)" = "$req_key" ]' if use_cache else 'false'
+    )
+    store_root = shlex.quote(ENV_STORE_CONFIG['root'].rstrip('/'))
+    shared_check = (
+        f'if req_out=$(pip install --dry-run --no-index --quiet -r requirements.txt 2>&1); then '
+        f'echo "{REQUIREMENTS_CACHE_TAG} shared"; '
+        f'else echo "$req_out" | tail -n 5 >&2; '
+        f'echo "共享环境为只读，不满足 requirements.txt 中的依赖，请用新的 requirements 创建环境" >&2; '
+        f'echo "{REQUIREMENTS_CACHE_TAG} failed"; false; fi'
+    )
+    return (
+        f'if [ -f "requirements.txt" ]; then '
+        f'req_store=$(readlink -f {store_root} 2>/dev/null); '
+        f'case "$(readlink -f "{env_path}")/" in "${{req_store:-/nonexistent}}"/*) {shared_check};; *) '
+        f'req_key=$({{ cat requirements.txt "{env_path}/pyvenv.cfg" 2>/dev/null; '
+        f'echo "{env_path} {config["index_url"]}"; }} | sha256sum | cut -c1-64); '
+        f'if {cache_check}; then '
+        f'echo "{REQUIREMENTS_CACHE_TAG} hit $(cut -d" " -f2 "{marker}")"; '
+        f'else req_start=$(date +%s%N); '
+        f'if {pip_install}; then '
+        f'req_ms=$(( ($(date +%s%N) - req_start) / 1000000 )); '
+        f'echo "$req_key $req_ms" > "{marker}" 2>/dev/null; '
+        f'echo "{REQUIREMENTS_CACHE_TAG} miss $req_ms"; '
+        f'else echo "{REQUIREMENTS_CACHE_TAG} failed"; false; fi; '
+        f'fi;; '
+        f'esac; '
+        f'fi'
+    )
+
+
+def parse_requirements_cache(output):
+    """
+    从命令输出中解析依赖安装缓存的结果
+
+    Returns:
+        dict: status（hit / miss / shared 共享环境已满足，未安装 / failed 安装失败 / none 没有 requirements.txt）、
+              install_seconds（miss 时本次安装耗时）、saved_seconds（hit 时节省的时间，即上次安装耗时）
+    """
+    result = {'status': 'none', 'install_seconds': None, 'saved_seconds': None}
+    for line in output.splitlines():
+        if line.startswith(REQUIREMENTS_CACHE_TAG):
+            parts = line.split()
+            result['status'] = parts[1] if len(parts) > 1 else 'miss'
+            seconds = int(parts[2]) / 1000 if len(parts) > 2 and parts[2].isdigit() else None
+            if result['status'] == 'miss':
+                result['install_seconds'] = seconds
+            elif result['status'] == 'hit':
+                result['saved_seconds'] = seconds
+    return result
+
+
+def new_run_id():
+    """生成运行ID（例如 run_20251222_101517_3fa2c1），同一秒内的多次运行也不会重名"""
+    return f'run_{datetime.now().strftime("%Y%m%d_%H%M%S")}_{uuid.uuid4().hex[:6]}'
+
+
+def get_run_workdir(username, projectname, run_id):
+    """server102 上某次运行的独立工作目录"""
+    root = RUN_WORKDIR_CONFIG['root'].format(username=username, projectname=projectname)
+    return f'{root}/{run_id}'
+
+
+def create_run_workdir(ssh_client, project_path, run_dir):
+    """
+    在 server102 上从共享项目副本创建本次运行的工作目录
+
+    依次尝试 reflink（写时复制，完全独立）、普通复制，运行目录与共享副本及其他运行互不影响。
+    RUN_WORKDIR_CONFIG['allow_hardlink'] 开启时在两者之间再尝试硬链接（不复制数据，
+    RUN_WORKDIR_CONFIG['private_dirs'] 中的目录仍完整复制）：此时运行目录与共享副本共用文件内容，
+    程序只能新建/整体替换文件，不能原地改写项目中的已有文件。增量同步以「临时文件 + rename」替换文件，
+    不会改动已链接出去的文件。
+
+    Args:
+        ssh_client: server102 的 SSH 客户端
+        project_path: 共享项目副本目录
+        run_dir: 运行目录（已存在则先删除）
+
+    Returns:
+        tuple: (success: bool, method: str | None, message: str)，method 为 reflink / hardlink / copy
+    """
+    src = shlex.quote(project_path)
+    dst = shlex.quote(run_dir)
+    private_copy = ''.join(
+        f'if [ -d {src}/{shlex.quote(d)} ]; then rm -rf {dst}/{shlex.quote(d)} && '
+        f'cp -a {src}/{shlex.quote(d)} {dst}/{shlex.quote(d)}; fi; '
+        for d in RUN_WORKDIR_CONFIG['private_dirs']
+    )
+    hardlink = (
+        f'elif rm -rf {dst} && cp -al {src} {dst} 2>/dev/null; then {private_copy}echo hardlink; '
+        if RUN_WORKDIR_CONFIG['allow_hardlink'] else ''
+    )
+    command = (
+        f'mkdir -p {shlex.quote(os.path.dirname(run_dir))} && rm -rf {dst} && '
+        f'if cp -a --reflink=always {src} {dst} 2>/dev/null; then echo reflink; '
+        f'{hardlink}'
+        f'else rm -rf {dst} && cp -a {src} {dst} && echo copy; fi'
+    )
+    started = time.time()
+    ok, out, err = execute_ssh_command(ssh_client, command, use_sudo=False)
+    method = out.strip().splitlines()[-1] if ok and out.strip() else None
+    if not ok or method not in ('reflink', 'hardlink', 'copy'):
+        return False, None, f'创建运行目录失败: {(err or out).strip()}'
+    METADATA_CACHE.invalidate('server102', run_dir)
+    message = f'运行目录已创建（{method}，耗时 {time.time() - started:.3f}s）: {run_dir}'
+    logger.info(f"[create_run_workdir] {message}")
+    return True, method, message
+
+
+def venv_relocate_cmd(env_path, old_path):
+    """
+    生成把虚拟环境中的 old_path 改写为 env_path 的 shell 片段（以 " && " 结尾，rewrite_paths 关闭时为空）
+
+    改写范围为 ENV_CLONE_CONFIG['mutable_files'] 与引用 old_path 的 bin/ 脚本；sed -i 会写出新文件，
+    不会改动与其他环境共用的硬链接。
+    """
+    if not ENV_CLONE_CONFIG['rewrite_paths']:
+        return ''
+    dst = shlex.quote(env_path)
+    mutable = ' '.join(ENV_CLONE_CONFIG['mutable_files'])
+    old_pattern = shlex.quote(old_path.replace('|', '\\|'))
+    return (
+        f'(cd {dst} && for f in {mutable} $(grep -lIs -F -- {shlex.quote(old_path)} bin/* 2>/dev/null); do '
+        f'if [ -f "$f" ] && [ ! -L "$f" ]; then sed -i "s|"{old_pattern}"|"{dst}"|g" "$f" || exit 1; fi; '
+        f'done) && '
+    )
+
+
+def clone_base_venv(ssh_client, env_path, clone_mode='auto'):
+    """
+    在 server102 上从基线虚拟环境克隆出新环境（以 sudo 执行，env_path 须为空目录或不存在）
+
+    auto 方式依次尝试 reflink（写时复制）、硬链接（site-packages 等文件与基线共用，不占额外空间）、普通复制。
+    硬链接方式下 ENV_CLONE_CONFIG['mutable_files'] 以及包含基线路径的 bin/ 脚本会被替换为独立副本，
+    之后再改写其中的基线路径，不会影响基线环境。pip 安装/卸载包时新建或删除文件，不会改写共用的文件。
+
+    Args:
+        ssh_client: server102 的 SSH 客户端
+        env_path: 新环境目录
+        clone_mode: auto / copy
+
+    Returns:
+        tuple: (success: bool, method: str | None, message: str)，method 为 reflink / hardlink / copy
+    """
+    base = ENV_CLONE_CONFIG['base_venv_path']
+    src = shlex.quote(base)
+    dst = shlex.quote(env_path)
+    mutable = ' '.join(ENV_CLONE_CONFIG['mutable_files'])
+    # 把可能被改写的文件替换为独立副本（cp + mv，与基线断开硬链接）
+    private_copy = (
+        f'(cd {dst} && for f in {mutable} $(grep -lIs -F -- {src} bin/* 2>/dev/null); do '
+        f'if [ -f "$f" ] && [ ! -L "$f" ]; then cp -p "$f" "$f.clone_tmp" && mv -f "$f.clone_tmp" "$f" || exit 1; fi; '
+        f'done) && '
+    )
+    command = (
+        f'mkdir -p {dst} && '
+        + (
+            f'if cp -a --reflink=always {src}/. {dst}/ 2>/dev/null; then method=reflink; '
+            f'elif rm -rf {dst} && mkdir -p {dst} && cp -al {src}/. {dst}/ 2>/dev/null && {private_copy}true; then method=hardlink; '
+            f'else rm -rf {dst} && mkdir -p {dst} && cp -a {src}/. {dst}/ && method=copy; fi'
+            if clone_mode == 'auto' else
+            f'cp -a {src}/. {dst}/ && method=copy'
+        )
+        + f' && {venv_relocate_cmd(env_path, base)}echo $method'
+    )
+    started = time.time()
+    # sudo 只作用于紧随其后的单条命令，整段脚本交给 bash -c 执行
+    ok, out, err = execute_ssh_command(ssh_client, f'bash -c {shlex.quote(command)}', use_sudo=True)
+    method = out.strip().splitlines()[-1] if ok and out.strip() else None
+    if not ok or method not in ('reflink', 'hardlink', 'copy'):
+        return False, None, f'克隆基线虚拟环境失败: {(err or out).strip()}'
+    message = f'虚拟环境已从基线克隆（{method}，耗时 {time.time() - started:.3f}s）: {env_path}'
+    logger.info(f"[clone_base_venv] {message}")
+    return True, method, message
+
+
+def base_venv_fingerprint_cmd():
+    """输出基线虚拟环境指纹（pyvenv.cfg 与 site-packages 目录修改时间的摘要，12 位）的 shell 命令，基线更新后指纹随之变化"""
+    base = shlex.quote(ENV_CLONE_CONFIG['base_venv_path'])
+    return f'stat -c "%Y %n" {base}/pyvenv.cfg {base}/lib/*/site-packages 2>/dev/null | md5sum | cut -c1-12'
+
+
+class EnvPool:
+    """
+    预热虚拟环境池：后台线程在 server102 上预先从基线环境克隆出 size 个环境，/env/create 直接把其中一个
+    rename 到用户的环境目录，不必等待克隆
+
+    - 克隆中的环境位于 {root}/building/{name}，克隆完成后 rename 到 {root}/ready/{name}；
+    - name 为「基线指纹-随机ID」，基线指纹由基线环境 pyvenv.cfg 与 site-packages 目录的修改时间计算，
+      基线更新后旧的预热环境在取用或补充时作废删除；
+    - 取走一个环境后立即唤醒后台线程补充；server103 重启时按 ready/ 恢复池，building/ 中的半成品删除。
+    """
+
+    def __init__(self, server, root, size, retry_interval):
+        self.server = server
+        self.root = root
+        self.size = size
+        self.retry_interval = retry_interval
+        self.error = None        # 最近一次补充失败的原因
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._ready = []         # 就绪环境名，先进先出
+        self._building = 0
+        self._taken = 0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.size > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='env-pool', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run_remote(self, ssh_client, command):
+        return execute_ssh_command(ssh_client, f'bash -c {shlex.quote(command)}', use_sudo=True)
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            ssh_client = None
+            try:
+                ssh_client = SSH_POOL.acquire(self.server)
+                self._refill(ssh_client)
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+                logger.warning(f"[env_pool] 补充预热环境失败: {str(e)}")
+            finally:
+                SSH_POOL.release(ssh_client)
+            self._wake.wait(self.retry_interval)
+
+    def _refill(self, ssh_client):
+        root = shlex.quote(self.root)
+        # 恢复/校验池：删除半成品，列出就绪环境，并取得当前基线指纹
+        command = f'mkdir -p {root}/ready {root}/building && '
+        if not self.loaded:
+            command += f'rm -rf {root}/building/* && '
+        command += f'{base_venv_fingerprint_cmd()} && ls -1 {root}/ready'
+        ok, out, err = self._run_remote(ssh_client, command)
+        if not ok:
+            raise RuntimeError(f'读取环境池失败: {(err or out).strip()}')
+        lines = out.strip().splitlines()
+        fingerprint, names = lines[0], lines[1:]
+        with self._lock:
+            if not self.loaded:
+                self._ready = list(names)
+                self.loaded = True
+            stale = [n for n in self._ready if not n.startswith(f'{fingerprint}-')]
+            self._ready = [n for n in self._ready if n not in stale]
+        if stale:
+            logger.info(f"[env_pool] 基线环境已更新，删除旧的预热环境: {stale}")
+            self._run_remote(ssh_client, 'rm -rf ' + ' '.join(shlex.quote(f'{self.root}/ready/{n}') for n in stale))
+
+        while True:
+            with self._lock:
+                if len(self._ready) + self._building >= self.size:
+                    return
+                self._building += 1
+            name = f'{fingerprint}-{uuid.uuid4().hex[:8]}'
+            building_path = f'{self.root}/building/{name}'
+            try:
+                ok, method, message = clone_base_venv(ssh_client, building_path)
+                if not ok:
+                    self._run_remote(ssh_client, f'rm -rf {shlex.quote(building_path)}')
+                    raise RuntimeError(message)
+                ok, out, err = self._run_remote(
+                    ssh_client, f'mv -T {shlex.quote(building_path)} {shlex.quote(f"{self.root}/ready/{name}")}'
+                )
+                if not ok:
+                    raise RuntimeError(f'移动预热环境失败: {(err or out).strip()}')
+                with self._lock:
+                    self._ready.append(name)
+                logger.info(f"[env_pool] 预热环境就绪（{method}）: {name}")
+            finally:
+                with self._lock:
+                    self._building -= 1
+
+    def take(self, ssh_client, env_path):
+        """
+        从池中取出一个就绪环境，rename 为 env_path（不存在或为空目录）并改写其中的路径
+
+        Returns:
+            tuple: (success: bool, message: str)，池为空或取用失败时 success 为 False，调用方应退回直接克隆
+        """
+        while True:
+            with self._lock:
+                if not self._ready:
+                    break
+                name = self._ready.pop(0)
+            self._wake.set()
+            ready_path = shlex.quote(f'{self.root}/ready/{name}')
+            dst = shlex.quote(env_path)
+            fingerprint = name.split('-', 1)[0]
+            # 克隆时环境中的路径指向 building/{name}，rename 后改写为用户环境路径
+            command = (
+                f'if [ "$({base_venv_fingerprint_cmd()})" != {shlex.quote(fingerprint)} ]; then '
+                f'rm -rf {ready_path}; echo stale; '
+                f'else mv -T {ready_path} {dst} || exit 1; '
+                f'if {venv_relocate_cmd(env_path, f"{self.root}/building/{name}")}true; then echo ok; '
+                f'else rm -rf {dst}; echo failed; fi; fi'
+            )
+            started = time.time()
+            ok, out, err = self._run_remote(ssh_client, command)
+            result = out.strip().splitlines()[-1] if ok and out.strip() else ''
+            if result == 'ok':
+                with self._lock:
+                    self._taken += 1
+                message = f'虚拟环境已从环境池取出（耗时 {time.time() - started:.3f}s）: {env_path}'
+                logger.info(f"[env_pool] {message}")
+                return True, message
+            logger.warning(f"[env_pool] 预热环境 {name} 不可用（{result or (err or out).strip()}），尝试下一个")
+        return False, '环境池中没有可用的预热环境'
+
+    def stats(self):
+        """返回环境池状态"""
+        with self._lock:
+            return {
+                'size': self.size,
+                'ready': len(self._ready),
+                'building': self._building,
+                'taken': self._taken,
+                'loaded': self.loaded,
+                'error': self.error,
+            }
+
+
+ENV_POOL = EnvPool('server102', **ENV_POOL_CONFIG)
+
+
+_SHARED_ENV_LOCKS = {}  # 共享环境哈希 -> threading.Lock，同一依赖集合只构建一次
+_SHARED_ENV_LOCKS_GUARD = threading.Lock()
+
+
+def get_shared_env_path(env_key):
+    """server102 上的共享虚拟环境目录"""
+    return f'{ENV_STORE_CONFIG["root"]}/{env_key}'
+
+
+def resolve_requirements(ssh_client, requirements_text):
+    """
+    在基线虚拟环境中解析依赖（pip install --dry-run --ignore-installed --report -），得到完整的「包名==版本」集合
+
+    Args:
+        ssh_client: server102 的 SSH 客户端
+        requirements_text: requirements.txt 的内容
+
+    Returns:
+        tuple: (success: bool, env_key: str | None, pins: list | str)；
+               env_key 为 sha256(基线指纹 + 排序后的包名==版本)，失败时 pins 为错误信息
+    """
+    config = PIP_INSTALL_CONFIG
+    req_file = f'/tmp/envstore_{uuid.uuid4().hex}.txt'
+    with SSH_POOL.open_sftp(ssh_client).open(req_file, 'w') as f:
+        f.write(requirements_text)
+    base = shlex.quote(ENV_CLONE_CONFIG['base_venv_path'])
+    command = (
+        f'{base_venv_fingerprint_cmd()}; '
+        f'source {base}/bin/activate && '
+        f'pip install --dry-run --ignore-installed --quiet --report - -r {shlex.quote(req_file)} '
+        f'--index-url {config["index_url"]} --trusted-host {config["trusted_host"]}; '
+        f'rc=$?; rm -f {shlex.quote(req_file)}; exit $rc'
+    )
+    ok, out, err = execute_ssh_command(ssh_client, command, use_sudo=False)
+    fingerprint, _, report_text = out.partition('\n')
+    if not ok:
+        return False, None, f'解析依赖失败: {(err or report_text).strip()[-2000:]}'
+    try:
+        report = json.loads(report_text)
+    except ValueError:
+        return False, None, f'解析依赖失败，pip 未输出安装报告（需要 pip >= 22.2）: {report_text.strip()[-500:]}'
+    pins = sorted({
+        f"{item['metadata']['name'].lower().replace('_', '-').replace('.', '-')}=={item['metadata']['version']}"
+        for item in report.get('install', [])
+    })
+    env_key = hashlib.sha256('\n'.join([fingerprint.strip()] + pins).encode('utf-8')).hexdigest()
+    return True, env_key, pins
+
+
+def ensure_shared_env(ssh_client, requirements_text):
+    """
+    取得与 requirements 解析结果对应的共享虚拟环境，不存在时构建
+
+    构建过程：从基线克隆到 {root}/.building/{hash}，按解析结果 pip install --no-deps 安装，
+    rename 到 {root}/{hash} 并改写路径，最后设为只读（目录与独有文件）。
+
+    Returns:
+        tuple: (success: bool, info: dict | None, message: str)，
+               info 包含 env_key、path、built（本次是否新构建）、packages（包数量）
+    """
+    ok, env_key, pins = resolve_requirements(ssh_client, requirements_text)
+    if not ok:
+        return False, None, pins
+    shared_path = get_shared_env_path(env_key)
+    info = {'env_key': env_key, 'path': shared_path, 'built': False, 'packages': len(pins)}
+    with _SHARED_ENV_LOCKS_GUARD:
+        lock = _SHARED_ENV_LOCKS.setdefault(env_key, threading.Lock())
+    with lock:
+        exists, _, _ = execute_ssh_command(ssh_client, f'test -f {shlex.quote(shared_path)}/bin/activate', use_sudo=False)
+        if exists:
+            return True, info, f'使用已有共享环境: {shared_path}'
+
+        started = time.time()
+        building_path = f'{ENV_STORE_CONFIG["root"]}/.building/{env_key}'
+        building = shlex.quote(building_path)
+        execute_ssh_command(ssh_client, f'rm -rf {building}', use_sudo=True)
+        ok, method, message = clone_base_venv(ssh_client, building_path)
+        if not ok:
+            return False, None, message
+        config = PIP_INSTALL_CONFIG
+        resolved = shlex.quote(f'{building_path}/{ENV_STORE_CONFIG["resolved_file"]}')
+        pin_args = ' '.join(shlex.quote(pin) for pin in pins)
+        command = (
+            f'printf "%s\\n" {pin_args} > {resolved} && '
+            f'source {building}/bin/activate && '
+            + (f'pip install --no-deps --quiet -r {resolved} '
+               f'--index-url {config["index_url"]} --trusted-host {config["trusted_host"]} && ' if pins else '')
+            + f'mv -T {building} {shlex.quote(shared_path)} && '
+            f'{venv_relocate_cmd(shared_path, building_path)}'
+            # 只读：目录与独有文件去掉写权限；与基线共用 inode 的硬链接文件不改权限，否则会连带改动基线
+            f'find {shlex.quote(shared_path)} \\( -type d -o -type f -links 1 \\) -exec chmod a-w {{}} +'
+        )
+        ok, out, err = execute_ssh_command(ssh_client, f'bash -c {shlex.quote(command)}', use_sudo=True)
+        if not ok:
+            execute_ssh_command(ssh_client, f'rm -rf {building} {shlex.quote(shared_path)}', use_sudo=True)
+            return False, None, f'构建共享环境失败: {(err or out).strip()[-2000:]}'
+        info['built'] = True
+        message = f'共享环境已构建（{method}，{len(pins)} 个包，耗时 {time.time() - started:.3f}s）: {shared_path}'
+        logger.info(f"[ensure_shared_env] {message}")
+        return True, info, message
+
+
+def remove_run_workdir(ssh_client, run_dir):
+    """归档完成后删除运行目录（RUN_WORKDIR_CONFIG['keep_after_archive'] 为 True 时保留）"""
+    if RUN_WORKDIR_CONFIG['keep_after_archive']:
+        return
+    ok, _, err = execute_ssh_command(
+        ssh_client, f'rm -rf {shlex.quote(run_dir)} {shlex.quote(run_dir + ".manifest")}', use_sudo=False
+    )
+    METADATA_CACHE.invalidate('server102', run_dir)
+    if not ok:
+        logger.warning(f"[remove_run_workdir] 删除运行目录失败 {run_dir}: {err}")
+
+
+def record_run_manifest(ssh_client, run_dir):
+    """
+    运行前记录运行目录的清单（大小 + 修改时间），保存为执行节点上的 {run_dir}.manifest（JSON），
+    按变化归档（archive_mode='changed'）时据此找出本次运行新增/修改的文件
+
+    Returns:
+        dict | None: 运行目录清单，记录失败时返回 None
+    """
+    try:
+        manifest = build_remote_manifest(ssh_client, run_dir) or {}
+        with SSH_POOL.open_sftp(ssh_client).open(f'{run_dir}.manifest', 'w') as f:
+            f.write(json.dumps(manifest, ensure_ascii=False))
+        return manifest
+    except Exception as e:
+        # 记录失败时归档会退回 full，不影响本次运行
+        logger.warning(f"[record_run_manifest] 记录运行前清单失败 {run_dir}: {str(e)}")
+        return None
+
+
+def remote_mkdirs(ssh_client, dirs, batch=200):
+    """
+    批量创建远程目录（mkdir -p，每条命令最多 batch 个目录）
+
+    Returns:
+        tuple: (success: bool, error: str)
+    """
+    dirs = sorted(set(dirs))
+    for i in range(0, len(dirs), batch):
+        mkdir_cmd = 'mkdir -p ' + ' '.join(shlex.quote(d) for d in dirs[i:i + batch])
+        ok, _, err = execute_ssh_command(ssh_client, mkdir_cmd, use_sudo=False)
+        if not ok:
+            return False, err
+    return True, ''
+
+
+def probe_remote_entries(ssh_client, path, probes=None, use_sudo=False):
+    """
+    一次远程调用列出目录下的所有条目（含隐藏条目），并对每个条目执行若干判断，代替逐条 test 的多次 SSH 往返
+
+    Args:
+        ssh_client: SSH 客户端
+        path: 目录
+        probes: {字段名: 以 "$f" 表示条目的 shell 条件}，例如 {'has_requirements': '[ -f "$f/requirements.txt" ]'}
+        use_sudo: 是否以 sudo 执行
+
+    Returns:
+        tuple: (success: bool, entries: list | str)；entries 按名称排序，每项为
+               {name, is_dir（跟随符号链接）, link_target（非符号链接为 None）, <字段名>: bool}，失败时为错误信息
+    """
+    probes = probes or {}
+    checks = ''.join(f'if {cond}; then printf 1; else printf 0; fi; ' for cond in probes.values())
+    command = (
+        f'cd {shlex.quote(path)} && for f in .[!.]* ..?* *; do '
+        f'{{ [ -e "$f" ] || [ -L "$f" ]; }} || continue; '
+        f'if [ -d "$f" ]; then printf 1; else printf 0; fi; {checks}'
+        f'if [ -L "$f" ]; then printf "\\t1\\t%s" "$(readlink "$f")"; else printf "\\t0\\t"; fi; '
+        f'printf "\\t%s\\0" "$f"; done'
+    )
+    if use_sudo:
+        command = f'bash -c {shlex.quote(command)}'
+    ok, out, err = execute_ssh_command(ssh_client, command, use_sudo=use_sudo)
+    if not ok:
+        return False, (err or out).strip()
+    entries = []
+    for record in out.split('\0'):
+        parts = record.split('\t', 3)
+        if len(parts) != 4:
+            continue
+        flags, is_link, link_target, name = parts
+        entry = {'name': name, 'is_dir': flags[:1] == '1', 'link_target': link_target if is_link == '1' else None}
+        for index, field in enumerate(probes, start=1):
+            entry[field] = flags[index:index + 1] == '1'
+        entries.append(entry)
+    entries.sort(key=lambda e: e['name'])
+    return True, entries
+
+
+def archive_run_dedup(run_dir, run_output_path, username, projectname, ignore=None):
+    """
+    把运行目录归档到 server104 的内容寻址存储（archive_mode='dedup'）
+
+    1. 在 server102 上一次 find + sha256sum 得到运行目录中每个文件的哈希；
+    2. 在 server104 上检查哪些对象（{objects_root}/{hash[:2]}/{hash}）还不存在，只上传这些对象
+       （同一内容只传一次，先写临时文件再原子改名，对象设为只读）；
+    3. 本次运行的清单（相对路径 -> 哈希/大小/权限）保存到 {manifests_root}/{run_id}.json；
+    4. 在归档目录中用硬链接把对象还原成完整的目录结构，使用方式与普通归档相同。
+
+    无法计算哈希的文件（文件名含换行等特殊字符）直接复制到归档目录；ignore 忽略的文件不计算哈希，也不归档。
+
+    Returns:
+        tuple: (success: bool, message: str, stats: dict)
+    """
+    server102_config = SERVER_CONFIG['server102']
+    server104_config = SERVER_CONFIG['server104']
+    run_id = os.path.basename(run_output_path.rstrip('/'))
+    run_dir = run_dir.rstrip('/')
+    run_output_path = run_output_path.rstrip('/')
+    objects_root = ARCHIVE_STORE_CONFIG['objects_root'].format(username=username)
+    manifests_root = ARCHIVE_STORE_CONFIG['manifests_root'].format(username=username, projectname=projectname)
+    stats = {'archive_mode': 'dedup'}
+    started = time.time()
+
+    ssh_source = None
+    ssh_target = None
+    try:
+        ssh_source = SSH_POOL.acquire('server102')
+        ssh_target = SSH_POOL.acquire('server104')
+        sftp_target = SSH_POOL.open_sftp(ssh_target)
+
+        # 有忽略规则时先过滤再计算哈希，被忽略的文件不读取
+        manifest = build_remote_manifest(ssh_source, run_dir, with_hash=not ignore)
+        if manifest is None:
+            return False, f'运行目录不存在: {run_dir}', stats
+        if ignore:
+            manifest, stats['files_ignored'], stats['bytes_ignored'] = ignore.filter_manifest(manifest)
+            hash_remote_manifest(ssh_source, run_dir, manifest, only_listed=True)
+        files = {rel: entry for rel, entry in manifest.items() if entry['type'] == 'f'}
+        hashed = {rel: entry for rel, entry in files.items() if entry['hash']}
+        unhashed = [rel for rel, entry in files.items() if not entry['hash']]
+
+        # 1. 找出 server104 上还不存在的对象（哈希列表经临时文件传给远端，避免命令行过长）
+        hashes = sorted({entry['hash'] for entry in hashed.values()})
+        missing = set()
+        if hashes:
+            list_path = f'/tmp/.{run_id}.{uuid.uuid4().hex[:8]}.hashes'
+            with sftp_target.open(list_path, 'w') as f:
+                f.write('\n'.join(hashes) + '\n')
+            check_cmd = (
+                f'root={shlex.quote(objects_root)}; '
+                f'while read -r h; do [ -e "$root/${{h:0:2}}/$h" ] || echo "$h"; done < {shlex.quote(list_path)}; '
+                f'rm -f {shlex.quote(list_path)}'
+            )
+            ok, out, err = execute_ssh_command(ssh_target, check_cmd, use_sudo=False)
+            if not ok:
+                return False, f'检查已有对象失败: {err}', stats
+            missing = set(out.split())
+
+        # 2. 建好对象目录与归档目录结构，再上传缺失的对象（每个哈希只传一次）
+        upload = {}
+        for rel, entry in hashed.items():
+            if entry['hash'] in missing:
+                upload.setdefault(entry['hash'], rel)
+        dirs = {objects_root, manifests_root, run_output_path}
+        dirs.update(f'{objects_root}/{digest[:2]}' for digest in upload)
+        dirs.update(f'{run_output_path}/{rel}' for rel, entry in manifest.items() if entry['type'] == 'd')
+        dirs.update(f'{run_output_path}/{rel}'.rsplit('/', 1)[0] for rel in files)
+        ok, err = remote_mkdirs(ssh_target, dirs)
+        if not ok:
+            return False, f'创建归档目录失败: {err}', stats
+
+        def store_file(src_sftp, src_item, dst_sftp, dst_item):
+            """写到临时文件后原子改名；对象会被多次运行共享，设为只读"""
+            tmp_item = f"{dst_item}.{uuid.uuid4().hex[:8]}.tmp"
+            copied = sftp_copy_file_data(src_sftp, src_item, dst_sftp, tmp_item)
+            if dst_item.startswith(objects_root + '/'):
+                dst_sftp.chmod(tmp_item, 0o444)
+            try:
+                dst_sftp.posix_rename(tmp_item, dst_item)
+            except IOError:
+                # 服务端不支持 posix-rename 扩展时退回 rename；对象已被并发上传时保留已有的那份
+                try:
+                    dst_sftp.rename(tmp_item, dst_item)
+                except IOError:
+                    dst_sftp.remove(tmp_item)
+                    dst_sftp.stat(dst_item)
+            return copied
+
+        file_pairs = [(f'{run_dir}/{rel}', f'{objects_root}/{digest[:2]}/{digest}') for digest, rel in upload.items()]
+        file_pairs += [(f'{run_dir}/{rel}', f'{run_output_path}/{rel}') for rel in unhashed]
+        results = parallel_sftp_copy(
+            server102_config['host'],
+            server102_config['port'],
+            server102_config['user'],
+            server102_config['password'],
+            server104_config['host'],
+            server104_config['port'],
+            server104_config['user'],
+            server104_config['password'],
+            file_pairs,
+            copy_func=store_file
+        )
+        failed = [r for r in results if not r['success']]
+        if failed:
+            return False, (
+                f"{len(failed)}/{len(results)} 个对象上传失败，首个错误: "
+                f"{failed[0]['source']}: {failed[0]['message']}"
+            ), stats
+
+        # 3. 保存本次运行的清单
+        run_manifest = {
+            'run_id': run_id,
+            'run_dir': f'server102:{run_dir}',
+            'archive_path': run_output_path,
+            'objects_root': objects_root,
+            'archived_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'files': {
+                rel: {'hash': entry['hash'], 'size': entry['size'], 'mode': entry['mode'] & 0o7777}
+                for rel, entry in sorted(files.items())
+            },
+        }
+        manifest_path = f'{manifests_root}/{run_id}.json'
+        with sftp_target.open(manifest_path, 'w') as f:
+            f.write(json.dumps(run_manifest, ensure_ascii=False, indent=1))
+
+        # 4. 用硬链接在归档目录中还原目录结构
+        if hashed:
+            links_path = f'/tmp/.{run_id}.{uuid.uuid4().hex[:8]}.links'
+            with sftp_target.open(links_path, 'w') as f:
+                f.write(''.join(f"{entry['hash']}\t{rel}\n" for rel, entry in hashed.items()))
+            link_cmd = (
+                f'root={shlex.quote(objects_root)}; dst={shlex.quote(run_output_path)}; failed=0; '
+                f'while IFS="$(printf \'\\t\')" read -r h rel; do '
+                f'ln -f "$root/${{h:0:2}}/$h" "$dst/$rel" || failed=1; '
+                f'done < {shlex.quote(links_path)}; rm -f {shlex.quote(links_path)}; exit $failed'
+            )
+            ok, _, err = execute_ssh_command(ssh_target, link_cmd, use_sudo=False)
+            if not ok:
+                return False, f'在归档目录中创建硬链接失败: {err}', stats
+
+        uploaded = [r for r in results if r['target'].startswith(objects_root + '/')]
+        stats.update({
+            'files': len(files),
+            'objects_uploaded': len(uploaded),
+            'bytes_uploaded': sum(r['bytes'] for r in results),
+            'files_deduplicated': len(hashed) - len(uploaded),
+            'bytes_deduplicated': sum(entry['size'] for entry in hashed.values()) - sum(r['bytes'] for r in uploaded),
+            'manifest': manifest_path,
+            'elapsed': round(time.time() - started, 3),
+        })
+        message = (
+            f"内容寻址归档完成: server102:{run_dir} -> server104:{run_output_path}，"
+            f"共 {len(files)} 个文件，上传 {stats['objects_uploaded']} 个新对象（{stats['bytes_uploaded']} 字节），"
+            f"{stats['files_deduplicated']} 个文件复用已有对象（{stats['bytes_deduplicated']} 字节），"
+            f"耗时 {stats['elapsed']}s"
+        )
+        logger.info(f"[archive_run_dedup] {message}")
+        return True, message, stats
+
+    except Exception as e:
+        logger.error(f"内容寻址归档出错: {str(e)}", exc_info=True)
+        return False, f'内容寻址归档出错: {str(e)}', stats
+
+    finally:
+        SSH_POOL.release(ssh_source)
+        SSH_POOL.release(ssh_target)
+
+
+def archive_run_to_server104(run_dir, run_output_path, archive_mode='full', transport='sftp', direct=False,
+                             source=None, username=None, projectname=None, ignore=None):
+    """
+    把运行目录归档到 server104
+
+    - full: 复制整个运行目录（含未改动的代码与输入数据）；
+    - changed: 对比运行前记录的清单（record_run_manifest），只传输本次运行新增或修改的文件，
+      未改动的文件不复制，而是在归档目录的快照文件（RUN_ARCHIVE_CONFIG['snapshot_file']）中记录
+      源项目位置与这些文件的清单，作为对源快照的引用。没有运行前清单时退回 full；
+    - dedup: 内容寻址存储，只上传 server104 上还没有的文件内容，归档目录由硬链接组成（见 archive_run_dedup）。
+
+    Args:
+        run_dir: server102 上的运行目录
+        run_output_path: server104 上的归档目录
+        archive_mode: 'full' / 'changed' / 'dedup'
+        transport: 'sftp' / 'tar'（dedup 方式固定使用多通道 SFTP）
+        direct: 是否优先由 server102 直接推送到 server104（dedup 方式不适用）
+        source: 写入快照文件的源项目信息（如 {'server': 'server101', 'path': ...}）
+        username / projectname: dedup 方式用于确定对象与清单目录
+        ignore: SyncIgnore，运行目录中被忽略的文件（包括运行时产生的）不归档
+
+    Returns:
+        tuple: (success: bool, message: str, stats: dict)
+    """
+    try:
+        if archive_mode == 'dedup':
+            return archive_run_dedup(run_dir, run_output_path, username, projectname, ignore)
+        return _archive_run_copy(run_dir, run_output_path, archive_mode, transport, direct, source, ignore)
+    finally:
+        METADATA_CACHE.invalidate('server104', run_output_path)
+
+
+def _archive_run_copy(run_dir, run_output_path, archive_mode, transport, direct, source, ignore=None):
+    """archive_run_to_server104 的 full / changed 方式"""
+    server102_config = SERVER_CONFIG['server102']
+    server104_config = SERVER_CONFIG['server104']
+    stats = {'archive_mode': archive_mode}
+
+    pre_manifest = None
+    if archive_mode == 'changed':
+        ssh_client = SSH_POOL.acquire('server102')
+        try:
+            with SSH_POOL.open_sftp(ssh_client).open(f'{run_dir}.manifest', 'r') as f:
+                pre_manifest = json.loads(f.read().decode('utf-8'))
+        except IOError:
+            logger.warning(f"[archive_run_to_server104] 未找到运行前清单 {run_dir}.manifest，改为完整归档")
+            stats['archive_mode'] = 'full'
+        finally:
+            SSH_POOL.release(ssh_client)
+
+    if pre_manifest is None:
+        success, message = copy_folder_remote_to_remote(
+            server102_config['host'],
+            server102_config['port'],
+            server102_config['user'],
+            server102_config['password'],
+            run_dir,
+            server104_config['host'],
+            server104_config['port'],
+            server104_config['user'],
+            server104_config['password'],
+            run_output_path,
+            transport=transport,
+            direct=direct,
+            ignore=ignore
+        )
+        return success, message, stats
+
+    started = time.time()
+    ssh_source = None
+    ssh_target = None
+    try:
+        ssh_source = SSH_POOL.acquire('server102')
+        post_manifest = build_remote_manifest(ssh_source, run_dir)
+        if post_manifest is None:
+            return False, f'运行目录不存在: {run_dir}', stats
+        if ignore:
+            post_manifest, stats['files_ignored'], stats['bytes_ignored'] = ignore.filter_manifest(post_manifest)
+
+        changed = {}
+        new_dirs = []
+        unchanged = {}
+        for rel, entry in post_manifest.items():
+            before = pre_manifest.get(rel)
+            if entry['type'] == 'd':
+                if before is None or before['type'] != 'd':
+                    new_dirs.append(rel)
+            elif (before is None or before['type'] != 'f' or before['size'] != entry['size']
+                  or before['mtime'] != entry['mtime']):
+                changed[rel] = entry['size']
+            else:
+                unchanged[rel] = {'size': entry['size'], 'mtime': entry['mtime']}
+        deleted = sorted(rel for rel, entry in pre_manifest.items()
+                         if entry['type'] == 'f' and rel not in post_manifest)
+
+        # 目标端先建好归档目录、新目录与变化文件的上级目录（sftp 方式逐文件写入时需要）
+        dirs = {run_output_path}
+        dirs.update(f'{run_output_path}/{rel}' for rel in new_dirs)
+        dirs.update(f'{run_output_path}/{rel}'.rsplit('/', 1)[0] for rel in changed)
+        ssh_target = SSH_POOL.acquire('server104')
+        ok, err = remote_mkdirs(ssh_target, dirs)
+        if not ok:
+            return False, f'创建归档目录失败: {err}', stats
+
+        files_sent, bytes_sent = copy_files_remote_to_remote(
+            server102_config['host'],
+            server102_config['port'],
+            server102_config['user'],
+            server102_config['password'],
+            run_dir.rstrip('/'),
+            server104_config['host'],
+            server104_config['port'],
+            server104_config['user'],
+            server104_config['password'],
+            run_output_path.rstrip('/'),
+            changed,
+            transport=transport,
+            direct=direct
+        )
+
+        # 未复制的文件以清单形式引用源快照
+        manifest_text = '\n'.join(
+            f"{rel}\t{unchanged[rel]['size']}\t{unchanged[rel]['mtime']}" for rel in sorted(unchanged)
+        )
+        snapshot = {
+            'archive_mode': 'changed',
+            'run_dir': f"server102:{run_dir}",
+            'source': source,
+            'snapshot_id': hashlib.sha256(manifest_text.encode('utf-8')).hexdigest(),
+            'archived_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'archived': sorted(changed),
+            'deleted': deleted,
+            'unchanged': unchanged,
+        }
+        snapshot_path = f"{run_output_path.rstrip('/')}/{RUN_ARCHIVE_CONFIG['snapshot_file']}"
+        with SSH_POOL.open_sftp(ssh_target).open(snapshot_path, 'w') as f:
+            f.write(json.dumps(snapshot, ensure_ascii=False, indent=1))
+
+        stats.update({
+            'files_sent': files_sent,
+            'bytes_sent': bytes_sent,
+            'files_referenced': len(unchanged),
+            'bytes_referenced': sum(e['size'] for e in unchanged.values()),
+            'files_deleted': len(deleted),
+            'snapshot_id': snapshot['snapshot_id'],
+            'elapsed': round(time.time() - started, 3),
+        })
+        message = (
+            f"按变化归档完成: server102:{run_dir} -> server104:{run_output_path}，"
+            f"传输 {files_sent} 个新增/修改的文件（{bytes_sent} 字节），"
+            f"引用 {stats['files_referenced']} 个未改动的文件（{stats['bytes_referenced']} 字节），"
+            f"耗时 {stats['elapsed']}s"
+        )
+        logger.info(f"[archive_run_to_server104] {message}")
+        return True, message, stats
+
+    except Exception as e:
+        logger.error(f"按变化归档出错: {str(e)}", exc_info=True)
+        return False, f'按变化归档出错: {str(e)}', stats
+
+    finally:
+        SSH_POOL.release(ssh_source)
+        SSH_POOL.release(ssh_target)
+
+
+def sftp_tail_offset(sftp, remote_path, lines, block_size=64 * 1024):
+    """
+    计算文件最后 lines 行的起始字节偏移：从文件末尾按块向前读，只读取这几行所在的字节
+
+    Args:
+        sftp: SFTP 客户端
+        remote_path: 远程文件路径
+        lines: 行数（<= 0 表示从头开始）
+        block_size: 每次向前读取的字节数
+
+    Returns:
+        int: 起始偏移（文件不存在时返回 0）
+    """
+    try:
+        size = sftp.stat(remote_path).st_size
+    except IOError:
+        return 0
+    if lines <= 0 or size == 0:
+        return 0
+    with sftp.open(remote_path, 'rb') as f:
+        position = size
+        # 文件末尾的换行不算作新的一行
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            position -= 1
+        remaining = lines
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            index = len(block)
+            while True:
+                index = block.rfind(b'\n', 0, index)
+                if index < 0:
+                    break
+                remaining -= 1
+                if remaining == 0:
+                    return start + index + 1
+            position = start
+    return 0
+
+
+def _utf8_complete_length(data):
+    """去掉末尾不完整的 UTF-8 字符后的长度（窗口边界落在多字节字符中间时使用）"""
+    for back in range(1, min(4, len(data)) + 1):
+        byte = data[-back]
+        if byte & 0xC0 == 0x80:
+            continue  # 续字节，继续向前找首字节
+        need = 1 if byte < 0x80 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+        return len(data) if need <= back else len(data) - back
+    return len(data)
+
+
+def parse_read_window(data):
+    """
+    解析按字节窗口读取的参数 offset / length / tail_lines
+
+    Returns:
+        tuple: (offset, length, tail_lines, error)，未提供的参数为 None，参数无效时 error 为错误信息
+    """
+    values = {}
+    for name in ('offset', 'length', 'tail_lines'):
+        value = data.get(name)
+        if value is None:
+            values[name] = None
+            continue
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            return None, None, None, f'{name} 必须是非负整数'
+        values[name] = value
+    return values['offset'], values['length'], values['tail_lines'], None
+
+
+def sftp_read_window(sftp, remote_path, offset=None, length=None, tail_lines=None):
+    """
+    按字节窗口读取远程文件：SFTP seek 到起始位置，只传输窗口内的字节
+
+    Args:
+        sftp: SFTP 客户端
+        remote_path: 远程文件路径
+        offset: 起始字节偏移（None 表示从头读取；指定 tail_lines 时忽略）
+        length: 最多读取的字节数（None 表示读到文件末尾；窗口末尾不完整的 UTF-8 字符留给下一次读取）
+        tail_lines: 从最后 tail_lines 行开始读取
+
+    Returns:
+        dict: content / offset（实际起始偏移）/ next_offset / size / eof
+    """
+    size = sftp.stat(remote_path).st_size
+    if tail_lines is not None:
+        start = sftp_tail_offset(sftp, remote_path, tail_lines)
+    else:
+        start = min(offset or 0, size)
+    end = size if length is None else min(size, start + length)
+
+    data = b''
+    if end > start:
+        with sftp.open(remote_path, 'rb') as f:
+            f.seek(start)
+            f.prefetch(end)
+            data = f.read(end - start)
+        if end < size:
+            data = data[:_utf8_complete_length(data)]
+
+    next_offset = start + len(data)
+    return {
+        'content': data.decode('utf-8', errors='replace'),
+        'offset': start,
+        'next_offset': next_offset,
+        'size': size,
+        'eof': next_offset >= size,
+    }
+
+
+def sudo_read_window(ssh_client, remote_path, offset=None, length=None, tail_lines=None):
+    """
+    sftp_read_window 的 sudo 版本（SFTP 无权限读取时使用），由远程 tail / head 截取窗口
+
+    Returns:
+        tuple: (是否成功, 与 sftp_read_window 相同的 dict 或错误信息)
+    """
+    path = shlex.quote(remote_path)
+    ok, out, err = execute_ssh_command(ssh_client, f'stat -c %s {path}', use_sudo=True)
+    if not ok or not out.strip().isdigit():
+        return False, err or out
+    size = int(out.strip())
+    if tail_lines is not None:
+        ok, out, err = execute_ssh_command(ssh_client, f'tail -n {tail_lines} {path} | wc -c', use_sudo=True)
+        if not ok or not out.strip().isdigit():
+            return False, err or out
+        start = max(0, size - int(out.strip()))
+    else:
+        start = min(offset or 0, size)
+    read_cmd = f'tail -c +{start + 1} {path}'
+    if length is not None:
+        read_cmd += f' | head -c {length}'
+    ok, content, err = execute_ssh_command(ssh_client, read_cmd, use_sudo=True)
+    if not ok:
+        return False, err
+    next_offset = min(size, start + len(content.encode('utf-8')))
+    return True, {
+        'content': content,
+        'offset': start,
+        'next_offset': next_offset,
+        'size': size,
+        'eof': next_offset >= size,
+    }
+
+
+def _list_entry_type(mode):
+    if stat.S_ISDIR(mode):
+        return 'directory'
+    if stat.S_ISLNK(mode):
+        return 'link'
+    return 'file'
+
+
+def sftp_list_dir(sftp, path):
+    """
+    用 SFTP listdir_iter 读取目录条目（不跟随符号链接）
+
+    Returns:
+        list: [(name, mode, size, mtime, owner, group)]，owner/group 取自服务器返回的 longname，没有时为 uid/gid
+    """
+    names = {}  # 重复的属主/属组字符串只保留一份
+    entries = []
+    for attr in sftp.listdir_iter(path):
+        if attr.filename in ('.', '..'):
+            continue
+        fields = (attr.longname or '').split(None, 8)
+        if len(fields) >= 9:
+            owner, group = fields[2], fields[3]
+        else:
+            owner, group = str(attr.st_uid), str(attr.st_gid)
+        entries.append((
+            attr.filename, attr.st_mode or 0, attr.st_size or 0, int(attr.st_mtime or 0),
+            names.setdefault(owner, owner), names.setdefault(group, group)
+        ))
+    return entries
+
+
+def sudo_list_dir(ssh_client, path):
+    """
+    SFTP 用户无权读取目录时，以 sudo 执行一次 find -printf 读取目录条目
+
+    Returns:
+        tuple: (success: bool, entries: list | str)，entries 格式同 sftp_list_dir，失败时为错误信息
+    """
+    type_bits = {'d': stat.S_IFDIR, 'l': stat.S_IFLNK, 'f': stat.S_IFREG, 'p': stat.S_IFIFO,
+                 's': stat.S_IFSOCK, 'c': stat.S_IFCHR, 'b': stat.S_IFBLK}
+    command = (
+        f'cd {shlex.quote(path)} && find . -mindepth 1 -maxdepth 1 '
+        f'-printf "%y\\t%m\\t%s\\t%T@\\t%u\\t%g\\t%f\\0"'
+    )
+    ok, out, err = execute_ssh_command(ssh_client, f'bash -c {shlex.quote(command)}', use_sudo=True)
+    if not ok:
+        return False, (err or out).strip()
+    names = {}
+    entries = []
+    for record in out.split('\0'):
+        parts = record.split('\t', 6)
+        if len(parts) != 7:
+            continue
+        kind, perms, size, mtime, owner, group, name = parts
+        entries.append((
+            name, type_bits.get(kind, 0) | int(perms, 8), int(size), int(float(mtime)),
+            names.setdefault(owner, owner), names.setdefault(group, group)
+        ))
+    return True, entries
+
+
+def _list_sort_key(sort):
+    if sort == 'size':
+        return lambda e: (e[2], e[0])
+    if sort == 'mtime':
+        return lambda e: (e[3], e[0])
+    return lambda e: (not stat.S_ISDIR(e[1]), e[0].lower(), e[0])
+
+
+def encode_list_cursor(sort, order, key):
+    """把分页位置（最后一条的排序键）编码为不透明的游标字符串"""
+    raw = json.dumps({'s': sort, 'o': order, 'k': list(key)}, ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_list_cursor(cursor, sort, order):
+    """解析游标，返回排序键；游标无效或与本次排序方式不一致时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        data = json.loads(raw)
+        key = tuple(data['k'])
+    except Exception:
+        raise ValueError('cursor 无效')
+    if data.get('s') != sort or data.get('o') != order:
+        raise ValueError('cursor 与本次请求的 sort / order 不一致')
+    # 排序键的形状须与 _list_sort_key 一致，否则 bisect 比较时会抛出 TypeError
+    if sort in ('size', 'mtime'):
+        valid = (len(key) == 2 and isinstance(key[0], (int, float)) and not isinstance(key[0], bool)
+                 and isinstance(key[1], str))
+    else:
+        valid = (len(key) == 3 and isinstance(key[0], bool)
+                 and isinstance(key[1], str) and isinstance(key[2], str))
+    if not valid:
+        raise ValueError('cursor 无效')
+    return key
+
+
+def paginate_listing(entries, sort='name', order='asc', name_filter=None, show_hidden=True, cursor=None,
+                     limit=None):
+    """
+    对目录条目过滤、排序并取一页
+
+    游标记录上一页最后一条的排序键，下一页从排序键之后继续，目录在两次请求之间变化时不会重复或跳过未变化的条目。
+
+    Args:
+        entries: sftp_list_dir / sudo_list_dir 返回的条目
+        sort: name / size / mtime
+        order: asc / desc
+        name_filter: 名称过滤（不区分大小写；包含 * ? [ 时按通配符匹配，否则按子串匹配）
+        show_hidden: 是否包含以 . 开头的条目
+        cursor: 上一页返回的 next_cursor
+        limit: 每页条目数
+
+    Returns:
+        tuple: (page: list, total: int, next_cursor: str | None)，total 为过滤后的条目总数
+    """
+    if not show_hidden:
+        entries = [e for e in entries if not e[0].startswith('.')]
+    if name_filter:
+        pattern = name_filter.lower()
+        if any(c in pattern for c in '*?['):
+            entries = [e for e in entries if fnmatch.fnmatchcase(e[0].lower(), pattern)]
+        else:
+            entries = [e for e in entries if pattern in e[0].lower()]
+    sort_key = _list_sort_key(sort)
+    entries = sorted(entries, key=sort_key)
+    keys = [sort_key(e) for e in entries]
+    total = len(entries)
+    last_key = decode_list_cursor(cursor, sort, order) if cursor else None
+
+    if order == 'desc':
+        end = bisect.bisect_left(keys, last_key) if last_key is not None else total
+        start = max(0, end - limit)
+        page = entries[start:end][::-1]
+        has_more = start > 0
+    else:
+        start = bisect.bisect_right(keys, last_key) if last_key is not None else 0
+        end = min(total, start + limit)
+        page = entries[start:end]
+        has_more = end < total
+    next_cursor = encode_list_cursor(sort, order, sort_key(page[-1])) if has_more and page else None
+    return page, total, next_cursor
+
+
+def parse_http_range(range_header, size):
+    """
+    解析 HTTP Range 请求头（只支持单个区间：bytes=a-b / bytes=a- / bytes=-n）
+
+    Returns:
+        tuple | None: (start, end)，end 不含；没有 Range、格式不支持或多区间时返回 None（按整个文件返回）
+
+    Raises:
+        ValueError: 区间无法满足（应返回 416）
+    """
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    first, sep, last = range_header[len('bytes='):].strip().partition('-')
+    if not sep or (first == last == '') or not (first.isdigit() or first == '') \
+            or not (last.isdigit() or last == ''):
+        return None
+    if first == '':
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError('Range 无法满足')
+        return max(0, size - suffix), size
+    start = int(first)
+    end = int(last) + 1 if last else size
+    if start >= size or end <= start:
+        raise ValueError('Range 无法满足')
+    return start, min(end, size)
+
+
+def sftp_stream_file(server, remote_path, start, end):
+    """
+    以 SFTP 流式读取远程文件 [start, end) 区间的生成器（每轮用 readv 并发读取 window 个块，读完一轮再读下一轮）
+
+    在生成器内从 STREAM_SSH_POOL 借用并归还 SSH 连接（不占用执行任务所用的 SSH_POOL），
+    客户端断开时随生成器关闭而归还。
+    """
+    chunk_size = DOWNLOAD_CONFIG['chunk_size']
+    window = chunk_size * DOWNLOAD_CONFIG['window']
+    ssh_client = STREAM_SSH_POOL.acquire(server)
+    try:
+        with STREAM_SSH_POOL.open_sftp(ssh_client).open(remote_path, 'rb') as f:
+            position = start
+            while position < end:
+                window_end = min(end, position + window)
+                chunks = [(offset, min(chunk_size, window_end - offset))
+                          for offset in range(position, window_end, chunk_size)]
+                for data in f.readv(chunks):
+                    if not data:
+                        return
+                    yield data
+                position = window_end
+    finally:
+        STREAM_SSH_POOL.release(ssh_client)
+
+
+def sudo_stream_file(server, remote_path, start, end):
+    """SFTP 无权读取时，以 sudo 执行 tail | head 并从 SSH 通道流式读取 [start, end) 区间"""
+    ssh_client = STREAM_SSH_POOL.acquire(server)
+    channel = None
+    try:
+        command = f'tail -c +{start + 1} {shlex.quote(remote_path)} | head -c {end - start}'
+        channel = ssh_client.get_transport().open_session()
+        channel.exec_command(f'echo "{SUDO_PASSWORD}" | sudo -S bash -c {shlex.quote(command)}')
+        while True:
+            data = channel.recv(DOWNLOAD_CONFIG['chunk_size'])
+            if not data:
+                break
+            yield data
+    finally:
+        if channel is not None:
+            channel.close()
+        STREAM_SSH_POOL.release(ssh_client)
+
+
+def split_glob_patterns(values):
+    """把请求中的 glob 参数（可重复传入，也可用逗号分隔）展开成模式列表"""
+    patterns = []
+    for value in values or []:
+        patterns.extend(p.strip() for p in str(value).split(',') if p.strip())
+    return patterns
+
+
+def match_archive_path(relative, patterns):
+    """相对路径是否匹配任一 glob（* 可以跨越 /；不含 / 的模式同时与文件名比较，如 *.log）"""
+    name = posixpath.basename(relative)
+    return any(fnmatch.fnmatchcase(relative, p) or ('/' not in p and fnmatch.fnmatchcase(name, p))
+               for p in patterns)
+
+
+def walk_remote_tree(ssh_client, root, exclude=None):
+    """
+    按名称顺序深度优先遍历远程目录的生成器（不跟随符号链接），SFTP 无权读取的目录改用 sudo 读取
+
+    无法读取的子目录记录警告后跳过，不中断遍历。
+
+    Args:
+        ssh_client: 从 STREAM_SSH_POOL 借用的连接
+        exclude: glob 列表，匹配的文件不返回、匹配的目录整个跳过
+
+    Yields:
+        tuple: (relative, mode, size, mtime, use_sudo)，use_sudo 表示该条目需要 sudo 才能读取
+    """
+    sftp = STREAM_SSH_POOL.open_sftp(ssh_client)
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        path = f'{root}/{relative_dir}' if relative_dir else root
+        use_sudo = False
+        try:
+            entries = sftp_list_dir(sftp, path)
+        except IOError as e:
+            if getattr(e, 'errno', None) != errno.EACCES:
+                logger.warning(f"遍历目录失败，已跳过: {path}。错误: {str(e)}")
+                continue
+            success, entries = sudo_list_dir(ssh_client, path)
+            if not success:
+                logger.warning(f"遍历目录失败，已跳过: {path}。错误: {entries}")
+                continue
+            use_sudo = True
+
+        subdirs = []
+        for name, mode, size, mtime, _, _ in sorted(entries):
+            relative = f'{relative_dir}/{name}' if relative_dir else name
+            if exclude and match_archive_path(relative, exclude):
+                continue
+            yield relative, mode, size, mtime, use_sudo
+            if stat.S_ISDIR(mode):
+                subdirs.append(relative)
+        pending.extend(reversed(subdirs))
+
+
+def read_remote_link(ssh_client, path, use_sudo=False):
+    """读取远程符号链接的指向，失败时返回 None"""
+    if not use_sudo:
+        try:
+            return STREAM_SSH_POOL.open_sftp(ssh_client).readlink(path)
+        except IOError:
+            pass
+    success, stdout, _ = execute_ssh_command(ssh_client, f'readlink {shlex.quote(path)}', use_sudo=True)
+    return stdout.rstrip('\n') if success else None
+
+
+def open_remote_file_stream(server, remote_path, size, use_sudo=False):
+    """
+    打开远程文件的流式读取（SFTP 无权读取时改用 sudo），先读出第一块，以便在写入压缩包条目头之前发现无法读取的文件
+
+    Returns:
+        generator: 文件内容数据块
+
+    Raises:
+        IOError: 文件无法读取
+    """
+    chunks = (sudo_stream_file if use_sudo else sftp_stream_file)(server, remote_path, 0, size)
+    try:
+        first = next(chunks, b'')
+    except IOError as e:
+        if use_sudo or getattr(e, 'errno', None) != errno.EACCES:
+            raise
+        chunks = sudo_stream_file(server, remote_path, 0, size)
+        first = next(chunks, b'')
+
+    def resume():
+        try:
+            if first:
+                yield first
+            yield from chunks
+        finally:
+            chunks.close()
+    return resume()
+
+
+class TarStreamWriter:
+    """
+    逐条目生成 tar（PAX 格式）数据，可选 gzip 压缩；各方法返回 / 产出应写入响应的字节
+
+    tar 条目头中要写入文件大小，实际读到的内容与遍历时的大小不一致时（文件在打包过程中被修改）
+    截断或以 0 补齐，保证压缩包结构完整。
+    """
+
+    def __init__(self, compression='none'):
+        self._compressor = zlib.compressobj(wbits=31) if compression == 'gzip' else None  # wbits=31: gzip 格式
+        self._offset = 0
+
+    def _emit(self, data):
+        self._offset += len(data)
+        return self._compressor.compress(data) if self._compressor else data
+
+    def _header(self, name, entry_type, mode, mtime, size=0, linkname=''):
+        info = tarfile.TarInfo(name)
+        info.type = entry_type
+        info.mode = mode & 0o7777
+        info.mtime = mtime
+        info.size = size
+        info.linkname = linkname
+        return self._emit(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+    def add_dir(self, name, mode, mtime):
+        return self._header(name, tarfile.DIRTYPE, mode, mtime)
+
+    def add_symlink(self, name, target, mode, mtime):
+        return self._header(name, tarfile.SYMTYPE, mode, mtime, linkname=target)
+
+    def add_file(self, name, mode, size, mtime, chunks):
+        yield self._header(name, tarfile.REGTYPE, mode, mtime, size)
+        written = 0
+        try:
+            for data in chunks:
+                data = data[:size - written]
+                written += len(data)
+                yield self._emit(data)
+                if written >= size:
+                    break
+        finally:
+            chunks.close()
+        if written < size:
+            logger.warning(f"打包时文件变小: {name}（{written}/{size} 字节），不足部分以 0 补齐")
+            while written < size:
+                padding = min(size - written, DOWNLOAD_CONFIG['chunk_size'])
+                written += padding
+                yield self._emit(tarfile.NUL * padding)
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            yield self._emit(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def close(self):
+        # 结尾是两个全 0 块，并补齐到 RECORDSIZE 的整数倍（与 tarfile 生成的文件一致）
+        data = self._emit(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self._offset % tarfile.RECORDSIZE
+        if remainder:
+            data += self._emit(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        if self._compressor:
+            data += self._compressor.flush()
+        return data
+
+
+class _StreamSink:
+    """只支持追加写入的文件对象，zipfile 写入的数据暂存在这里，由 drain() 取走后写入响应"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipStreamWriter:
+    """
+    逐条目生成 zip 数据，可选 deflate 压缩；各方法返回 / 产出应写入响应的字节
+
+    输出不可 seek，zipfile 会在每个文件数据之后写入数据描述符（data descriptor），大文件自动使用 zip64。
+    """
+
+    def __init__(self, compression='none'):
+        self._sink = _StreamSink()
+        self._compression = zipfile.ZIP_DEFLATED if compression == 'deflate' else zipfile.ZIP_STORED
+        self._zip = zipfile.ZipFile(self._sink, 'w', compression=self._compression, allowZip64=True)
+
+    @staticmethod
+    def _info(name, mode, mtime):
+        # zip 的时间字段不能早于 1980 年
+        info = zipfile.ZipInfo(name, date_time=time.localtime(max(mtime, 315619200))[:6])
+        info.external_attr = (mode & 0xFFFF) << 16
+        return info
+
+    def add_dir(self, name, mode, mtime):
+        info = self._info(name + '/', mode, mtime)
+        info.external_attr |= 0x10  # MS-DOS 目录标志
+        self._zip.writestr(info, b'')
+        return self._sink.drain()
+
+    def add_symlink(self, name, target, mode, mtime):
+        # 与 Info-ZIP 相同：条目内容为链接指向，权限位中带 S_IFLNK
+        self._zip.writestr(self._info(name, mode, mtime), target)
+        return self._sink.drain()
+
+    def add_file(self, name, mode, size, mtime, chunks):
+        info = self._info(name, mode, mtime)
+        info.compress_type = self._compression
+        info.file_size = size  # 用于决定是否使用 zip64，实际大小在数据描述符中
+        try:
+            with self._zip.open(info, 'w') as dest:
+                for data in chunks:
+                    dest.write(data)
+                    yield self._sink.drain()
+        finally:
+            chunks.close()
+        yield self._sink.drain()
+
+    def close(self):
+        self._zip.close()
+        return self._sink.drain()
+
+
+def stream_run_archive(server, root, arcname, archive_format='tar', compression='none', include=None, exclude=None):
+    """
+    边遍历 server 上的 root 目录边生成 tar / zip 数据的生成器（不在任何节点上生成临时压缩包）
+
+    同一时刻只持有一个文件的一个读取窗口，server103 内存占用与目录大小无关；客户端读取期间占用的连接
+    来自 STREAM_SSH_POOL，不占用执行任务所用的 SSH_POOL；
+    无法读取的文件记录警告后跳过，管道、设备等特殊文件不打包。
+
+    Args:
+        arcname: 压缩包内的顶层目录名
+        archive_format: tar / zip
+        compression: tar 为 none / gzip，zip 为 none / deflate
+        include: glob 列表，只打包匹配的文件（此时不单独写入目录条目）
+        exclude: glob 列表，跳过匹配的文件与目录
+
+    Yields:
+        bytes: 压缩包数据块
+    """
+    writer = TarStreamWriter(compression) if archive_format == 'tar' else ZipStreamWriter(compression)
+    counts = {'files': 0, 'bytes': 0, 'skipped': 0}
+    started = time.time()
+
+    def entries():
+        for relative, mode, size, mtime, use_sudo in walk_remote_tree(ssh_client, root, exclude):
+            name = f'{arcname}/{relative}'
+            remote_path = f'{root}/{relative}'
+            if stat.S_ISDIR(mode):
+                if not include:
+                    yield writer.add_dir(name, mode, mtime)
+                continue
+            if include and not match_archive_path(relative, include):
+                continue
+            if stat.S_ISLNK(mode):
+                target = read_remote_link(ssh_client, remote_path, use_sudo)
+                if target is None:
+                    counts['skipped'] += 1
+                    logger.warning(f"读取符号链接失败，已跳过: {remote_path}")
+                    continue
+                yield writer.add_symlink(name, target, mode, mtime)
+            elif stat.S_ISREG(mode):
+                try:
+                    chunks = open_remote_file_stream(server, remote_path, size, use_sudo)
+                except IOError as e:
+                    counts['skipped'] += 1
+                    logger.warning(f"读取文件失败，已跳过: {remote_path}。错误: {str(e)}")
+                    continue
+                yield from writer.add_file(name, mode, size, mtime, chunks)
+                counts['files'] += 1
+                counts['bytes'] += size
+        yield writer.close()
+
+    ssh_client = STREAM_SSH_POOL.acquire(server)
+    try:
+        for data in entries():
+            if data:  # 压缩器缓冲中的空输出不写入响应
+                yield data
+        logger.info(f"打包下载完成: {server}:{root} ({archive_format}/{compression})，{counts['files']} 个文件，"
+                    f"{counts['bytes']} 字节，跳过 {counts['skipped']} 个，耗时 {time.time() - started:.2f}s")
+    finally:
+        STREAM_SSH_POOL.release(ssh_client)
+
+
+def format_sse(data=None, event=None, event_id=None):
+    """按 Server-Sent Events 格式编码一条事件（多行 data 逐行加 data: 前缀）"""
+    parts = []
+    if event_id is not None:
+        parts.append(f'id: {event_id}')
+    if event:
+        parts.append(f'event: {event}')
+    for line in (data or '').split('\n'):
+        parts.append(f'data: {line}')
+    return '\n'.join(parts) + '\n\n'
+
+
+def get_job_log_sources(job):
+    """
+    任务日志的位置
+
+    - 同步/异步任务：命令输出直接写入执行节点的 /tmp/{run_id}.log，运行期间由 LogShipper 按批追加到
+      server104 的 log_file，进入 archiving 时已完整写入；之后执行节点上的临时日志被删除
+    - 后台任务：nohup 脚本把日志写在执行节点的 log_file（/tmp 下），结束后仍保留在原处
+
+    Returns:
+        tuple: ((运行中日志所在服务器, 路径), (结束后日志所在服务器, 路径))
+    """
+    if job['mode'] == 'background':
+        return (job['node'], job['log_file']), (job['node'], job['log_file'])
+    return (job['node'], f"/tmp/{job['job_id']}.log"), ('server104', job['log_file'])
+
+
+def _split_complete_lines(buffer):
+    """把缓冲区拆成完整的行（含结尾换行）与剩余的不完整行"""
+    index = buffer.rfind(b'\n')
+    if index < 0:
+        return b'', buffer
+    return buffer[:index + 1], buffer[index + 1:]
+
+
+def _log_event(data, offset):
+    return format_sse(data.decode('utf-8', errors='replace').rstrip('\n'), event='log', event_id=offset)
+
+
+def stream_log_file_events(sftp, remote_path, offset):
+    """
+    从 offset 开始按块读取（seek）远程日志文件直到文件末尾，生成 log 事件；末尾不完整的行也会推送
+
+    Returns:
+        int: 读取结束后的偏移（通过 yield from 的返回值取得）
+    """
+    read_size = LOG_STREAM_CONFIG['read_size']
+    pending = b''
+    with sftp.open(remote_path, 'rb') as f:
+        f.seek(offset)
+        f.prefetch()
+        while True:
+            data = f.read(read_size)
+            if not data:
+                break
+            lines, pending = _split_complete_lines(pending + data)
+            if lines:
+                offset += len(lines)
+                yield _log_event(lines, offset)
+    if pending:
+        offset += len(pending)
+        yield _log_event(pending, offset)
+    return offset
+
+
+def stream_job_log(job_id, offset=None, tail_lines=0):
+    """
+    生成任务日志的 SSE 事件流
+
+    - 任务运行中：在执行节点上用一个 SSH 通道 `tail -c +{offset+1} -F` 跟踪日志，只推送新增的完整行，
+      没有新输出时按 LOG_STREAM_CONFIG['poll_interval'] 检查任务状态、定期发送心跳注释；
+    - 任务结束后：从结束后的日志文件按偏移补齐剩余内容，最后发送 end 事件。
+
+    每个 log 事件的 id 是这些行之后的字节偏移，断线重连时带上它即可从断点继续。
+    推送期间一直占用一条连接，因此从 STREAM_SSH_POOL 借用，不占用执行任务所用的 SSH_POOL。
+
+    Args:
+        job_id: 任务ID
+        offset: 起始字节偏移（None 表示从最后 tail_lines 行开始）
+        tail_lines: offset 为 None 时先推送的行数（0 表示从头推送）
+    """
+    config = LOG_STREAM_CONFIG
+    job = JOB_REGISTRY.get(job_id)
+    ssh_client = None
+    channel = None
+    try:
+        # 后台任务在进程启动前还没有日志路径，等待它进入 running 或结束
+        while not job['log_file'] and job['status'] not in JobRegistry.TERMINAL_STATUSES:
+            yield ': waiting\n\n'
+            time.sleep(config['poll_interval'])
+            job = JOB_REGISTRY.get(job_id)
+        if not job['log_file']:
+            yield format_sse(json.dumps({'status': job['status'], 'exit_code': job['exit_code'],
+                                         'offset': offset or 0, 'error': job['error']}, ensure_ascii=False),
+                             event='end')
+            return
 
-        def sftp_rmtree(sftp, remote_path):
-            """递归删除远程目录（如果不存在则忽略）"""
-            try:
-                for entry in sftp.listdir_attr(remote_path):
-                    name = entry.filename
-                    if name in ('.', '..'):
-                        continue
-                    full = f"{remote_path.rstrip('/')}/{name}"
-                    if stat.S_ISDIR(entry.st_mode):
-                        sftp_rmtree(sftp, full)
-                    else:
-                        sftp.remove(full)
-                sftp.rmdir(remote_path)
-            except IOError:
-                return
+        (live_server, live_path), (final_server, final_path) = get_job_log_sources(job)
 
-        def sftp_copy_dir(src_sftp, src, dst_sftp, dst):
-            logger.info(f"[copy_folder_remote_to_remote] 复制目录: {src} -> {dst}")
-            sftp_mkdir_p(dst_sftp, dst)
-            for entry in src_sftp.listdir_attr(src):
-                name = entry.filename
-                if name in ('.', '..'):
+        if job['status'] not in JobRegistry.TERMINAL_STATUSES:
+            ssh_client = STREAM_SSH_POOL.acquire(live_server)
+            if offset is None:
+                offset = sftp_tail_offset(STREAM_SSH_POOL.open_sftp(ssh_client), live_path, tail_lines)
+            channel = ssh_client.get_transport().open_session()
+            channel.settimeout(config['poll_interval'])
+            channel.exec_command(f'tail -c +{offset + 1} -F {shlex.quote(live_path)} 2>/dev/null')
+            pending = b''
+            last_sent = time.time()
+            while True:
+                try:
+                    data = channel.recv(config['read_size'])
+                except socket.timeout:
+                    data = None
+                if data:
+                    lines, pending = _split_complete_lines(pending + data)
+                    if lines:
+                        offset += len(lines)
+                        last_sent = time.time()
+                        yield _log_event(lines, offset)
                     continue
-                src_item = f"{src.rstrip('/')}/{name}"
-                dst_item = f"{dst.rstrip('/')}/{name}"
-                if stat.S_ISDIR(entry.st_mode):
-                    sftp_copy_dir(src_sftp, src_item, dst_sftp, dst_item)
-                else:
-                    logger.info(f"[copy_folder_remote_to_remote] 复制文件: {src_item} -> {dst_item}")
-                    parent = '/'.join(dst_item.rstrip('/').split('/')[:-1])
-                    sftp_mkdir_p(dst_sftp, parent)
-                    with src_sftp.open(src_item, 'rb') as f_src, dst_sftp.open(dst_item, 'wb') as f_dst:
-                        while True:
-                            chunk = f_src.read(32768)
-                            if not chunk:
-                                break
-                            f_dst.write(chunk)
-
-        logger.info(f"[copy_folder_remote_to_remote] 清理目标目录（如果存在）: {target_path_clean}")
-        sftp_rmtree(sftp_target, target_path_clean)
-
-        # 执行复制
-        sftp_copy_dir(sftp_source, source_path_clean, sftp_target, target_path_clean)
+                if data == b'':
+                    break  # tail 已退出
+                job = refresh_background_job(JOB_REGISTRY.get(job_id), ssh_client)
+                # 同步/异步任务进入 archiving 时日志已完整写入 server104，不必再跟踪
+                if job['status'] in JobRegistry.TERMINAL_STATUSES or job['status'] == 'archiving':
+                    break
+                if time.time() - last_sent >= config['keepalive_interval']:
+                    last_sent = time.time()
+                    yield ': keepalive\n\n'
+            # 不完整的行留给下面从结束后的日志文件补齐
+            channel.close()
+            channel = None
 
-        # 校验目标目录
-        list_cmd = f'ls -la "{target_path_clean}" 2>&1'
-        logger.info(f"[copy_folder_remote_to_remote] 目标目录校验命令: {list_cmd}")
-        ok, out, err = execute_ssh_command(ssh_target, list_cmd, use_sudo=False)
-        debug_info = out if ok else err
+        if ssh_client is not None and live_server != final_server:
+            STREAM_SSH_POOL.release(ssh_client)
+            ssh_client = None
+        if ssh_client is None:
+            ssh_client = STREAM_SSH_POOL.acquire(final_server)
+        sftp = STREAM_SSH_POOL.open_sftp(ssh_client)
+        if offset is None:
+            offset = sftp_tail_offset(sftp, final_path, tail_lines)
+        try:
+            offset = yield from stream_log_file_events(sftp, final_path, offset)
+        except IOError as e:
+            logger.warning(f"[stream_job_log] 读取日志失败 {final_server}:{final_path}: {str(e)}")
 
-        return True, (
-            f"文件夹传输成功: {source_host}:{source_path} -> {target_host}:{target_path}\n"
-            f"目标目录内容:\n{debug_info}"
-        )
-    
-    except paramiko.AuthenticationException:
-        return False, f"SSH认证失败: 用户名或密码错误"
-    except paramiko.SSHException as e:
-        return False, f"SSH连接错误: {str(e)}"
+        # 等待归档等收尾步骤完成，end 事件带上最终状态
+        job = refresh_background_job(JOB_REGISTRY.get(job_id), ssh_client if job['node'] == final_server else None)
+        while job['status'] not in JobRegistry.TERMINAL_STATUSES:
+            yield ': keepalive\n\n'
+            time.sleep(config['poll_interval'])
+            job = refresh_background_job(JOB_REGISTRY.get(job_id),
+                                         ssh_client if job['node'] == final_server else None)
+        yield format_sse(json.dumps({'status': job['status'], 'exit_code': job['exit_code'],
+                                     'offset': offset, 'error': job['error']}, ensure_ascii=False),
+                         event='end')
     except Exception as e:
-        logger.error(f"传输过程出错: {str(e)}", exc_info=True)
-        return False, f"传输过程出错: {str(e)}"
-    
+        logger.error(f"[stream_job_log] 推送任务 {job_id} 日志出错: {str(e)}", exc_info=True)
+        yield format_sse(str(e), event='error')
     finally:
-        # 安全关闭连接
-        if sftp_source:
-            try:
-                sftp_source.close()
-            except Exception as e:
-                logger.warning(f"关闭源SFTP失败: {str(e)}")
-        if sftp_target:
-            try:
-                sftp_target.close()
-            except Exception as e:
-                logger.warning(f"关闭目标SFTP失败: {str(e)}")
-        if ssh_source:
-            try:
-                ssh_source.close()
-            except Exception as e:
-                logger.warning(f"关闭源SSH连接失败: {str(e)}")
-        if ssh_target:
-            try:
-                ssh_target.close()
-            except Exception as e:
-                logger.warning(f"关闭目标SSH连接失败: {str(e)}")
+        if channel is not None:
+            channel.close()
+        STREAM_SSH_POOL.release(ssh_client)
+
 
 def copy_multiple_remote_to_remote(source_host, source_port, source_user, source_password, source_paths,
-                                   target_host, target_port, target_user, target_password, target_path):
+                                   target_host, target_port, target_user, target_password, target_path,
+                                   channels=None, direct=False):
     """
     从源服务器复制多个文件或目录到目标服务器的指定目录
     
@@ -403,6 +4262,8 @@ def copy_multiple_remote_to_remote(source_host, source_port, source_user, source
         target_user: 目标服务器用户名
         target_password: 目标服务器密码
         target_path: 目标目录路径（如果存在则先清空，不存在则创建）
+        channels: 并行 SFTP 通道数，None 时按 PARALLEL_TRANSFER_CONFIG 配置
+        direct: 为 True 时先尝试让源节点直接推送到目标节点，失败的路径回退到经 server103 中转
     
     Returns:
         tuple: (success: bool, message: str, details: list)
@@ -419,31 +4280,13 @@ def copy_multiple_remote_to_remote(source_host, source_port, source_user, source
             f"{target_user}@{target_host}:{target_port}{target_path}"
         )
         
-        # 连接源服务器
-        ssh_source = paramiko.SSHClient()
-        ssh_source.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_source.connect(
-            hostname=source_host,
-            port=source_port,
-            username=source_user,
-            password=source_password,
-            timeout=30
-        )
-        
-        # 连接目标服务器
-        ssh_target = paramiko.SSHClient()
-        ssh_target.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_target.connect(
-            hostname=target_host,
-            port=target_port,
-            username=target_user,
-            password=target_password,
-            timeout=30
-        )
+        # 从连接池借用源/目标服务器连接
+        ssh_source = SSH_POOL.acquire_for(source_host, source_port, source_user, source_password)
+        ssh_target = SSH_POOL.acquire_for(target_host, target_port, target_user, target_password)
         
         # 打开 SFTP
-        sftp_source = ssh_source.open_sftp()
-        sftp_target = ssh_target.open_sftp()
+        sftp_source = SSH_POOL.open_sftp(ssh_source)
+        sftp_target = SSH_POOL.open_sftp(ssh_target)
         
         # 统一去掉结尾的 /
         target_path_clean = target_path.rstrip('/')
@@ -528,35 +4371,7 @@ def copy_multiple_remote_to_remote(source_host, source_port, source_user, source
             if parent_dir:
                 sftp_mkdir_p(dst_sftp, parent_dir)
             
-            with src_sftp.open(src_path, 'rb') as f_src, dst_sftp.open(dst_path, 'wb') as f_dst:
-                while True:
-                    chunk = f_src.read(32768)
-                    if not chunk:
-                        break
-                    f_dst.write(chunk)
-        
-        def sftp_copy_dir(src_sftp, src, dst_sftp, dst):
-            """递归复制目录"""
-            logger.info(f"[copy_multiple_remote_to_remote] 复制目录: {src} -> {dst}")
-            sftp_mkdir_p(dst_sftp, dst)
-            for entry in src_sftp.listdir_attr(src):
-                name = entry.filename
-                if name in ('.', '..'):
-                    continue
-                src_item = f"{src.rstrip('/')}/{name}"
-                dst_item = f"{dst.rstrip('/')}/{name}"
-                if stat.S_ISDIR(entry.st_mode):
-                    sftp_copy_dir(src_sftp, src_item, dst_sftp, dst_item)
-                else:
-                    logger.info(f"[copy_multiple_remote_to_remote] 复制文件: {src_item} -> {dst_item}")
-                    parent = '/'.join(dst_item.rstrip('/').split('/')[:-1])
-                    sftp_mkdir_p(dst_sftp, parent)
-                    with src_sftp.open(src_item, 'rb') as f_src, dst_sftp.open(dst_item, 'wb') as f_dst:
-                        while True:
-                            chunk = f_src.read(32768)
-                            if not chunk:
-                                break
-                            f_dst.write(chunk)
+            sftp_copy_file_data(src_sftp, src_path, dst_sftp, dst_path)
         
         # 确保目标目录存在
         sftp_mkdir_p(sftp_target, target_path_clean)
@@ -591,10 +4406,87 @@ def copy_multiple_remote_to_remote(source_host, source_port, source_user, source
             # 目录不存在或为空，继续
             pass
         
+        def target_item_for(source_path_clean):
+            """源路径在目标目录下对应的路径（目标目录/源路径基名）"""
+            source_basename = os.path.basename(source_path_clean) if source_path_clean != '/' else ''
+            if not source_basename:
+                # 如果路径是根目录，使用路径的最后一部分
+                parts = [p for p in source_path_clean.split('/') if p]
+                source_basename = parts[-1] if parts else 'root'
+            return f"{target_path_clean}/{source_basename}"
+
+        def parallel_copy_dir(src, dst):
+            """先建好目录树，再把目录下的文件分发到多个 SFTP 通道并行复制"""
+            logger.info(f"[copy_multiple_remote_to_remote] 复制目录: {src} -> {dst}")
+            dirs, file_pairs = sftp_walk_files(sftp_source, src, dst)
+            for d in dirs:
+                sftp_mkdir_p(sftp_target, d)
+            return parallel_sftp_copy(
+                source_host, source_port, source_user, source_password,
+                target_host, target_port, target_user, target_password,
+                file_pairs, channels=channels
+            )
+
+        # 节点间可直连时，由源节点把每个路径直接推送到目标目录下，推送失败的路径再走中转
+        parallel_file_results = {}
+        path = None
+        if direct:
+            path = probe_direct_path(ssh_source, source_host, source_port, source_user, source_password,
+                                     target_host, target_port, target_user, target_password)
+            if not path:
+                logger.info("[copy_multiple_remote_to_remote] 节点间无法直连，回退到经 server103 中转")
+        if path:
+            for source_path in source_paths:
+                source_path_clean = source_path.rstrip('/')
+                try:
+                    is_dir = stat.S_ISDIR(sftp_source.stat(source_path_clean).st_mode)
+                except IOError:
+                    continue
+                pushed, push_message = direct_push_remote_to_remote(
+                    ssh_source, source_path_clean, target_host, target_port, target_user, target_password,
+                    target_path_clean, path, replace=False
+                )
+                logger.info(f"[copy_multiple_remote_to_remote] {source_path_clean}: {push_message}")
+                if pushed:
+                    parallel_file_results[source_path_clean] = {
+                        'source': source_path_clean,
+                        'target': target_item_for(source_path_clean),
+                        'type': 'directory' if is_dir else 'file',
+                        'success': True,
+                        'message': push_message
+                    }
+
+        # 可直接访问的单个文件先一起并行复制，失败的再走下面逐个处理（含 sudo 兜底）的流程
+        direct_files = []
+        for source_path in source_paths:
+            source_path_clean = source_path.rstrip('/')
+            if source_path_clean in parallel_file_results:
+                continue
+            try:
+                if not stat.S_ISDIR(sftp_source.stat(source_path_clean).st_mode):
+                    direct_files.append((source_path_clean, target_item_for(source_path_clean)))
+            except IOError:
+                continue
+        for r in parallel_sftp_copy(source_host, source_port, source_user, source_password,
+                                    target_host, target_port, target_user, target_password,
+                                    direct_files, channels=channels):
+            if r['success']:
+                parallel_file_results[r['source']] = r
+
         # 处理每个源路径
         results = []
         for source_path in source_paths:
             source_path_clean = source_path.rstrip('/')
+            if source_path_clean in parallel_file_results:
+                r = parallel_file_results[source_path_clean]
+                results.append({
+                    'source': r['source'],
+                    'target': r['target'],
+                    'type': r['type'],
+                    'success': True,
+                    'message': r['message']
+                })
+                continue
             
             try:
                 # 检查源路径是否存在
@@ -630,27 +4522,24 @@ def copy_multiple_remote_to_remote(source_host, source_port, source_user, source
                         else:
                             raise IOError(f"源路径不存在或无法访问: {source_path_clean}")
                 
-                # 获取源路径的基名（文件名或目录名）
-                source_basename = os.path.basename(source_path_clean) if source_path_clean != '/' else ''
-                if not source_basename:
-                    # 如果路径是根目录，使用路径的最后一部分
-                    parts = [p for p in source_path_clean.split('/') if p]
-                    source_basename = parts[-1] if parts else 'root'
-                
-                # 构建目标路径
+                # 构建目标路径（目标目录/源路径基名）
+                target_item_path = target_item_for(source_path_clean)
                 if is_dir:
-                    target_item_path = f"{target_path_clean}/{source_basename}"
                     # 复制目录
-                    sftp_copy_dir(sftp_source, source_path_clean, sftp_target, target_item_path)
+                    file_results = parallel_copy_dir(source_path_clean, target_item_path)
+                    failed = [r for r in file_results if not r['success']]
                     results.append({
                         'source': source_path_clean,
                         'target': target_item_path,
                         'type': 'directory',
-                        'success': True,
-                        'message': f'目录传输成功'
+                        'success': not failed,
+                        'message': (
+                            f'目录传输成功（{len(file_results)} 个文件）' if not failed else
+                            f'目录传输失败: {len(failed)}/{len(file_results)} 个文件复制失败，'
+                            f'首个错误: {failed[0]["source"]}: {failed[0]["message"]}'
+                        )
                     })
                 else:
-                    target_item_path = f"{target_path_clean}/{source_basename}"
                     # 复制文件
                     try:
                         sftp_copy_file(sftp_source, source_path_clean, sftp_target, target_item_path)
@@ -862,27 +4751,9 @@ def copy_multiple_remote_to_remote(source_host, source_port, source_user, source
         return False, f"传输过程出错: {str(e)}", []
     
     finally:
-        # 安全关闭连接
-        if sftp_source:
-            try:
-                sftp_source.close()
-            except Exception as e:
-                logger.warning(f"关闭源SFTP失败: {str(e)}")
-        if sftp_target:
-            try:
-                sftp_target.close()
-            except Exception as e:
-                logger.warning(f"关闭目标SFTP失败: {str(e)}")
-        if ssh_source:
-            try:
-                ssh_source.close()
-            except Exception as e:
-                logger.warning(f"关闭源SSH连接失败: {str(e)}")
-        if ssh_target:
-            try:
-                ssh_target.close()
-            except Exception as e:
-                logger.warning(f"关闭目标SSH连接失败: {str(e)}")
+        # 归还连接（SFTP 会话由连接池缓存复用）
+        SSH_POOL.release(ssh_source)
+        SSH_POOL.release(ssh_target)
 
 
 def copy_folder_paramiko(source_path, target_host, target_port, target_user, target_password, target_path):
@@ -901,7 +4772,6 @@ def copy_folder_paramiko(source_path, target_host, target_port, target_user, tar
         tuple: (success: bool, message: str)
     """
     ssh_client = None
-    sftp_client = None
     
     try:
         # 确保源路径存在
@@ -911,18 +4781,8 @@ def copy_folder_paramiko(source_path, target_host, target_port, target_user, tar
         if not os.path.isdir(source_path):
             return False, f"源路径不是文件夹: {source_path}"
         
-        # 创建SSH客户端
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        
         logger.info(f"连接到 {target_host}:{target_port} (用户: {target_user})")
-        ssh_client.connect(
-            hostname=target_host,
-            port=target_port,
-            username=target_user,
-            password=target_password,
-            timeout=30
-        )
+        ssh_client = SSH_POOL.acquire_for(target_host, target_port, target_user, target_password)
         
         # 确保目标目录存在
         logger.info(f"确保目标目录存在: {target_path}")
@@ -930,7 +4790,7 @@ def copy_folder_paramiko(source_path, target_host, target_port, target_user, tar
             return False, f"无法创建目标目录: {target_path}"
         
         # 创建SFTP客户端
-        sftp_client = ssh_client.open_sftp()
+        sftp_client = SSH_POOL.open_sftp(ssh_client)
         
         # 递归复制文件
         def copy_recursive(local_dir, remote_dir):
@@ -1005,17 +4865,8 @@ def copy_folder_paramiko(source_path, target_host, target_port, target_user, tar
         return False, f"传输过程出错: {str(e)}"
     
     finally:
-        # 关闭连接
-        if sftp_client:
-            try:
-                sftp_client.close()
-            except:
-                pass
-        if ssh_client:
-            try:
-                ssh_client.close()
-            except:
-                pass
+        # 归还连接（SFTP 会话由连接池缓存复用）
+        SSH_POOL.release(ssh_client)
 
 
 @app.route('/health', methods=['GET'])
@@ -1137,6 +4988,7 @@ def transfer_folder():
             target_password,
             target_path
         )
+        METADATA_CACHE.invalidate(target_server, target_path)
         
         if success:
             return jsonify({
@@ -1171,6 +5023,8 @@ def transfer_multiple():
         - source_paths: 源路径列表（可以是文件或目录），例如: ["/path/to/file1", "/path/to/dir1"]
         - target_server: 目标服务器名称（server101/server102/server103/server104）
         - target_path: 目标目录路径（如果存在则先清空，不存在则创建）
+        - channels: 并行 SFTP 通道数（可选，默认按 PARALLEL_TRANSFER_CONFIG 中该服务器对的配置）
+        - direct: 是否让源服务器直接推送到目标服务器（可选，默认 false），不可直连的路径回退到经 server103 中转
     
     返回:
         JSON格式的响应，包含传输结果和详细信息
@@ -1189,8 +5043,16 @@ def transfer_multiple():
         source_paths = data.get('source_paths')
         target_server = data.get('target_server')
         target_path = data.get('target_path')
+        channels = data.get('channels')
+        direct = bool(data.get('direct', False))
         
         # 参数验证
+        if channels is not None and (not isinstance(channels, int) or channels < 1):
+            return jsonify({
+                'success': False,
+                'error': 'channels 必须是正整数'
+            }), 400
+        
         if not source_server:
             return jsonify({
                 'success': False,
@@ -1254,8 +5116,11 @@ def transfer_multiple():
             target_config['port'],
             target_config['user'],
             target_config['password'],
-            target_path
+            target_path,
+            channels=channels,
+            direct=direct
         )
+        METADATA_CACHE.invalidate(target_server, target_path)
         
         if success:
             return jsonify({
@@ -1284,6 +5149,131 @@ def transfer_multiple():
         }), 500
 
 
+@app.route('/transfer/benchmark', methods=['POST'])
+def transfer_benchmark():
+    """
+    目录传输方式基准测试：用不同 transport 把同一个源目录复制到目标服务器的临时目录并计时
+
+    请求参数（JSON）:
+        - source_server: 源服务器名称
+        - source_path: 源目录
+        - target_server: 目标服务器名称
+        - target_path: 目标服务器上的临时基准目录（每种方式复制到其下的 .benchmark_{transport}）
+        - transports: 参与比较的传输方式列表（可选，默认全部: ["sftp", "tar"]）
+        - keep: 是否保留复制结果（可选，默认 false，测试后删除）
+
+    返回:
+        JSON格式的响应，包含每种方式的耗时与吞吐量
+    """
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({
+                'success': False,
+                'error': '请求体必须为JSON格式'
+            }), 400
+
+        source_server = data.get('source_server')
+        source_path = data.get('source_path')
+        target_server = data.get('target_server')
+        target_path = data.get('target_path')
+        transports = data.get('transports') or list(TRANSFER_TRANSPORTS)
+        keep = bool(data.get('keep', False))
+
+        if not all([source_server, source_path, target_server, target_path]):
+            return jsonify({
+                'success': False,
+                'error': '缺少必需参数: source_server / source_path / target_server / target_path'
+            }), 400
+
+        for server_name in (source_server, target_server):
+            if server_name not in SERVER_CONFIG:
+                return jsonify({
+                    'success': False,
+                    'error': f'无效的服务器: {server_name}。可用服务器: {", ".join(SERVER_CONFIG.keys())}'
+                }), 400
+
+        invalid = [t for t in transports if t not in TRANSFER_TRANSPORTS]
+        if invalid:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 transport: {", ".join(invalid)}。可选: {", ".join(TRANSFER_TRANSPORTS)}'
+            }), 400
+
+        source_config = SERVER_CONFIG[source_server]
+        target_config = SERVER_CONFIG[target_server]
+
+        # 统计源目录规模（一次 find）
+        ssh_source = SSH_POOL.acquire(source_server)
+        try:
+            manifest = build_remote_manifest(ssh_source, source_path)
+        finally:
+            SSH_POOL.release(ssh_source)
+        if manifest is None:
+            return jsonify({
+                'success': False,
+                'error': f'源目录不存在: {source_server}:{source_path}'
+            }), 404
+        total_files = sum(1 for e in manifest.values() if e['type'] == 'f')
+        total_bytes = sum(e['size'] for e in manifest.values() if e['type'] == 'f')
+
+        results = []
+        for transport in transports:
+            bench_path = f"{target_path.rstrip('/')}/.benchmark_{transport}"
+            started = time.time()
+            success, message = copy_folder_remote_to_remote(
+                source_config['host'],
+                source_config['port'],
+                source_config['user'],
+                source_config['password'],
+                source_path,
+                target_config['host'],
+                target_config['port'],
+                target_config['user'],
+                target_config['password'],
+                bench_path,
+                transport=transport
+            )
+            elapsed = time.time() - started
+            results.append({
+                'transport': transport,
+                'success': success,
+                'elapsed': round(elapsed, 3),
+                'throughput_mb_s': round(total_bytes / 1024 / 1024 / elapsed, 2) if success and elapsed > 0 else None,
+                'target': bench_path,
+                'message': message if not success else '复制成功'
+            })
+
+            if not keep:
+                ssh_target = SSH_POOL.acquire(target_server)
+                try:
+                    execute_ssh_command(ssh_target, f'rm -rf "{bench_path}"', use_sudo=False)
+                finally:
+                    SSH_POOL.release(ssh_target)
+        METADATA_CACHE.invalidate(target_server, target_path)
+
+        succeeded = [r for r in results if r['success']]
+        fastest = min(succeeded, key=lambda r: r['elapsed'])['transport'] if succeeded else None
+
+        return jsonify({
+            'success': len(succeeded) == len(results),
+            'source': f'{source_server}:{source_path}',
+            'target': f'{target_server}:{target_path}',
+            'files': total_files,
+            'bytes': total_bytes,
+            'results': results,
+            'fastest': fastest
+        }), 200
+
+    except Exception as e:
+        logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
 @app.route('/servers', methods=['GET'])
 def list_servers():
     """获取可用服务器列表（不返回密码）"""
@@ -1302,17 +5292,69 @@ def list_servers():
     })
 
 
+@app.route('/ssh/pool', methods=['GET'])
+def ssh_pool_status():
+    """查看SSH连接池状态（各节点连接总数 / 空闲数 / 借出数，stream_pools 为流式接口的独立连接池）"""
+    return jsonify({
+        'success': True,
+        'config': SSH_POOL_CONFIG,
+        'pools': SSH_POOL.stats(),
+        'stream_config': STREAM_SSH_POOL_CONFIG,
+        'stream_pools': STREAM_SSH_POOL.stats()
+    })
+
+
+@app.route('/cache/metadata', methods=['GET'])
+def metadata_cache_status():
+    """查看目录列表缓存状态（条目数 / 命中 / 未命中 / 失效次数）"""
+    return jsonify({
+        'success': True,
+        'cache': METADATA_CACHE.stats()
+    })
+
+
+@app.route('/cache/metadata/invalidate', methods=['POST'])
+def invalidate_metadata_cache():
+    """
+    使某个路径的目录列表缓存失效（在服务之外修改了远程文件时使用）
+
+    请求参数（JSON）:
+        - server: 服务器名称
+        - path: 被修改的路径（该路径、其子目录与父目录的列表都会失效）
+    """
+    data = request.get_json() or {}
+    server_name = data.get('server')
+    path = data.get('path')
+    if server_name not in SERVER_CONFIG or not path:
+        return jsonify({
+            'success': False,
+            'error': '缺少或无效的参数: server / path'
+        }), 400
+    METADATA_CACHE.invalidate(server_name, path)
+    return jsonify({
+        'success': True,
+        'message': f'已使缓存失效: {server_name}:{path}'
+    })
+
+
 @app.route('/list', methods=['POST'])
 def list_files():
     """
-    列出远程服务器指定路径下的文件和文件夹
+    列出远程服务器指定路径下的文件和文件夹（SFTP 读取，分页返回）
     
     请求参数（JSON）:
         - server: 服务器名称（server101/server102/server103/server104）
         - path: 要查询的路径（默认为 /home/user）
+        - limit: 每页条目数（可选，默认 LIST_CONFIG['default_limit']，最大 LIST_CONFIG['max_limit']）
+        - cursor: 上一页返回的 next_cursor（可选，不传则从第一页开始）
+        - sort: 排序方式 name / size / mtime（可选，默认 name，目录在前）
+        - order: asc / desc（可选，默认 asc）
+        - filter: 名称过滤（可选，不区分大小写，包含 * ? [ 时按通配符匹配，否则按子串匹配）
+        - show_hidden: 是否包含隐藏文件（可选，默认 true）
+        - refresh: 是否忽略缓存重新读取（可选，默认 false）
     
     返回:
-        JSON格式的响应，包含文件列表
+        JSON格式的响应，包含本页文件列表（size / mtime 为数值）、total（过滤后的总数）与 next_cursor
     """
     try:
         data = request.get_json()
@@ -1325,6 +5367,12 @@ def list_files():
         
         server_name = data.get('server')
         path = data.get('path', '/home')
+        sort = data.get('sort') or 'name'
+        order = data.get('order') or 'asc'
+        name_filter = data.get('filter') or None
+        show_hidden = bool(data.get('show_hidden', True))
+        cursor = data.get('cursor') or None
+        limit = data.get('limit', LIST_CONFIG['default_limit'])
         
         # 参数验证
         if not server_name:
@@ -1340,131 +5388,122 @@ def list_files():
                 'error': f'无效的服务器: {server_name}。可用服务器: {", ".join(SERVER_CONFIG.keys())}'
             }), 400
         
-        # 获取服务器配置
-        server_config = SERVER_CONFIG[server_name]
-        target_host = server_config['host']
-        target_port = server_config['port']
-        target_user = server_config['user']
-        target_password = server_config['password']
-        
-        ssh_client = None
-        try:
-            # 创建SSH客户端
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
-            logger.info(f"连接到 {target_host}:{target_port} (用户: {target_user})")
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
-            
-            # 执行 ls -la 命令获取详细信息
-            # 使用 -a 显示所有文件（包括隐藏文件），-l 显示详细信息
-            ls_cmd = f'ls -la "{path}" 2>&1'
-            success, stdout, stderr = execute_ssh_command(ssh_client, ls_cmd, use_sudo=False)
-            
-            if not success:
-                # 如果普通用户没有权限，尝试使用sudo
-                logger.warning(f"普通用户无权限，尝试使用sudo: {path}")
-                success, stdout, stderr = execute_ssh_command(ssh_client, ls_cmd, use_sudo=True)
-            
-            if not success:
-                return jsonify({
-                    'success': False,
-                    'error': f'无法访问路径: {path}。错误: {stderr}',
-                    'server': server_name,
-                    'path': path
-                }), 404
-            
-            # 解析 ls -la 输出
-            files = []
-            lines = stdout.strip().split('\n')
-            
-            # 跳过第一行（total X）和空行
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith('total'):
-                    continue
-                
-                # 解析 ls -la 格式: permissions links owner group size date time name
-                parts = line.split(None, 8)  # 最多分割8次，保留文件名（可能包含空格）
-                
-                if len(parts) >= 9:
-                    permissions = parts[0]
-                    links = parts[1]
-                    owner = parts[2]
-                    group = parts[3]
-                    size = parts[4]
-                    date = parts[5]
-                    time = parts[6]
-                    name = parts[8]  # 文件名（可能包含空格）
-                    
-                    # 判断是文件还是目录
-                    is_dir = permissions.startswith('d')
-                    is_link = permissions.startswith('l')
-                    
-                    # 跳过 . 和 .. 目录
-                    if name in ['.', '..']:
-                        continue
-                    
-                    file_info = {
-                        'name': name,
-                        'type': 'directory' if is_dir else ('link' if is_link else 'file'),
-                        'permissions': permissions,
-                        'owner': owner,
-                        'group': group,
-                        'size': size,
-                        'date': f'{date} {time}',
-                        'is_hidden': name.startswith('.'),
-                        'full_path': os.path.join(path, name).replace('\\', '/')
-                    }
-                    
-                    files.append(file_info)
-            
-            # 按类型和名称排序：目录在前，然后按名称排序
-            files.sort(key=lambda x: (x['type'] != 'directory', x['name'].lower()))
-            
-            return jsonify({
-                'success': True,
-                'server': server_name,
-                'path': path,
-                'files': files,
-                'count': len(files)
-            }), 200
-        
-        except paramiko.AuthenticationException:
+        if sort not in LIST_SORTS or order not in ('asc', 'desc'):
             return jsonify({
                 'success': False,
-                'error': 'SSH认证失败: 用户名或密码错误',
-                'server': server_name
-            }), 401
-        except paramiko.SSHException as e:
+                'error': f'sort 必须为 {" / ".join(LIST_SORTS)} 之一，order 必须为 asc / desc'
+            }), 400
+        
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
             return jsonify({
                 'success': False,
-                'error': f'SSH连接错误: {str(e)}',
-                'server': server_name
-            }), 500
-        except Exception as e:
-            logger.error(f"列出文件时出错: {str(e)}", exc_info=True)
+                'error': 'limit 必须是正整数'
+            }), 400
+        limit = min(limit, LIST_CONFIG['max_limit'])
+        
+        # 整个目录的条目缓存在 METADATA_CACHE 中，翻页、排序、过滤都在缓存的条目上进行
+        listing = None if data.get('refresh') else METADATA_CACHE.get(server_name, path, 'list')
+        
+        if listing is None:
+            cache_generation = METADATA_CACHE.generation
+            server_config = SERVER_CONFIG[server_name]
+            ssh_client = None
+            try:
+                logger.info(f"连接到 {server_config['host']}:{server_config['port']} (用户: {server_config['user']})")
+                ssh_client = SSH_POOL.acquire(server_name)
+                sftp_client = SSH_POOL.open_sftp(ssh_client)
+                
+                method = 'sftp'
+                try:
+                    if not stat.S_ISDIR(sftp_client.stat(path).st_mode or 0):
+                        return jsonify({
+                            'success': False,
+                            'error': f'路径不是目录: {path}',
+                            'server': server_name,
+                            'path': path
+                        }), 400
+                    entries = sftp_list_dir(sftp_client, path)
+                except IOError as e:
+                    if getattr(e, 'errno', None) != errno.EACCES:
+                        return jsonify({
+                            'success': False,
+                            'error': f'无法访问路径: {path}。错误: {str(e)}',
+                            'server': server_name,
+                            'path': path
+                        }), 404
+                    # 如果普通用户没有权限，尝试使用sudo
+                    logger.warning(f"普通用户无权限，尝试使用sudo: {path}")
+                    method = 'sudo'
+                    success, entries = sudo_list_dir(ssh_client, path)
+                    if not success:
+                        return jsonify({
+                            'success': False,
+                            'error': f'无法访问路径: {path}。错误: {entries}',
+                            'server': server_name,
+                            'path': path
+                        }), 404
+            finally:
+                SSH_POOL.release(ssh_client)
+            
+            listing = METADATA_CACHE.put(server_name, path, 'list', {'entries': entries, 'method': method},
+                                         cache_generation)
+        
+        try:
+            page, total, next_cursor = paginate_listing(
+                listing['entries'], sort=sort, order=order, name_filter=name_filter,
+                show_hidden=show_hidden, cursor=cursor, limit=limit
+            )
+        except ValueError as e:
             return jsonify({
                 'success': False,
-                'error': f'服务器内部错误: {str(e)}',
-                'server': server_name
-            }), 500
+                'error': str(e)
+            }), 400
         
-        finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+        files = []
+        for name, mode, size, mtime, owner, group in page:
+            files.append({
+                'name': name,
+                'type': _list_entry_type(mode),
+                'permissions': stat.filemode(mode),
+                'owner': owner,
+                'group': group,
+                'size': size,
+                'mtime': mtime,
+                'date': datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M'),
+                'is_hidden': name.startswith('.'),
+                'full_path': posixpath.join(path, name)
+            })
+        
+        return jsonify({
+            'success': True,
+            'server': server_name,
+            'path': path,
+            'files': files,
+            'count': len(files),
+            'total': total,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None,
+            'sort': sort,
+            'order': order,
+            'method': listing['method'],
+            'cached': listing['cached'],
+            'cached_at': listing['cached_at']
+        }), 200
     
+    except paramiko.AuthenticationException:
+        return jsonify({
+            'success': False,
+            'error': 'SSH认证失败: 用户名或密码错误',
+            'server': data.get('server')
+        }), 401
+    except paramiko.SSHException as e:
+        return jsonify({
+            'success': False,
+            'error': f'SSH连接错误: {str(e)}',
+            'server': data.get('server')
+        }), 500
     except Exception as e:
-        logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
+        logger.error(f"列出文件时出错: {str(e)}", exc_info=True)
         return jsonify({
             'success': False,
             'error': f'服务器内部错误: {str(e)}'
@@ -1529,22 +5568,12 @@ def create_file():
         target_host = server_config['host']
         target_port = server_config['port']
         target_user = server_config['user']
-        target_password = server_config['password']
 
         ssh_client = None
-        sftp_client = None
         try:
             # 创建SSH客户端
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             logger.info(f"连接到 {target_host}:{target_port} (用户: {target_user}) 以创建文件")
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire(server_name)
 
             # 检查目录是否存在
             check_dir_cmd = f'test -d "{path}"'
@@ -1556,7 +5585,7 @@ def create_file():
                 }), 404
 
             # 通过 SFTP 写入文件
-            sftp_client = ssh_client.open_sftp()
+            sftp_client = SSH_POOL.open_sftp(ssh_client)
             remote_dir = path.rstrip('/').replace('\\', '/')
             remote_file = os.path.join(remote_dir, filename).replace('\\', '/')
 
@@ -1578,6 +5607,7 @@ def create_file():
                     'error': f'创建文件失败: {str(e)}'
                 }), 500
 
+            METADATA_CACHE.invalidate(server_name, remote_file)
             return jsonify({
                 'success': True,
                 'message': f'文件创建成功: {remote_file}',
@@ -1606,19 +5636,459 @@ def create_file():
                 'server': server_name
             }), 500
         finally:
-            if sftp_client:
+            SSH_POOL.release(ssh_client)
+
+    except Exception as e:
+        logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+@app.route('/file/upload/init', methods=['POST'])
+def init_upload():
+    """
+    开始（或继续）一次分块上传，目标为 server101 上 /home/user/{username}/projects/{projectname} 下的文件
+
+    数据先写入目标目录下的临时文件 .{文件名}.{upload_id}.upload，提交（commit）并校验 sha256 后原子改名为目标文件。
+    同一目标文件已有未完成的上传（size / sha256 一致）时直接返回该上传及其偏移量，客户端从 offset 继续即可。
+
+    请求参数（JSON）:
+        - username: 用户名
+        - projectname: 项目名
+        - path: 项目内的相对路径（例如: data/train.csv），上级目录不存在时自动创建
+        - size: 文件总大小（可选，字节，提供时写入与提交都会检查）
+        - sha256: 整个文件的 sha256（可选，也可以在 commit 时提供）
+
+    返回:
+        JSON格式的响应，包含 upload_id、offset（下一块的起始偏移）、建议的 chunk_size 与 max_chunk_size
+    """
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({
+                'success': False,
+                'error': '请求体必须为JSON格式'
+            }), 400
+
+        username = data.get('username')
+        projectname = data.get('projectname')
+        path = data.get('path')
+        size = data.get('size')
+        sha256 = (data.get('sha256') or '').lower() or None
+
+        if not username or not projectname or not path:
+            return jsonify({
+                'success': False,
+                'error': '缺少必需参数: username、projectname、path'
+            }), 400
+
+        relative = posixpath.normpath(str(path))
+        if relative in ('', '.') or relative.startswith('/') or relative.split('/')[0] == '..':
+            return jsonify({
+                'success': False,
+                'error': 'path 必须是项目目录内的相对文件路径'
+            }), 400
+
+        if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 0):
+            return jsonify({
+                'success': False,
+                'error': 'size 必须为非负整数'
+            }), 400
+
+        server_name = UPLOAD_CONFIG['server']
+        project_path = f'/home/user/{username}/projects/{projectname}'
+        target_path = f'{project_path}/{relative}'
+        target_dir, filename = target_path.rsplit('/', 1)
+
+        ssh_client = SSH_POOL.acquire(server_name)
+        try:
+            sftp_client = SSH_POOL.open_sftp(ssh_client)
+
+            # 同一目标文件未完成的上传：参数一致且临时文件还在时继续，否则作废
+            upload = UPLOAD_REGISTRY.find_active(target_path)
+            if upload:
+                offset = get_upload_offset(sftp_client, upload)
+                if offset is not None and upload['size'] == size and (not sha256 or upload['sha256'] in (None, sha256)):
+                    if sha256 and not upload['sha256']:
+                        UPLOAD_REGISTRY.update(upload['upload_id'], sha256=sha256)
+                    logger.info(f"继续未完成的上传 {upload['upload_id']}: {target_path}，已接收 {offset} 字节")
+                    return jsonify({
+                        'success': True,
+                        'resumed': True,
+                        **upload_status_payload(UPLOAD_REGISTRY.get(upload['upload_id']), offset),
+                        'chunk_size': UPLOAD_CONFIG['chunk_size'],
+                        'max_chunk_size': UPLOAD_CONFIG['max_chunk_size'],
+                    }), 200
+                if offset is not None:
+                    try:
+                        sftp_client.remove(upload['temp_path'])
+                    except IOError:
+                        pass
+                UPLOAD_REGISTRY.update(upload['upload_id'], status='aborted', error='被新的上传取代')
+
+            try:
+                is_dir = stat.S_ISDIR(sftp_client.stat(project_path).st_mode or 0)
+            except IOError:
+                is_dir = False
+            if not is_dir:
+                return jsonify({
+                    'success': False,
+                    'error': f'项目目录不存在或无法访问: {server_name}:{project_path}'
+                }), 404
+
+            if target_dir != project_path:
+                ok, err = remote_mkdirs(ssh_client, [target_dir])
+                if not ok:
+                    return jsonify({
+                        'success': False,
+                        'error': f'创建目录失败: {target_dir}。错误: {err}'
+                    }), 500
+
+            upload_id = uuid.uuid4().hex
+            temp_path = f'{target_dir}/.{filename}.{upload_id}.upload'
+            try:
+                sftp_client.open(temp_path, 'wb').close()
+            except IOError as e:
+                return jsonify({
+                    'success': False,
+                    'error': f'没有权限在该目录创建文件: {target_dir}。错误: {str(e)}'
+                }), 403
+        finally:
+            SSH_POOL.release(ssh_client)
+
+        UPLOAD_REGISTRY.create(
+            upload_id, username=username, projectname=projectname, path=relative,
+            target_path=target_path, temp_path=temp_path, size=size, sha256=sha256
+        )
+        logger.info(f"开始分块上传 {upload_id}: {server_name}:{target_path}（size={size}）")
+        return jsonify({
+            'success': True,
+            'resumed': False,
+            **upload_status_payload(UPLOAD_REGISTRY.get(upload_id), 0),
+            'chunk_size': UPLOAD_CONFIG['chunk_size'],
+            'max_chunk_size': UPLOAD_CONFIG['max_chunk_size'],
+        }), 200
+
+    except Exception as e:
+        logger.error(f"初始化上传时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+@app.route('/file/upload/<upload_id>/chunk', methods=['POST', 'PUT'])
+def upload_chunk(upload_id):
+    """
+    上传一个分块：请求体为原始字节（application/octet-stream），边读边写入 server101 上的临时文件
+
+    查询参数:
+        - offset: 该块在文件中的起始偏移，必须等于当前已接收的字节数（否则返回 409 与当前 offset）
+        - sha256: 该块的 sha256（可选），不一致时丢弃该块
+
+    写入中断或校验失败时临时文件截回 offset，已接收的字节数始终落在完整分块的边界上。
+
+    返回:
+        JSON格式的响应，offset 为下一块的起始偏移
+    """
+    try:
+        upload = UPLOAD_REGISTRY.get(upload_id)
+        if not upload:
+            return jsonify({
+                'success': False,
+                'error': f'上传不存在: {upload_id}'
+            }), 404
+        if upload['status'] != 'uploading':
+            return jsonify({
+                'success': False,
+                'error': f"上传已结束（{upload['status']}），不能继续写入"
+            }), 409
+
+        try:
+            offset = int(request.args.get('offset', ''))
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': '缺少必需参数: offset（整数）'
+            }), 400
+        chunk_sha256 = (request.args.get('sha256') or '').lower() or None
+        max_chunk_size = UPLOAD_CONFIG['max_chunk_size']
+        if request.content_length is not None and request.content_length > max_chunk_size:
+            return jsonify({
+                'success': False,
+                'error': f'分块过大: {request.content_length} 字节，上限 {max_chunk_size}'
+            }), 413
+
+        lock = _UPLOAD_LOCKS.setdefault(upload_id, threading.Lock())
+        if not lock.acquire(blocking=False):
+            return jsonify({
+                'success': False,
+                'error': '该上传正在写入另一个分块'
+            }), 409
+        ssh_client = None
+        try:
+            ssh_client = SSH_POOL.acquire(UPLOAD_CONFIG['server'])
+            sftp_client = SSH_POOL.open_sftp(ssh_client)
+            current = get_upload_offset(sftp_client, upload)
+            if current is None:
+                UPLOAD_REGISTRY.update(upload_id, status='aborted', error='临时文件已不存在')
+                return jsonify({
+                    'success': False,
+                    'error': '临时文件已不存在，请重新开始上传'
+                }), 410
+            if offset != current:
+                return jsonify({
+                    'success': False,
+                    'error': f'offset 不连续: 当前已接收 {current} 字节',
+                    'offset': current
+                }), 409
+
+            digest = hashlib.sha256()
+            written = 0
+            error = None
+            with sftp_client.open(upload['temp_path'], 'r+b') as f:
+                f.set_pipelined(True)
+                f.seek(offset)
                 try:
-                    sftp_client.close()
-                except:
-                    pass
-            if ssh_client:
+                    while True:
+                        block = request.stream.read(UPLOAD_CONFIG['write_block'])
+                        if not block:
+                            break
+                        written += len(block)
+                        if written > max_chunk_size:
+                            error = (413, f'分块过大: 超过上限 {max_chunk_size} 字节')
+                            break
+                        if upload['size'] is not None and offset + written > upload['size']:
+                            error = (400, f"写入超出文件大小: {upload['size']} 字节")
+                            break
+                        digest.update(block)
+                        f.write(block)
+                    if not error and chunk_sha256 and digest.hexdigest() != chunk_sha256:
+                        error = (400, f'分块 sha256 校验失败: 期望 {chunk_sha256}，实际 {digest.hexdigest()}')
+                except Exception as e:
+                    error = (500, f'写入分块失败: {str(e)}')
+                if error:
+                    f.flush()
+                    f.truncate(offset)
+            if error:
+                logger.warning(f"上传 {upload_id} 的分块（offset={offset}）已丢弃: {error[1]}")
+                return jsonify({
+                    'success': False,
+                    'error': error[1],
+                    'offset': offset
+                }), error[0]
+
+            UPLOAD_REGISTRY.update(upload_id, received=offset + written)
+            return jsonify({
+                'success': True,
+                'upload_id': upload_id,
+                'chunk_size': written,
+                'offset': offset + written,
+                'size': upload['size']
+            }), 200
+        finally:
+            SSH_POOL.release(ssh_client)
+            lock.release()
+
+    except Exception as e:
+        logger.error(f"上传分块时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+@app.route('/file/upload/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """
+    查询上传状态，offset 为 server101 上临时文件的实际大小（中断后从这里继续上传）
+    """
+    try:
+        upload = UPLOAD_REGISTRY.get(upload_id)
+        if not upload:
+            return jsonify({
+                'success': False,
+                'error': f'上传不存在: {upload_id}'
+            }), 404
+        offset = None
+        if upload['status'] == 'uploading':
+            ssh_client = SSH_POOL.acquire(UPLOAD_CONFIG['server'])
+            try:
+                offset = get_upload_offset(SSH_POOL.open_sftp(ssh_client), upload)
+            finally:
+                SSH_POOL.release(ssh_client)
+            if offset is None:
+                UPLOAD_REGISTRY.update(upload_id, status='aborted', error='临时文件已不存在')
+                upload = UPLOAD_REGISTRY.get(upload_id)
+            elif offset != upload['received']:
+                UPLOAD_REGISTRY.update(upload_id, received=offset)
+        return jsonify({
+            'success': True,
+            **upload_status_payload(upload, offset),
+            'error': upload['error']
+        }), 200
+
+    except Exception as e:
+        logger.error(f"查询上传状态时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+@app.route('/file/upload/<upload_id>/commit', methods=['POST'])
+def commit_upload(upload_id):
+    """
+    完成上传：在 server101 上计算临时文件的 sha256 并与期望值比对，一致后原子改名为目标文件（覆盖已有文件）
+
+    请求参数（JSON，可选）:
+        - sha256: 整个文件的 sha256（init 时已提供则可省略）
+
+    校验失败时保留临时文件与上传状态，可以重新提交正确的 sha256 或调用 abort 放弃；
+    已提交的上传再次 commit 直接返回成功（便于客户端在响应丢失后重试）。
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        upload = UPLOAD_REGISTRY.get(upload_id)
+        if not upload:
+            return jsonify({
+                'success': False,
+                'error': f'上传不存在: {upload_id}'
+            }), 404
+        if upload['status'] == 'committed':
+            return jsonify({
+                'success': True,
+                'message': f"文件已上传: {upload['target_path']}",
+                **upload_status_payload(upload),
+                'sha256': upload['sha256']
+            }), 200
+        if upload['status'] != 'uploading':
+            return jsonify({
+                'success': False,
+                'error': f"上传已结束（{upload['status']}），不能提交"
+            }), 409
+
+        expected = (data.get('sha256') or upload['sha256'] or '').lower()
+        if not expected:
+            return jsonify({
+                'success': False,
+                'error': '缺少必需参数: sha256（init 或 commit 时提供）'
+            }), 400
+
+        lock = _UPLOAD_LOCKS.setdefault(upload_id, threading.Lock())
+        if not lock.acquire(blocking=False):
+            return jsonify({
+                'success': False,
+                'error': '该上传正在写入分块，请稍后提交'
+            }), 409
+        ssh_client = None
+        try:
+            ssh_client = SSH_POOL.acquire(UPLOAD_CONFIG['server'])
+            sftp_client = SSH_POOL.open_sftp(ssh_client)
+            received = get_upload_offset(sftp_client, upload)
+            if received is None:
+                UPLOAD_REGISTRY.update(upload_id, status='aborted', error='临时文件已不存在')
+                return jsonify({
+                    'success': False,
+                    'error': '临时文件已不存在，请重新开始上传'
+                }), 410
+            if upload['size'] is not None and received != upload['size']:
+                return jsonify({
+                    'success': False,
+                    'error': f"文件未上传完整: 已接收 {received} / {upload['size']} 字节",
+                    'offset': received
+                }), 409
+
+            success, stdout, stderr = execute_ssh_command(
+                ssh_client, f"sha256sum {shlex.quote(upload['temp_path'])}", use_sudo=False
+            )
+            if not success or not stdout.strip():
+                return jsonify({
+                    'success': False,
+                    'error': f'计算 sha256 失败: {stderr}'
+                }), 500
+            actual = stdout.split()[0]
+            if actual != expected:
+                UPLOAD_REGISTRY.update(upload_id, error=f'sha256 校验失败: {actual}')
+                return jsonify({
+                    'success': False,
+                    'error': f'sha256 校验失败: 期望 {expected}，实际 {actual}',
+                    'offset': received
+                }), 400
+
+            try:
+                sftp_client.posix_rename(upload['temp_path'], upload['target_path'])
+            except IOError:
+                # 服务端不支持 posix-rename 扩展时，先删后改名
                 try:
-                    ssh_client.close()
-                except:
+                    sftp_client.remove(upload['target_path'])
+                except IOError:
                     pass
+                sftp_client.rename(upload['temp_path'], upload['target_path'])
+        finally:
+            SSH_POOL.release(ssh_client)
+            lock.release()
+
+        UPLOAD_REGISTRY.update(upload_id, status='committed', sha256=actual, received=received, error=None,
+                               committed_at=JobRegistry._now())
+        _UPLOAD_LOCKS.pop(upload_id, None)
+        METADATA_CACHE.invalidate(UPLOAD_CONFIG['server'], upload['target_path'])
+        logger.info(f"上传 {upload_id} 完成: {upload['target_path']}（{received} 字节，sha256={actual}）")
+        return jsonify({
+            'success': True,
+            'message': f"文件上传成功: {upload['target_path']}",
+            **upload_status_payload(UPLOAD_REGISTRY.get(upload_id)),
+            'sha256': actual
+        }), 200
 
     except Exception as e:
-        logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
+        logger.error(f"提交上传时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+@app.route('/file/upload/<upload_id>/abort', methods=['POST'])
+def abort_upload(upload_id):
+    """
+    放弃上传并删除 server101 上的临时文件
+    """
+    try:
+        upload = UPLOAD_REGISTRY.get(upload_id)
+        if not upload:
+            return jsonify({
+                'success': False,
+                'error': f'上传不存在: {upload_id}'
+            }), 404
+        if upload['status'] == 'committed':
+            return jsonify({
+                'success': False,
+                'error': '上传已提交，不能放弃'
+            }), 409
+
+        lock = _UPLOAD_LOCKS.setdefault(upload_id, threading.Lock())
+        with lock:
+            ssh_client = SSH_POOL.acquire(UPLOAD_CONFIG['server'])
+            try:
+                SSH_POOL.open_sftp(ssh_client).remove(upload['temp_path'])
+            except IOError:
+                pass
+            finally:
+                SSH_POOL.release(ssh_client)
+            UPLOAD_REGISTRY.update(upload_id, status='aborted', error='已放弃')
+        _UPLOAD_LOCKS.pop(upload_id, None)
+        return jsonify({
+            'success': True,
+            'message': f'已放弃上传: {upload_id}',
+            'upload_id': upload_id
+        }), 200
+
+    except Exception as e:
+        logger.error(f"放弃上传时出错: {str(e)}", exc_info=True)
         return jsonify({
             'success': False,
             'error': f'服务器内部错误: {str(e)}'
@@ -1633,6 +6103,10 @@ def create_venv():
     请求参数（JSON）:
         - env_name: 环境名称
         - username: 用户名（默认为 'user'）
+        - clone_mode: 克隆方式（可选，默认 auto）：auto 依次尝试 reflink / 硬链接 / 复制，copy 总是完整复制基线环境
+        - use_pool: 是否优先从预热环境池取用（可选，默认 true，仅 auto 方式）
+        - requirements: 依赖列表（可选，requirements.txt 内容或字符串数组）：给出时不克隆独立环境，
+          而是把环境链接到与解析后依赖集合对应的只读共享环境（不存在时先构建）
     
     返回:
         JSON格式的响应
@@ -1661,30 +6135,37 @@ def create_venv():
                 'error': '缺少必需参数: username'
             }), 400
         
+        clone_mode = data.get('clone_mode') or 'auto'
+        if clone_mode not in ENV_CLONE_MODES:
+            return jsonify({
+                'success': False,
+                'error': f'clone_mode 必须为 {" / ".join(ENV_CLONE_MODES)} 之一'
+            }), 400
+        use_pool = bool(data.get('use_pool', True))
+        requirements = data.get('requirements')
+        if isinstance(requirements, list):
+            if not all(isinstance(line, str) for line in requirements):
+                return jsonify({
+                    'success': False,
+                    'error': 'requirements 必须为字符串或字符串数组'
+                }), 400
+            requirements = '\n'.join(requirements)
+        elif requirements is not None and not isinstance(requirements, str):
+            return jsonify({
+                'success': False,
+                'error': 'requirements 必须为字符串或字符串数组'
+            }), 400
+        
         # 目标服务器是 server102
         # Server102: /home/user/{username}/envs/envname
-        server_config = SERVER_CONFIG['server102']
-        target_host = server_config['host']
-        target_port = server_config['port']
-        target_user = server_config['user']
-        target_password = server_config['password']
-        
         # 环境路径
         envs_path = f'/home/user/{username}/envs'
         env_path = f'{envs_path}/{env_name}'
-        base_venv_path = '/home/user/common/basevenv/venv'
+        base_venv_path = ENV_CLONE_CONFIG['base_venv_path']
         
         ssh_client = None
         try:
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire('server102')
             
             # 确保 envs 目录存在
             mkdir_envs_cmd = f'mkdir -p "{envs_path}"'
@@ -1701,6 +6182,34 @@ def create_venv():
                     'error': f'虚拟环境 {env_name} 已存在'
                 }), 400
             
+            # 指定了依赖：链接到对应的共享环境，相同依赖集合的环境只构建一次
+            if requirements is not None:
+                success, shared, shared_message = ensure_shared_env(ssh_client, requirements)
+                if not success:
+                    return jsonify({
+                        'success': False,
+                        'error': f'创建虚拟环境失败: {shared_message}',
+                        'path': env_path
+                    }), 500
+                link_cmd = f'ln -s {shlex.quote(shared["path"])} {shlex.quote(env_path)}'
+                success, _, stderr = execute_ssh_command(ssh_client, link_cmd, use_sudo=False)
+                if not success:
+                    success, _, stderr = execute_ssh_command(ssh_client, link_cmd, use_sudo=True)
+                if not success:
+                    return jsonify({
+                        'success': False,
+                        'error': f'链接共享环境失败: {stderr}',
+                        'path': env_path
+                    }), 500
+                return jsonify({
+                    'success': True,
+                    'message': f'虚拟环境 {env_name} 创建成功（共享环境 {shared["env_key"][:12]}）',
+                    'path': env_path,
+                    'clone_method': 'shared',
+                    'shared_env': shared,
+                    'output': shared_message
+                }), 200
+            
             # 创建环境目录
             mkdir_cmd = f'mkdir -p "{env_path}"'
             success, _, stderr = execute_ssh_command(ssh_client, mkdir_cmd, use_sudo=False)
@@ -1722,24 +6231,37 @@ def create_venv():
                     'error': f'基础虚拟环境不存在: {base_venv_path}，请先在10.2准备好基线venv'
                 }), 500
             
-            # 从基础虚拟环境拷贝一份到目标目录并改名
-            copy_cmd = f'cp -a "{base_venv_path}/." "{env_path}/"'
-            success, stdout, stderr = execute_ssh_command(ssh_client, copy_cmd, use_sudo=True)
-            print("------------------创建虚拟环境(基线拷贝)----------")
-            print(success, stdout, stderr)
-            print(copy_cmd)
+            # 优先从预热环境池取出一个现成的环境 rename 过来，池为空时再直接克隆
+            if use_pool and clone_mode == 'auto':
+                pooled, pool_message = ENV_POOL.take(ssh_client, env_path)
+                if pooled:
+                    return jsonify({
+                        'success': True,
+                        'message': f'虚拟环境 {env_name} 创建成功（预热环境池）',
+                        'path': env_path,
+                        'clone_method': 'pool',
+                        'output': pool_message
+                    }), 200
+                logger.info(f"[env_create] {pool_message}，直接从基线克隆: {env_path}")
+
+            # 从基础虚拟环境克隆一份到目标目录（reflink / 硬链接 / 复制）
+            success, clone_method, clone_message = clone_base_venv(ssh_client, env_path, clone_mode=clone_mode)
 
             if success:
                 return jsonify({
                     'success': True,
-                    'message': f'虚拟环境 {env_name} 创建成功（基线拷贝）',
+                    'message': f'虚拟环境 {env_name} 创建成功（基线克隆: {clone_method}）',
                     'path': env_path,
-                    'output': stdout
+                    'clone_method': clone_method,
+                    'output': clone_message
                 }), 200
             else:
+                logger.error(f"[env_create] {clone_message}: {env_path}")
+                # 克隆失败时清理半成品目录，避免下次创建时被判定为已存在
+                execute_ssh_command(ssh_client, f'rm -rf {shlex.quote(env_path)}', use_sudo=True)
                 return jsonify({
                     'success': False,
-                    'error': f'创建虚拟环境失败: {stderr or stdout}',
+                    'error': f'创建虚拟环境失败: {clone_message}',
                     'path': env_path
                 }), 500
         
@@ -1751,11 +6273,8 @@ def create_venv():
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
+            METADATA_CACHE.invalidate('server102', env_path)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -1765,6 +6284,12 @@ def create_venv():
         }), 500
 
 
+@app.route('/env/pool', methods=['GET'])
+def env_pool_status():
+    """查看预热虚拟环境池的状态"""
+    return jsonify({'success': True, 'pool': ENV_POOL.stats()}), 200
+
+
 @app.route('/env/list', methods=['POST'])
 def list_venvs():
     """
@@ -1772,6 +6297,7 @@ def list_venvs():
     
     请求参数（JSON）:
         - username: 用户名（默认为 'user'）
+        - refresh: 是否忽略缓存重新读取（可选，默认 false）
     
     返回:
         JSON格式的响应，包含环境列表
@@ -1788,65 +6314,49 @@ def list_venvs():
             }), 400
         
         # Server102: /home/user/{username}/envs/envname
-        server_config = SERVER_CONFIG['server102']
-        target_host = server_config['host']
-        target_port = server_config['port']
-        target_user = server_config['user']
-        target_password = server_config['password']
-        
         envs_path = f'/home/user/{username}/envs'
         
+        cached = None if data.get('refresh') else METADATA_CACHE.get('server102', envs_path, 'envs')
+        if cached is not None:
+            return jsonify(cached), 200
+        cache_generation = METADATA_CACHE.generation
+        
         ssh_client = None
         try:
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire('server102')
             
-            # 列出目录
-            list_cmd = f'ls -la "{envs_path}" 2>&1'
-            success, stdout, stderr = execute_ssh_command(ssh_client, list_cmd, use_sudo=False)
+            # 列出目录：一次远程调用取得所有条目、是否为虚拟环境以及符号链接指向
+            success, entries = probe_remote_entries(
+                ssh_client, envs_path,
+                probes={'is_venv': '[ -f "$f/bin/activate" ] || [ -f "$f/Scripts/activate" ]'}
+            )
             
             if not success:
                 return jsonify({
                     'success': False,
-                    'error': f'无法访问路径: {envs_path}。错误: {stderr}',
+                    'error': f'无法访问路径: {envs_path}。错误: {entries}',
                     'envs': []
                 }), 404
             
-            # 解析输出
+            # 指向共享环境存储的符号链接：环境名 -> 共享环境
+            store_prefix = ENV_STORE_CONFIG['root'].rstrip('/') + '/'
             envs = []
-            lines = stdout.strip().split('\n')
-            
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith('total') or line.startswith('d') and '.' in line[:10]:
-                    continue
-                
-                parts = line.split(None, 8)
-                if len(parts) >= 9:
-                    name = parts[8]
-                    if name not in ['.', '..']:
-                        # 检查是否是虚拟环境（包含 bin/activate 或 Scripts/activate）
-                        check_venv_cmd = f'test -f "{envs_path}/{name}/bin/activate" || test -f "{envs_path}/{name}/Scripts/activate"'
-                        is_venv, _, _ = execute_ssh_command(ssh_client, check_venv_cmd, use_sudo=False)
-                        
-                        envs.append({
-                            'name': name,
-                            'path': f'{envs_path}/{name}',
-                            'is_venv': is_venv
-                        })
+            for entry in entries:
+                target = entry['link_target']
+                shared_env = target[len(store_prefix):] if target and target.startswith(store_prefix) else None
+                envs.append({
+                    'name': entry['name'],
+                    'path': f'{envs_path}/{entry["name"]}',
+                    'is_venv': entry['is_venv'],
+                    'shared_env': shared_env,  # 链接到的共享环境哈希，独立环境为 None
+                    'shared_path': target if shared_env else None
+                })
             
-            return jsonify({
+            return jsonify(METADATA_CACHE.put('server102', envs_path, 'envs', {
                 'success': True,
                 'envs': envs,
                 'count': len(envs)
-            }), 200
+            }, cache_generation)), 200
         
         except Exception as e:
             logger.error(f"列出虚拟环境时出错: {str(e)}", exc_info=True)
@@ -1857,11 +6367,7 @@ def list_venvs():
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -1909,25 +6415,11 @@ def delete_venv():
             }), 400
         
         # Server102: /home/user/{username}/envs/envname
-        server_config = SERVER_CONFIG['server102']
-        target_host = server_config['host']
-        target_port = server_config['port']
-        target_user = server_config['user']
-        target_password = server_config['password']
-        
         env_path = f'/home/user/{username}/envs/{env_name}'
         
         ssh_client = None
         try:
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire('server102')
             
             # 删除目录
             delete_cmd = f'rm -rf "{env_path}"'
@@ -1955,11 +6447,8 @@ def delete_venv():
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
+            METADATA_CACHE.invalidate('server102', env_path)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -2007,23 +6496,9 @@ def execute_command():
                 'error': '缺少必需参数: username'
             }), 400
         
-        server_config = SERVER_CONFIG['server102']
-        target_host = server_config['host']
-        target_port = server_config['port']
-        target_user = server_config['user']
-        target_password = server_config['password']
-        
         ssh_client = None
         try:
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire('server102')
             
             # 构建命令
             if env_name:
@@ -2066,11 +6541,7 @@ def execute_command():
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -2090,6 +6561,14 @@ def execute_project():
         - projectname: 项目名称
         - env_name: 虚拟环境名称（必需）
         - command: 要执行的命令（如: python xxx.py）
+        - sync_mode: 项目同步方式（可选）：delta 增量同步（默认）/ full 清空后全量复制
+        - sync_checksum: 增量同步时是否用 sha256 判断文件变化（可选，默认 false，按大小+修改时间判断）
+        - transport: 目录传输方式（可选）：sftp 逐文件复制（默认）/ tar 源端打包流式解包到目标端
+        - direct: 是否让节点间直接传输（可选，默认 false）：server101 直接推送到 server102、server102 直接推送到 server104，不可直连时回退到经 server103 中转
+        - archive_mode: 归档方式（可选，默认 RUN_ARCHIVE_CONFIG['default_mode']）：full 复制整个运行目录 / changed 只传输本次运行新增或修改的文件，未改动的文件在快照文件中引用源项目 / dedup 内容寻址存储，只上传 server104 上还没有的文件内容
+        - requirements_cache: 是否使用依赖安装缓存（可选，默认 true）：requirements.txt 与虚拟环境都未变化时跳过 pip install
+        - sync_ignore: 附加的忽略规则（可选，字符串数组或多行字符串，语法同 .syncignore），追加在项目 .syncignore 之后，可用 !pattern 重新包含；项目同步与归档都跳过被忽略的文件
+        - use_syncignore: 是否读取 server101 项目根目录下的 .syncignore（可选，默认 true）
     
     返回:
         JSON格式的响应，包含命令输出
@@ -2107,6 +6586,20 @@ def execute_project():
         projectname = data.get('projectname')
         env_name = data.get('env_name')
         command = data.get('command')
+        # 同步方式：delta 增量同步（默认），full 清空后全量复制
+        sync_mode = data.get('sync_mode', 'delta')
+        sync_checksum = bool(data.get('sync_checksum', False))
+        # 目录传输方式：sftp 逐文件（默认）/ tar 单个数据流
+        transport = data.get('transport', 'sftp')
+        # 节点间直连传输（不经 server103 中转），不可用时自动回退
+        direct = bool(data.get('direct', False))
+        # 依赖安装缓存：requirements.txt 与虚拟环境未变化时跳过 pip install
+        requirements_cache = bool(data.get('requirements_cache', True))
+        # 归档方式：full 整个运行目录 / changed 只归档本次运行新增或修改的文件 / dedup 内容寻址去重存储
+        archive_mode = data.get('archive_mode', RUN_ARCHIVE_CONFIG['default_mode'])
+        # 忽略规则：server101 项目下的 .syncignore 加上请求中附加的规则
+        sync_ignore_patterns = parse_sync_ignore_patterns(data.get('sync_ignore'))
+        use_syncignore = bool(data.get('use_syncignore', True))
         # 固定使用 server102 执行，忽略传入的 server 参数
         # 项目代码从 server101 拷贝到 server102 执行
         server = 'server102'
@@ -2136,17 +6629,35 @@ def execute_project():
                 'error': '缺少必需参数: command'
             }), 400
 
+        if transport not in TRANSFER_TRANSPORTS:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 transport: {transport}。可选: {", ".join(TRANSFER_TRANSPORTS)}',
+                'stdout': '',
+                'stderr': ''
+            }), 400
+
+        if archive_mode not in ARCHIVE_MODES:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 archive_mode: {archive_mode}。可选: {", ".join(ARCHIVE_MODES)}'
+            }), 400
+
+        if sync_ignore_patterns is None:
+            return jsonify({
+                'success': False,
+                'error': 'sync_ignore 必须是字符串数组或多行字符串'
+            }), 400
+
         # 统一约定：
         # - 项目代码源在 10.1（server101）：/home/user/{username}/projects/{projectname}
         # - 执行与虚拟环境在 10.2（server102）：
-        #     - 项目执行目录：/home/user/{username}/projects/{projectname}
+        #     - 共享项目副本：/home/user/{username}/projects/{projectname}（每次同步的目标）
+        #     - 本次运行目录：/home/user/{username}/runs/{projectname}/{run_id}（从共享副本创建，执行与归档都在这里）
         #     - 虚拟环境目录：/home/user/{username}/envs/{env_name}
         server101_config = SERVER_CONFIG['server101']
         server102_config = SERVER_CONFIG['server102']
-        target_host = server102_config['host']
-        target_port = server102_config['port']
         target_user = server102_config['user']
-        target_password = server102_config['password']
 
         # 构建路径：源项目在 server101，目标项目在 server102
         project_path_source = f'/home/user/{username}/projects/{projectname}'
@@ -2154,20 +6665,15 @@ def execute_project():
         env_path = f'/home/user/{username}/envs/{env_name}'
         
         ssh_client = None
+        run_id = None
         try:
             # 先检查 server101 上项目是否存在
-            ssh_server101 = paramiko.SSHClient()
-            ssh_server101.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_server101.connect(
-                hostname=server101_config['host'],
-                port=server101_config['port'],
-                username=server101_config['user'],
-                password=server101_config['password'],
-                timeout=30
-            )
-            check_project_cmd = f'test -d "{project_path_source}"'
-            exists, _, _ = execute_ssh_command(ssh_server101, check_project_cmd, use_sudo=False)
-            ssh_server101.close()
+            ssh_server101 = SSH_POOL.acquire('server101')
+            try:
+                check_project_cmd = f'test -d "{project_path_source}"'
+                exists, _, _ = execute_ssh_command(ssh_server101, check_project_cmd, use_sudo=False)
+            finally:
+                SSH_POOL.release(ssh_server101)
             if not exists:
                 return jsonify({
                     'success': False,
@@ -2182,91 +6688,87 @@ def execute_project():
                 f"{server101_config['host']}:{project_path_source} "
                 f"-> {server102_config['host']}:{project_path}"
             )
-            copy_success, copy_message = copy_folder_remote_to_remote(
-                server101_config['host'],
-                server101_config['port'],
-                server101_config['user'],
-                server101_config['password'],
-                project_path_source,
-                server102_config['host'],
-                server102_config['port'],
-                server102_config['user'],
-                server102_config['password'],
-                project_path
-            )
-            if not copy_success:
-                return jsonify({
-                    'success': False,
-                    'error': f'从 server101 同步项目到 server102 失败: {copy_message}',
-                    'stdout': '',
-                    'stderr': ''
-                }), 500
+            # 本次运行ID（例如 run_20251222_101517_3fa2c1）：server102 上的运行目录、Server104 上的归档目录都按它命名
+            run_id = new_run_id()
+            run_dir = get_run_workdir(username, projectname, run_id)
+            sync_ignore = load_sync_ignore(project_path_source, sync_ignore_patterns, use_syncignore)
+            JOB_REGISTRY.create(run_id, 'sync', username, projectname, env_name, command, run_dir=run_dir,
+                                archive_mode=archive_mode, sync_ignore=json.dumps(sync_ignore.patterns, ensure_ascii=False))
+            JOB_REGISTRY.set_status(run_id, 'syncing')
+            with get_project_sync_lock(project_path):
+                copy_success, copy_message, sync_stats = sync_project_to_server102(
+                    project_path_source,
+                    project_path,
+                    sync_mode=sync_mode,
+                    checksum=sync_checksum,
+                    transport=transport,
+                    direct=direct,
+                    ignore=sync_ignore
+                )
+                if not copy_success:
+                    fail_job(run_id, f'项目同步失败: {copy_message}')
+                    return jsonify({
+                        'success': False,
+                        'error': f'从 server101 同步项目到 server102 失败: {copy_message}',
+                        'stdout': '',
+                        'stderr': ''
+                    }), 500
 
-            # 连接执行服务器 server102
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
-            
-            # 检查虚拟环境是否存在
-            check_env_cmd = f'test -f "{env_path}/bin/activate"'
-            success, _, _ = execute_ssh_command(ssh_client, check_env_cmd, use_sudo=False)
-            if not success:
+                # 连接执行服务器 server102
+                ssh_client = SSH_POOL.acquire('server102')
+
+                # 检查虚拟环境是否存在
+                check_env_cmd = f'test -f "{env_path}/bin/activate"'
+                success, _, _ = execute_ssh_command(ssh_client, check_env_cmd, use_sudo=False)
+                if not success:
+                    fail_job(run_id, f'虚拟环境不存在: {env_name}')
+                    return jsonify({
+                        'success': False,
+                        'error': f'虚拟环境不存在: {env_name}',
+                        'stdout': '',
+                        'stderr': ''
+                    }), 404
+
+                # 从共享项目副本创建本次运行的独立工作目录，同一项目的多次运行互不干扰
+                workdir_success, workdir_method, workdir_message = create_run_workdir(
+                    ssh_client, project_path, run_dir
+                )
+            if not workdir_success:
+                fail_job(run_id, workdir_message)
                 return jsonify({
                     'success': False,
-                    'error': f'虚拟环境不存在: {env_name}',
+                    'error': workdir_message,
                     'stdout': '',
                     'stderr': ''
-                }), 404
+                }), 500
+            if archive_mode == 'changed':
+                record_run_manifest(ssh_client, run_dir)
             
             # 在Server104创建log文件路径
             output_path = f'/home/user/{username}/outputs/{projectname}'
-            log_file = f'{output_path}/run_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-            # 本次运行名（例如 run_20251222_101517），用于在Server104上为每次执行单独建目录
-            run_name = os.path.splitext(os.path.basename(log_file))[0]
-            run_output_path = f'{output_path}/{run_name}'
+            log_file = f'{output_path}/{run_id}.log'
+            run_output_path = f'{output_path}/{run_id}'
             
             # 确保Server104的输出目录存在
             server104_config = SERVER_CONFIG['server104']
             ssh_server104 = None
             try:
-                ssh_server104 = paramiko.SSHClient()
-                ssh_server104.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh_server104.connect(
-                    hostname=server104_config['host'],
-                    port=server104_config['port'],
-                    username=server104_config['user'],
-                    password=server104_config['password'],
-                    timeout=30
-                )
+                ssh_server104 = SSH_POOL.acquire('server104')
                 # 创建输出目录（项目输出根目录，按项目聚合）
                 mkdir_cmd = f'mkdir -p "{output_path}"'
                 execute_ssh_command(ssh_server104, mkdir_cmd, use_sudo=False)
             except Exception as e:
                 logger.warning(f"无法创建Server104输出目录: {str(e)}")
             finally:
-                if ssh_server104:
-                    try:
-                        ssh_server104.close()
-                    except:
-                        pass
+                SSH_POOL.release(ssh_server104)
             
             # 构建命令：激活虚拟环境，若有 requirements.txt 则先安装依赖，再执行命令并将输出写入临时log文件
             # 然后传输到Server104
-            temp_log = f'/tmp/run_{datetime.now().strftime("%Y%m%d_%H%M%S")}_{os.getpid()}.log'
-            pip_cmd = (
-                f'if [ -f "requirements.txt" ]; then '
-                f'pip install -r requirements.txt --index-url http://192.168.140.202:8087/simple/ --trusted-host 192.168.140.202; '
-                f'fi'
-            )
+            temp_log = f'/tmp/{run_id}.log'
+            pip_cmd = build_pip_install_cmd(env_path, use_cache=requirements_cache)
             # 先用 sudo 修正输出目录权限（作用于项目目录下的 output）
             fix_output_cmd = (
-                f'bash -lc \'cd "{project_path}" && '
+                f'bash -lc \'cd "{run_dir}" && '
                 f'mkdir -p output && chmod -R 775 output && '
                 f'chown -R {target_user}:{target_user} output\''
             )
@@ -2274,11 +6776,11 @@ def execute_project():
 
             ensure_output_cmd = 'mkdir -p output && chmod -R 775 output || true'
             full_command = (
-                f'cd "{project_path}" && '
+                f'cd "{run_dir}" && '
                 f'{ensure_output_cmd} && '
                 f'source "{env_path}/bin/activate" && '
                 f'{pip_cmd} && '
-                f'({command} 2>&1 | tee "{temp_log}")'
+                f'{build_project_run_cmd(command, temp_log)}'
             )
             print("------------------执行项目算法----------")
             print(pip_cmd)
@@ -2287,50 +6789,21 @@ def execute_project():
             logger.info(f"执行项目算法: 项目={projectname}, 环境={env_name}, 命令={command}, log={log_file}")
             
             # 执行命令（不再使用 sudo，避免工作目录丢失导致 python 在 /home/user 下找脚本）
-            success, stdout, stderr = execute_ssh_command(ssh_client, full_command, use_sudo=False)
-            
-            # 读取临时log文件内容
-            log_content = stdout + (stderr if stderr else '')
-            try:
-                sftp_client = ssh_client.open_sftp()
-                try:
-                    # 尝试读取临时log文件（如果存在）
-                    with sftp_client.open(temp_log, 'r') as f:
-                        log_content = f.read().decode('utf-8', errors='ignore')
-                except IOError:
-                    # 如果文件不存在，使用stdout/stderr
-                    pass
-                finally:
-                    sftp_client.close()
-            except Exception as e:
-                logger.warning(f"读取临时log文件失败: {str(e)}")
+            # 命令输出直接写入临时log文件，运行期间由 LogShipper 按批追加到 Server104
+            JOB_REGISTRY.set_status(run_id, 'running', log_file=log_file)
+            log_shipper = LogShipper(server, temp_log, 'server104', log_file).start()
+            exit_code, stdout, stderr = execute_ssh_command_with_code(
+                ssh_client, full_command, use_sudo=False, timeout=None
+            )
+            success = exit_code == 0
+            requirements = parse_requirements_cache(stdout)
+            JOB_REGISTRY.update(run_id, exit_code=exit_code, run_finished_at=JOB_REGISTRY._now(),
+                                requirements_cache=requirements['status'],
+                                requirements_install_seconds=requirements['install_seconds'],
+                                requirements_saved_seconds=requirements['saved_seconds'])
             
-            # 保存log到Server104
-            if log_content:
-                try:
-                    ssh_server104 = paramiko.SSHClient()
-                    ssh_server104.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh_server104.connect(
-                        hostname=server104_config['host'],
-                        port=server104_config['port'],
-                        username=server104_config['user'],
-                        password=server104_config['password'],
-                        timeout=30
-                    )
-                    sftp_server104 = ssh_server104.open_sftp()
-                    try:
-                        # 确保目录存在
-                        mkdir_cmd = f'mkdir -p "{output_path}"'
-                        execute_ssh_command(ssh_server104, mkdir_cmd, use_sudo=False)
-                        
-                        # 写入log文件
-                        with sftp_server104.open(log_file, 'w') as f:
-                            f.write(log_content)
-                    finally:
-                        sftp_server104.close()
-                        ssh_server104.close()
-                except Exception as e:
-                    logger.warning(f"保存log文件到Server104失败: {str(e)}")
+            # 搬运剩余的日志；命令未能启动（没有临时log文件）时把 stdout/stderr 作为log保存
+            log_stats = log_shipper.finish(fallback_text=stdout + (stderr if stderr else ''))
             
             # 清理临时文件
             try:
@@ -2339,76 +6812,72 @@ def execute_project():
             except:
                 pass
             
-            # 执行完成后，将整个项目目录传输到Server104的outputs目录，按运行名归档：output/项目名/运行名/
+            # 执行完成后，将本次运行目录传输到Server104的outputs目录，按运行ID归档：output/项目名/运行ID/
             # Server104的outputs目录等同于其他服务器的projects目录
             logger.info(
-                f"开始传输项目到Server104: {server102_config['host']}:{project_path} "
+                f"开始传输项目到Server104: {server102_config['host']}:{run_dir} "
                 f"-> {server104_config['host']}:{run_output_path}"
             )
             
+            JOB_REGISTRY.set_status(run_id, 'archiving')
+            archive_stats = None
             try:
-                # 使用远程到远程复制函数传输整个项目目录
-                copy_success, copy_message = copy_folder_remote_to_remote(
-                    server102_config['host'],      # 源服务器（执行服务器 server102）
-                    server102_config['port'],
-                    server102_config['user'],
-                    server102_config['password'],
-                    project_path,               # 源路径
-                    server104_config['host'],   # 目标服务器（Server104）
-                    server104_config['port'],
-                    server104_config['user'],
-                    server104_config['password'],
-                    run_output_path             # 目标路径（按运行名的子目录）
+                # 按 archive_mode 归档本次运行目录（full 整个目录 / changed 只传输新增或修改的文件）
+                copy_success, copy_message, archive_stats = archive_run_to_server104(
+                    run_dir,
+                    run_output_path,
+                    archive_mode=archive_mode,
+                    transport=transport,
+                    direct=direct,
+                    source={'server': 'server101', 'path': project_path_source, 'synced_copy': f'server102:{project_path}'},
+                    username=username,
+                    projectname=projectname,
+                    ignore=sync_ignore
                 )
                 
                 if copy_success:
                     logger.info(f"项目传输成功: {copy_message}")
+                    remove_run_workdir(ssh_client, run_dir)
                 else:
                     logger.warning(f"项目传输失败: {copy_message}")
             except Exception as e:
                 logger.error(f"传输项目到Server104时出错: {str(e)}", exc_info=True)
+                copy_success, copy_message = False, f'传输项目到Server104时出错: {str(e)}'
             
-            # 确保log文件也保存在项目目录中
-            if log_content:
-                try:
-                    ssh_server104 = paramiko.SSHClient()
-                    ssh_server104.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    ssh_server104.connect(
-                        hostname=server104_config['host'],
-                        port=server104_config['port'],
-                        username=server104_config['user'],
-                        password=server104_config['password'],
-                        timeout=30
-                    )
-                    sftp_server104 = ssh_server104.open_sftp()
-                    try:
-                        # 确保目录存在（项目传输后应该已存在）
-                        mkdir_cmd = f'mkdir -p "{output_path}"'
-                        execute_ssh_command(ssh_server104, mkdir_cmd, use_sudo=False)
-                        
-                        # 写入log文件到项目目录中
-                        with sftp_server104.open(log_file, 'w') as f:
-                            f.write(log_content)
-                    finally:
-                        sftp_server104.close()
-                        ssh_server104.close()
-                except Exception as e:
-                    logger.warning(f"保存log文件到Server104失败: {str(e)}")
+            if success and copy_success:
+                JOB_REGISTRY.set_status(run_id, 'completed', archive_path=run_output_path, error=None)
+            else:
+                JOB_REGISTRY.set_status(
+                    run_id, 'failed',
+                    archive_path=run_output_path if copy_success else None,
+                    error=f'命令退出码: {exit_code}' if not success else f'归档失败: {copy_message}'
+                )
             
             return jsonify({
                 'success': success,
-                'stdout': stdout,
+                'job_id': run_id,
+                'exit_code': exit_code,
+                'stdout': stdout + log_shipper.tail_text() if log_shipper.source_seen else stdout,
                 'stderr': stderr,
+                'log_bytes': log_stats['bytes'],
+                'log_truncated': log_stats['truncated'],
                 'command': command,
                 'project': projectname,
                 'env_name': env_name,
                 'project_path': project_path,
+                'run_id': run_id,
+                'run_dir': run_dir,
+                'workdir_method': workdir_method,
                 'env_path': env_path,
                 'log_file': log_file,
                 'output_path': output_path,
                 'run_output_path': run_output_path,
                 'copy_success': copy_success,
                 'copy_message': copy_message,
+                'archive_stats': archive_stats,
+                'sync_stats': sync_stats,
+                'sync_ignore': sync_ignore.patterns,
+                'requirements_cache': requirements,
                 'message': (
                     f'项目已在Server104创建输出目录: {output_path}，'
                     f'并尝试将项目复制到: {run_output_path}'
@@ -2416,6 +6885,7 @@ def execute_project():
             }), 200
         
         except paramiko.AuthenticationException:
+            fail_job(run_id, 'SSH认证失败: 用户名或密码错误')
             return jsonify({
                 'success': False,
                 'error': 'SSH认证失败: 用户名或密码错误',
@@ -2423,6 +6893,7 @@ def execute_project():
                 'stderr': ''
             }), 401
         except paramiko.SSHException as e:
+            fail_job(run_id, f'SSH连接错误: {str(e)}')
             return jsonify({
                 'success': False,
                 'error': f'SSH连接错误: {str(e)}',
@@ -2431,6 +6902,7 @@ def execute_project():
             }), 500
         except Exception as e:
             logger.error(f"执行项目算法时出错: {str(e)}", exc_info=True)
+            fail_job(run_id, f'服务器内部错误: {str(e)}')
             return jsonify({
                 'success': False,
                 'error': f'服务器内部错误: {str(e)}',
@@ -2439,11 +6911,7 @@ def execute_project():
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -2463,6 +6931,14 @@ def execute_project_background():
         - projectname: 项目名称
         - env_name: 虚拟环境名称（必需）
         - command: 要执行的命令（如: python xxx.py）
+        - sync_mode: 项目同步方式（可选）：delta 增量同步（默认）/ full 清空后全量复制
+        - sync_checksum: 增量同步时是否用 sha256 判断文件变化（可选，默认 false，按大小+修改时间判断）
+        - transport: 目录传输方式（可选）：sftp 逐文件复制（默认）/ tar 源端打包流式解包到目标端
+        - direct: 是否让节点间直接传输（可选，默认 false）：server101 直接推送到 server102、server102 直接推送到 server104，不可直连时回退到经 server103 中转
+        - archive_mode: 归档方式（可选，默认 RUN_ARCHIVE_CONFIG['default_mode']）：full 复制整个运行目录 / changed 只传输本次运行新增或修改的文件，未改动的文件在快照文件中引用源项目 / dedup 内容寻址存储，只上传 server104 上还没有的文件内容
+        - requirements_cache: 是否使用依赖安装缓存（可选，默认 true）：requirements.txt 与虚拟环境都未变化时跳过 pip install
+        - sync_ignore: 附加的忽略规则（可选，字符串数组或多行字符串，语法同 .syncignore），追加在项目 .syncignore 之后，可用 !pattern 重新包含；项目同步与归档都跳过被忽略的文件
+        - use_syncignore: 是否读取 server101 项目根目录下的 .syncignore（可选，默认 true）
     
     返回:
         JSON格式的响应，包含进程ID和执行状态
@@ -2480,6 +6956,20 @@ def execute_project_background():
         projectname = data.get('projectname')
         env_name = data.get('env_name')
         command = data.get('command')
+        # 同步方式：delta 增量同步（默认），full 清空后全量复制
+        sync_mode = data.get('sync_mode', 'delta')
+        sync_checksum = bool(data.get('sync_checksum', False))
+        # 目录传输方式：sftp 逐文件（默认）/ tar 单个数据流
+        transport = data.get('transport', 'sftp')
+        # 节点间直连传输（不经 server103 中转），不可用时自动回退
+        direct = bool(data.get('direct', False))
+        # 依赖安装缓存：requirements.txt 与虚拟环境未变化时跳过 pip install
+        requirements_cache = bool(data.get('requirements_cache', True))
+        # 归档方式：full 整个运行目录 / changed 只归档本次运行新增或修改的文件 / dedup 内容寻址去重存储
+        archive_mode = data.get('archive_mode', RUN_ARCHIVE_CONFIG['default_mode'])
+        # 忽略规则：server101 项目下的 .syncignore 加上请求中附加的规则
+        sync_ignore_patterns = parse_sync_ignore_patterns(data.get('sync_ignore'))
+        use_syncignore = bool(data.get('use_syncignore', True))
         
         # 参数验证
         if not username:
@@ -2506,15 +6996,31 @@ def execute_project_background():
                 'error': '缺少必需参数: command'
             }), 400
 
+        if transport not in TRANSFER_TRANSPORTS:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 transport: {transport}。可选: {", ".join(TRANSFER_TRANSPORTS)}',
+                'pid': None
+            }), 400
+
+        if archive_mode not in ARCHIVE_MODES:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 archive_mode: {archive_mode}。可选: {", ".join(ARCHIVE_MODES)}'
+            }), 400
+
+        if sync_ignore_patterns is None:
+            return jsonify({
+                'success': False,
+                'error': 'sync_ignore 必须是字符串数组或多行字符串'
+            }), 400
+
         # 统一约定：
         # - 项目代码源在 10.1（server101）：/home/user/{username}/projects/{projectname}
         # - 执行与虚拟环境在 10.2（server102）
         server101_config = SERVER_CONFIG['server101']
         server102_config = SERVER_CONFIG['server102']
-        target_host = server102_config['host']
-        target_port = server102_config['port']
         target_user = server102_config['user']
-        target_password = server102_config['password']
 
         # 构建路径
         project_path_source = f'/home/user/{username}/projects/{projectname}'
@@ -2522,20 +7028,15 @@ def execute_project_background():
         env_path = f'/home/user/{username}/envs/{env_name}'
         
         ssh_client = None
+        run_id = None
         try:
             # 先检查 server101 上项目是否存在
-            ssh_server101 = paramiko.SSHClient()
-            ssh_server101.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_server101.connect(
-                hostname=server101_config['host'],
-                port=server101_config['port'],
-                username=server101_config['user'],
-                password=server101_config['password'],
-                timeout=30
-            )
-            check_project_cmd = f'test -d "{project_path_source}"'
-            exists, _, _ = execute_ssh_command(ssh_server101, check_project_cmd, use_sudo=False)
-            ssh_server101.close()
+            ssh_server101 = SSH_POOL.acquire('server101')
+            try:
+                check_project_cmd = f'test -d "{project_path_source}"'
+                exists, _, _ = execute_ssh_command(ssh_server101, check_project_cmd, use_sudo=False)
+            finally:
+                SSH_POOL.release(ssh_server101)
             if not exists:
                 return jsonify({
                     'success': False,
@@ -2549,49 +7050,62 @@ def execute_project_background():
                 f"{server101_config['host']}:{project_path_source} "
                 f"-> {server102_config['host']}:{project_path}"
             )
-            copy_success, copy_message = copy_folder_remote_to_remote(
-                server101_config['host'],
-                server101_config['port'],
-                server101_config['user'],
-                server101_config['password'],
-                project_path_source,
-                server102_config['host'],
-                server102_config['port'],
-                server102_config['user'],
-                server102_config['password'],
-                project_path
-            )
-            if not copy_success:
-                return jsonify({
-                    'success': False,
-                    'error': f'从 server101 同步项目到 server102 失败: {copy_message}',
-                    'pid': None
-                }), 500
+            # 本次运行ID与 server102 上的独立运行目录
+            run_id = new_run_id()
+            run_dir = get_run_workdir(username, projectname, run_id)
+            sync_ignore = load_sync_ignore(project_path_source, sync_ignore_patterns, use_syncignore)
+            JOB_REGISTRY.create(run_id, 'background', username, projectname, env_name, command, run_dir=run_dir,
+                                archive_mode=archive_mode, sync_ignore=json.dumps(sync_ignore.patterns, ensure_ascii=False))
+            JOB_REGISTRY.set_status(run_id, 'syncing')
+            with get_project_sync_lock(project_path):
+                copy_success, copy_message, sync_stats = sync_project_to_server102(
+                    project_path_source,
+                    project_path,
+                    sync_mode=sync_mode,
+                    checksum=sync_checksum,
+                    transport=transport,
+                    direct=direct,
+                    ignore=sync_ignore
+                )
+                if not copy_success:
+                    fail_job(run_id, f'项目同步失败: {copy_message}')
+                    return jsonify({
+                        'success': False,
+                        'error': f'从 server101 同步项目到 server102 失败: {copy_message}',
+                        'pid': None
+                    }), 500
 
-            # 连接执行服务器 server102
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
-            
-            # 检查虚拟环境是否存在
-            check_env_cmd = f'test -f "{env_path}/bin/activate"'
-            success, _, _ = execute_ssh_command(ssh_client, check_env_cmd, use_sudo=False)
-            if not success:
+                # 连接执行服务器 server102
+                ssh_client = SSH_POOL.acquire('server102')
+
+                # 检查虚拟环境是否存在
+                check_env_cmd = f'test -f "{env_path}/bin/activate"'
+                success, _, _ = execute_ssh_command(ssh_client, check_env_cmd, use_sudo=False)
+                if not success:
+                    fail_job(run_id, f'虚拟环境不存在: {env_name}')
+                    return jsonify({
+                        'success': False,
+                        'error': f'虚拟环境不存在: {env_name}',
+                        'pid': None
+                    }), 404
+
+                # 从共享项目副本创建本次运行的独立工作目录
+                workdir_success, workdir_method, workdir_message = create_run_workdir(
+                    ssh_client, project_path, run_dir
+                )
+            if not workdir_success:
+                fail_job(run_id, workdir_message)
                 return jsonify({
                     'success': False,
-                    'error': f'虚拟环境不存在: {env_name}',
+                    'error': workdir_message,
                     'pid': None
-                }), 404
+                }), 500
+            if archive_mode == 'changed':
+                record_run_manifest(ssh_client, run_dir)
             
             # 先用 sudo 修正输出目录权限
             fix_output_cmd = (
-                f'bash -lc \'cd "{project_path}" && '
+                f'bash -lc \'cd "{run_dir}" && '
                 f'mkdir -p output && chmod -R 775 output && '
                 f'chown -R {target_user}:{target_user} output\''
             )
@@ -2610,10 +7124,13 @@ def execute_project_background():
 MY_PID=$$
 LOG_FILE="/tmp/{projectname}_$MY_PID.log"
 
-# 将PID写入临时文件，方便外部读取（在重定向之前）
-PID_FILE="/tmp/{projectname}_pid_$MY_PID.tmp"
+# 将PID写入临时文件，方便外部读取（在重定向之前）；文件名带运行ID，并发启动时不会读错
+PID_FILE="/tmp/{projectname}_pid_{run_id}.tmp"
 echo "$MY_PID" > "$PID_FILE"
 
+# 记录本次运行目录，任务完成后 /task/check_and_copy 据此归档
+echo "{run_dir}" > "/tmp/{projectname}_$MY_PID.workdir"
+
 # 将输出重定向到日志文件（包括标准输出和标准错误）
 # 使用 exec 确保所有后续命令的输出都写入日志文件
 exec > "$LOG_FILE" 2>&1
@@ -2622,21 +7139,25 @@ exec > "$LOG_FILE" 2>&1
 echo "=== 任务开始执行 ==="
 echo "PID: $MY_PID"
 echo "日志文件: $LOG_FILE"
+echo "运行目录: {run_dir}"
 echo "时间: $(date)"
 echo ""
 
-cd "{project_path}"
+cd "{run_dir}"
 {ensure_output_cmd}
 source "{env_path}/bin/activate"
 if [ -f "requirements.txt" ]; then
     echo "安装依赖..."
-    pip install -r requirements.txt --index-url http://192.168.140.202:8087/simple/ --trusted-host 192.168.140.202
-    echo ""
 fi
+{build_pip_install_cmd(env_path, use_cache=requirements_cache)}
+echo ""
 echo "执行命令: {command}"
 echo ""
-{command}
+# 在子 shell 中执行，命令自身调用 exit 时也能记录退出码
+({command})
 EXIT_CODE=$?
+# 退出码写到运行目录旁，server103 据此更新任务状态（运行目录归档后会被删除）
+echo "$EXIT_CODE" > "{run_dir}.exitcode"
 echo ""
 echo "=== 任务执行完成 ==="
 echo "退出码: $EXIT_CODE"
@@ -2689,6 +7210,7 @@ exit $EXIT_CODE
                         pid = None
             
             if not pid:
+                fail_job(run_id, '无法获取进程ID，进程可能启动失败')
                 return jsonify({
                     'success': False,
                     'error': '无法获取进程ID，进程可能启动失败',
@@ -2701,7 +7223,7 @@ exit $EXIT_CODE
             
             # 尝试从PID文件中读取脚本的实际PID（脚本内部使用 $$ 获取的PID）
             # 查找所有匹配的PID文件
-            find_pid_file_cmd = f'ls -t /tmp/{projectname}_pid_*.tmp 2>/dev/null | head -1'
+            find_pid_file_cmd = f'ls -t /tmp/{projectname}_pid_{run_id}.tmp 2>/dev/null | head -1'
             pid_file_success, pid_file_stdout, _ = execute_ssh_command(ssh_client, find_pid_file_cmd, use_sudo=False)
             if pid_file_success and pid_file_stdout.strip():
                 pid_file_path = pid_file_stdout.strip()
@@ -2746,26 +7268,35 @@ exit $EXIT_CODE
                     logger.warning(f"[background] 日志文件可能尚未创建: {log_file}，将在稍后创建")
             
             logger.info(f"[background] 后台进程已启动，PID: {pid}, 日志文件: {log_file}")
+            JOB_REGISTRY.set_status(run_id, 'running', pid=pid, log_file=log_file)
             
             return jsonify({
                 'success': True,
+                'job_id': run_id,
                 'pid': pid,
                 'log_file': log_file,
                 'project': projectname,
                 'env_name': env_name,
                 'command': command,
                 'project_path': project_path,
+                'run_id': run_id,
+                'run_dir': run_dir,
+                'workdir_method': workdir_method,
                 'env_path': env_path,
+                'sync_stats': sync_stats,
+                'sync_ignore': sync_ignore.patterns,
                 'message': f'后台进程已启动，进程ID: {pid}'
             }), 200
         
         except paramiko.AuthenticationException:
+            fail_job(run_id, 'SSH认证失败: 用户名或密码错误')
             return jsonify({
                 'success': False,
                 'error': 'SSH认证失败: 用户名或密码错误',
                 'pid': None
             }), 401
         except paramiko.SSHException as e:
+            fail_job(run_id, f'SSH连接错误: {str(e)}')
             return jsonify({
                 'success': False,
                 'error': f'SSH连接错误: {str(e)}',
@@ -2773,6 +7304,7 @@ exit $EXIT_CODE
             }), 500
         except Exception as e:
             logger.error(f"执行项目算法时出错: {str(e)}", exc_info=True)
+            fail_job(run_id, f'服务器内部错误: {str(e)}')
             return jsonify({
                 'success': False,
                 'error': f'服务器内部错误: {str(e)}',
@@ -2780,11 +7312,7 @@ exit $EXIT_CODE
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -2806,9 +7334,20 @@ def execute_project_async():
         - env_name: 虚拟环境名称（必需）
         - command: 要执行的命令
         - server: 执行服务器（默认为 server102）
+        - sync_mode: 项目同步方式（可选）：delta 增量同步（默认）/ full 清空后全量复制
+        - sync_checksum: 增量同步时是否用 sha256 判断文件变化（可选，默认 false）
+        - transport: 目录传输方式（可选）：sftp 逐文件复制（默认）/ tar 源端打包流式解包到目标端
+        - direct: 是否让节点间直接传输（可选，默认 false）：server101 直接推送到 server102、server102 直接推送到 server104，不可直连时回退到经 server103 中转
+        - archive_mode: 归档方式（可选，默认 RUN_ARCHIVE_CONFIG['default_mode']）：full 复制整个运行目录 / changed 只传输本次运行新增或修改的文件，未改动的文件在快照文件中引用源项目 / dedup 内容寻址存储，只上传 server104 上还没有的文件内容
+        - requirements_cache: 是否使用依赖安装缓存（可选，默认 true）：requirements.txt 与虚拟环境都未变化时跳过 pip install
+        - sync_ignore: 附加的忽略规则（可选，字符串数组或多行字符串，语法同 .syncignore），追加在项目 .syncignore 之后，可用 !pattern 重新包含；项目同步与归档都跳过被忽略的文件
+        - use_syncignore: 是否读取 server101 项目根目录下的 .syncignore（可选，默认 true）
+        - priority: 排队优先级（可选，整数，默认 0，越大越先执行）
+    
+    任务提交到 JOB_SCHEDULER 排队执行，受全局 / 单用户 / 单节点并发上限约束（见 SCHEDULER_CONFIG）。
     
     返回:
-        JSON格式的响应，包含log文件路径和执行状态
+        JSON格式的响应，包含任务ID、log文件路径、排队位置和执行状态
     """
     try:
         data = request.get_json()
@@ -2823,6 +7362,21 @@ def execute_project_async():
         projectname = data.get('projectname')
         env_name = data.get('env_name')
         command = data.get('command')
+        # 同步方式：delta 增量同步（默认），full 清空后全量复制
+        sync_mode = data.get('sync_mode', 'delta')
+        sync_checksum = bool(data.get('sync_checksum', False))
+        # 目录传输方式：sftp 逐文件（默认）/ tar 单个数据流
+        transport = data.get('transport', 'sftp')
+        # 节点间直连传输（不经 server103 中转），不可用时自动回退
+        direct = bool(data.get('direct', False))
+        # 依赖安装缓存：requirements.txt 与虚拟环境未变化时跳过 pip install
+        requirements_cache = bool(data.get('requirements_cache', True))
+        # 归档方式：full 整个运行目录 / changed 只归档本次运行新增或修改的文件 / dedup 内容寻址去重存储
+        archive_mode = data.get('archive_mode', RUN_ARCHIVE_CONFIG['default_mode'])
+        # 忽略规则：server101 项目下的 .syncignore 加上请求中附加的规则
+        sync_ignore_patterns = parse_sync_ignore_patterns(data.get('sync_ignore'))
+        use_syncignore = bool(data.get('use_syncignore', True))
+        priority = data.get('priority', 0)
         # 固定使用 server102 执行，忽略传入的 server 参数
         # 项目代码从 server101 拷贝到 server102 执行
         server = 'server102'
@@ -2833,13 +7387,41 @@ def execute_project_async():
                 'success': False,
                 'error': '缺少必需参数'
             }), 400
+
+        if transport not in TRANSFER_TRANSPORTS:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 transport: {transport}。可选: {", ".join(TRANSFER_TRANSPORTS)}'
+            }), 400
+
+        if archive_mode not in ARCHIVE_MODES:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 archive_mode: {archive_mode}。可选: {", ".join(ARCHIVE_MODES)}'
+            }), 400
+
+        if sync_ignore_patterns is None:
+            return jsonify({
+                'success': False,
+                'error': 'sync_ignore 必须是字符串数组或多行字符串'
+            }), 400
+
+        if not isinstance(priority, int):
+            return jsonify({
+                'success': False,
+                'error': 'priority 必须是整数'
+            }), 400
         
         # 在Server104创建log文件路径
         output_path = f'/home/user/{username}/outputs/{projectname}'
-        log_file = f'{output_path}/run_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-        # 本次运行名（例如 run_20251222_101517），用于在Server104上为每次执行单独建目录
-        run_name = os.path.splitext(os.path.basename(log_file))[0]
-        run_output_path = f'{output_path}/{run_name}'
+        # 本次运行ID（例如 run_20251222_101517_3fa2c1）：server102 上的运行目录、Server104 上的归档目录都按它命名
+        run_id = new_run_id()
+        run_dir = get_run_workdir(username, projectname, run_id)
+        log_file = f'{output_path}/{run_id}.log'
+        run_output_path = f'{output_path}/{run_id}'
+        JOB_REGISTRY.create(run_id, 'async', username, projectname, env_name, command,
+                            node=server, run_dir=run_dir, log_file=log_file, priority=priority,
+                            archive_mode=archive_mode)
         
         # 在后台线程中执行命令
         def run_command():
@@ -2856,65 +7438,56 @@ def execute_project_async():
             ssh_server104 = None
             
             try:
+                JOB_REGISTRY.set_status(run_id, 'syncing')
+                # 在真正同步时读取 .syncignore（排队期间可能有修改），归档使用同一份规则
+                sync_ignore = load_sync_ignore(project_path_source, sync_ignore_patterns, use_syncignore)
+                JOB_REGISTRY.update(run_id, sync_ignore=json.dumps(sync_ignore.patterns, ensure_ascii=False))
                 # 每次执行前，将项目从 server101 拷贝到 server102 对应目录
                 logger.info(
                     f"[async] 从 server101 同步项目到 server102 以便执行: "
                     f"{server101_config['host']}:{project_path_source} "
                     f"-> {server102_config['host']}:{project_path}"
                 )
-                copy_success, copy_message = copy_folder_remote_to_remote(
-                    server101_config['host'],
-                    server101_config['port'],
-                    server101_config['user'],
-                    server101_config['password'],
-                    project_path_source,
-                    server102_config['host'],
-                    server102_config['port'],
-                    server102_config['user'],
-                    server102_config['password'],
-                    project_path
-                )
-                if not copy_success:
-                    logger.error(f"[async] 从 server101 同步项目到 server102 失败: {copy_message}")
-                    return
+                with get_project_sync_lock(project_path):
+                    copy_success, copy_message, sync_stats = sync_project_to_server102(
+                        project_path_source,
+                        project_path,
+                        sync_mode=sync_mode,
+                        checksum=sync_checksum,
+                        transport=transport,
+                        direct=direct,
+                        ignore=sync_ignore
+                    )
+                    if not copy_success:
+                        logger.error(f"[async] 从 server101 同步项目到 server102 失败: {copy_message}")
+                        fail_job(run_id, f'项目同步失败: {copy_message}')
+                        return
+                    logger.info(f"[async] 项目同步完成: {copy_message}")
 
-                # 连接执行服务器 server102
-                ssh_client = paramiko.SSHClient()
-                ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh_client.connect(
-                    hostname=server102_config['host'],
-                    port=server102_config['port'],
-                    username=server102_config['user'],
-                    password=server102_config['password'],
-                    timeout=30
-                )
+                    # 连接执行服务器 server102，从共享项目副本创建本次运行的独立工作目录
+                    ssh_client = SSH_POOL.acquire('server102')
+                    workdir_success, _, workdir_message = create_run_workdir(ssh_client, project_path, run_dir)
+                if not workdir_success:
+                    logger.error(f"[async] {workdir_message}")
+                    fail_job(run_id, workdir_message)
+                    return
+                if archive_mode == 'changed':
+                    record_run_manifest(ssh_client, run_dir)
                 
                 # 连接Server104创建输出目录
                 server104_config = SERVER_CONFIG['server104']
-                ssh_server104 = paramiko.SSHClient()
-                ssh_server104.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh_server104.connect(
-                    hostname=server104_config['host'],
-                    port=server104_config['port'],
-                    username=server104_config['user'],
-                    password=server104_config['password'],
-                    timeout=30
-                )
+                ssh_server104 = SSH_POOL.acquire('server104')
                 
                 # 创建输出目录（项目输出根目录，按项目聚合）
                 mkdir_cmd = f'mkdir -p "{output_path}"'
                 execute_ssh_command(ssh_server104, mkdir_cmd, use_sudo=False)
                 
                 # 构建命令：激活虚拟环境，必要时安装依赖，再执行并将输出写入临时log文件
-                temp_log = f'/tmp/run_{datetime.now().strftime("%Y%m%d_%H%M%S")}_{os.getpid()}.log'
-                pip_cmd = (
-                    f'if [ -f "requirements.txt" ]; then '
-                    f'pip install -r requirements.txt --index-url http://192.168.140.202:8087/simple/ --trusted-host 192.168.140.202; '
-                    f'fi'
-                )
+                temp_log = f'/tmp/{run_id}.log'
+                pip_cmd = build_pip_install_cmd(env_path, use_cache=requirements_cache)
                 # 先用 sudo 修正输出目录权限（作用于项目目录下的 output）
                 fix_output_cmd = (
-                    f'bash -lc \'cd "{project_path}" && '
+                    f'bash -lc \'cd "{run_dir}" && '
                     f'mkdir -p output && chmod -R 775 output && '
                     f'chown -R {server102_config["user"]}:{server102_config["user"]} output\''
                 )
@@ -2922,50 +7495,29 @@ def execute_project_async():
 
                 ensure_output_cmd = 'mkdir -p output && chmod -R 775 output || true'
                 full_command = (
-                    f'cd "{project_path}" && '
+                    f'cd "{run_dir}" && '
                     f'{ensure_output_cmd} && '
                     f'source "{env_path}/bin/activate" && '
                     f'{pip_cmd} && '
-                    f'({command} 2>&1 | tee "{temp_log}")'
+                    f'{build_project_run_cmd(command, temp_log)}'
                 )
                 
                 logger.info(f"异步执行项目算法: 项目={projectname}, 环境={env_name}, 命令={command}, log={log_file}")
                 
-                # 执行命令
-                success, stdout, stderr = execute_ssh_command(ssh_client, full_command, use_sudo=False)
-                
-                # 读取临时log文件内容
-                log_content = stdout + (stderr if stderr else '')
-                try:
-                    sftp_client = ssh_client.open_sftp()
-                    try:
-                        # 尝试读取临时log文件（如果存在）
-                        with sftp_client.open(temp_log, 'r') as f:
-                            log_content = f.read().decode('utf-8', errors='ignore')
-                    except IOError:
-                        # 如果文件不存在，使用stdout/stderr
-                        pass
-                    finally:
-                        sftp_client.close()
-                except Exception as e:
-                    logger.warning(f"读取临时log文件失败: {str(e)}")
+                # 执行命令：输出直接写入临时log文件，运行期间由 LogShipper 按批追加到 Server104
+                JOB_REGISTRY.set_status(run_id, 'running')
+                log_shipper = LogShipper(server, temp_log, 'server104', log_file).start()
+                exit_code, stdout, stderr = execute_ssh_command_with_code(
+                    ssh_client, full_command, use_sudo=False, timeout=None
+                )
+                requirements = parse_requirements_cache(stdout)
+                JOB_REGISTRY.update(run_id, exit_code=exit_code, run_finished_at=JOB_REGISTRY._now(),
+                                    requirements_cache=requirements['status'],
+                                    requirements_install_seconds=requirements['install_seconds'],
+                                    requirements_saved_seconds=requirements['saved_seconds'])
                 
-                # 保存log到Server104
-                if log_content:
-                    try:
-                        sftp_server104 = ssh_server104.open_sftp()
-                        try:
-                            # 确保目录存在
-                            mkdir_cmd = f'mkdir -p "{output_path}"'
-                            execute_ssh_command(ssh_server104, mkdir_cmd, use_sudo=False)
-                            
-                            # 写入log文件
-                            with sftp_server104.open(log_file, 'w') as f:
-                                f.write(log_content)
-                        finally:
-                            sftp_server104.close()
-                    except Exception as e:
-                        logger.warning(f"保存log文件到Server104失败: {str(e)}")
+                # 搬运剩余的日志；命令未能启动（没有临时log文件）时把 stdout/stderr 作为log保存
+                log_shipper.finish(fallback_text=stdout + (stderr if stderr else ''))
                 
                 # 清理临时文件
                 try:
@@ -2974,61 +7526,156 @@ def execute_project_async():
                 except:
                     pass
                 
-                # 执行完成后，将整个项目目录传输到Server104的outputs目录，按运行名归档：output/项目名/运行名/
+                # 执行完成后，将本次运行目录传输到Server104的outputs目录，按运行ID归档：output/项目名/运行ID/
                 # Server104的outputs目录等同于其他服务器的projects目录
                 logger.info(
-                    f"开始传输项目到Server104: {server102_config['host']}:{project_path} "
+                    f"开始传输项目到Server104: {server102_config['host']}:{run_dir} "
                     f"-> {server104_config['host']}:{run_output_path}"
                 )
                 
+                JOB_REGISTRY.set_status(run_id, 'archiving')
+                archive_stats = None
                 try:
-                    # 使用远程到远程复制函数传输整个项目目录
-                    copy_success, copy_message = copy_folder_remote_to_remote(
-                        server102_config['host'],      # 源服务器（执行服务器 server102）
-                        server102_config['port'],
-                        server102_config['user'],
-                        server102_config['password'],
-                        project_path,               # 源路径
-                    server104_config['host'],   # 目标服务器（Server104）
-                    server104_config['port'],
-                    server104_config['user'],
-                    server104_config['password'],
-                    run_output_path             # 目标路径（按运行名的子目录）
+                    # 按 archive_mode 归档本次运行目录（full 整个目录 / changed 只传输新增或修改的文件）
+                    copy_success, copy_message, archive_stats = archive_run_to_server104(
+                        run_dir,
+                        run_output_path,
+                        archive_mode=archive_mode,
+                        transport=transport,
+                        direct=direct,
+                        source={'server': 'server101', 'path': project_path_source, 'synced_copy': f'server102:{project_path}'},
+                        username=username,
+                        projectname=projectname,
+                        ignore=sync_ignore
                     )
                     
                     if copy_success:
                         logger.info(f"项目传输成功: {copy_message}")
+                        remove_run_workdir(ssh_client, run_dir)
                     else:
                         logger.warning(f"项目传输失败: {copy_message}")
                 except Exception as e:
                     logger.error(f"传输项目到Server104时出错: {str(e)}", exc_info=True)
+                    copy_success, copy_message = False, f'传输项目到Server104时出错: {str(e)}'
+
+                if exit_code == 0 and copy_success:
+                    JOB_REGISTRY.set_status(run_id, 'completed', archive_path=run_output_path, error=None)
+                else:
+                    JOB_REGISTRY.set_status(
+                        run_id, 'failed',
+                        archive_path=run_output_path if copy_success else None,
+                        error=f'命令退出码: {exit_code}' if exit_code != 0 else f'归档失败: {copy_message}'
+                    )
                 
             except Exception as e:
                 logger.error(f"异步执行出错: {str(e)}", exc_info=True)
+                fail_job(run_id, f'异步执行出错: {str(e)}')
             finally:
-                if ssh_client:
-                    try:
-                        ssh_client.close()
-                    except:
-                        pass
-                if ssh_server104:
-                    try:
-                        ssh_server104.close()
-                    except:
-                        pass
+                SSH_POOL.release(ssh_client)
+                SSH_POOL.release(ssh_server104)
         
-        # 启动后台线程
-        thread = threading.Thread(target=run_command)
-        thread.daemon = True
-        thread.start()
+        # 提交到调度器排队，由工作线程在并发额度允许时执行
+        JOB_REGISTRY.set_status(run_id, 'queued')
+        queue_position = JOB_SCHEDULER.submit(run_id, username, server, run_command, priority=priority)
         
         return jsonify({
             'success': True,
-            'message': '算法已开始执行',
-            'log_file': log_file,
-            'status': 'running'
+            'message': '算法已提交执行',
+            'job_id': run_id,
+            'log_file': log_file,
+            'run_id': run_id,
+            'run_dir': run_dir,
+            'status': 'queued',
+            'queue_position': queue_position
+        }), 200
+    
+    except Exception as e:
+        logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    查询任务登记表
+
+    查询参数:
+        - username / projectname / status / mode: 过滤条件（可选）
+        - limit: 返回条数（可选，默认 50，最大 500）
+        - offset: 偏移量（可选，默认 0）
+
+    返回:
+        JSON格式的响应，包含任务列表与总数（按创建时间倒序）、排队中任务的 queue_position 以及调度器状态
+    """
+    try:
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'limit / offset 必须是整数'
+            }), 400
+
+        jobs, total = JOB_REGISTRY.list(
+            username=request.args.get('username'),
+            projectname=request.args.get('projectname'),
+            status=request.args.get('status'),
+            mode=request.args.get('mode'),
+            limit=limit,
+            offset=offset
+        )
+        for job in jobs:
+            if job.get('status') == 'queued':
+                job['queue_position'] = JOB_SCHEDULER.queue_position(job['job_id'])
+        return jsonify({
+            'success': True,
+            'jobs': jobs,
+            'total': total,
+            'limit': limit,
+            'offset': offset,
+            'scheduler': JOB_SCHEDULER.stats()
+        }), 200
+
+    except Exception as e:
+        logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    查询单个任务；后台任务仍在运行时会到执行节点上检查进程是否已结束并更新状态
+
+    返回:
+        JSON格式的响应，包含任务记录
+    """
+    try:
+        job = JOB_REGISTRY.get(job_id)
+        if not job:
+            return jsonify({
+                'success': False,
+                'error': f'任务不存在: {job_id}'
+            }), 404
+
+        try:
+            job = refresh_background_job(job)
+        except Exception as e:
+            logger.warning(f"刷新后台任务 {job_id} 状态失败: {str(e)}")
+
+        if job.get('status') == 'queued':
+            job['queue_position'] = JOB_SCHEDULER.queue_position(job_id)
+
+        return jsonify({
+            'success': True,
+            'job': job
         }), 200
-    
+
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
         return jsonify({
@@ -3036,6 +7683,7 @@ def execute_project_async():
             'error': f'服务器内部错误: {str(e)}'
         }), 500
 
+
 @app.route('/project/list', methods=['POST'])
 def list_projects():
     """
@@ -3044,6 +7692,7 @@ def list_projects():
     请求参数（JSON）:
         - username: 用户名
         - server: 服务器名称（固定为 server101，忽略传入的 server 参数）
+        - refresh: 是否忽略缓存重新读取（可选，默认 false）
     
     返回:
         JSON格式的响应，包含项目列表
@@ -3073,72 +7722,46 @@ def list_projects():
         server_config = SERVER_CONFIG[server]
         print("------------------列出项目----------")
         print(server_config)
-        target_host = server_config['host']
-        target_port = server_config['port']
-        target_user = server_config['user']
-        target_password = server_config['password']
         
         projects_path = f'/home/user/{username}/projects'
         
+        cached = None if data.get('refresh') else METADATA_CACHE.get(server, projects_path, 'projects')
+        if cached is not None:
+            return jsonify(cached), 200
+        cache_generation = METADATA_CACHE.generation
+        
         ssh_client = None
         try:
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=target_host,
-                port=target_port,
-                username=target_user,
-                password=target_password,
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire(server)
             
-            # 列出项目目录
-            list_cmd = f'ls -la "{projects_path}" 2>&1'
-            success, stdout, stderr = execute_ssh_command(ssh_client, list_cmd, use_sudo=True)
-            print("------------------列出项目----------")
-            print(success, stdout, stderr)
-            print(list_cmd)
+            # 列出项目目录：一次远程调用取得所有条目及其是否为目录、是否有 requirements.txt
+            success, entries = probe_remote_entries(
+                ssh_client, projects_path,
+                probes={'has_requirements': '[ -f "$f/requirements.txt" ]'},
+                use_sudo=True
+            )
             if not success:
                 return jsonify({
                     'success': False,
-                    'error': f'无法访问路径: {projects_path}。错误: {stderr}',
+                    'error': f'无法访问路径: {projects_path}。错误: {entries}',
                     'projects': []
                 }), 404
             
-            # 解析输出
-            projects = []
-            lines = stdout.strip().split('\n')
-            
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith('total') or (line.startswith('d') and '.' in line[:10]):
-                    continue
-                
-                parts = line.split(None, 8)
-                if len(parts) >= 9:
-                    name = parts[8]
-                    if name not in ['.', '..']:
-                        # 检查是否是目录
-                        check_dir_cmd = f'test -d "{projects_path}/{name}"'
-                        is_dir, _, _ = execute_ssh_command(ssh_client, check_dir_cmd, use_sudo=False)
-                        
-                        if is_dir:
-                            # 检查是否有requirements.txt
-                            check_req_cmd = f'test -f "{projects_path}/{name}/requirements.txt"'
-                            has_requirements, _, _ = execute_ssh_command(ssh_client, check_req_cmd, use_sudo=False)
-                            
-                            projects.append({
-                                'name': name,
-                                'path': f'{projects_path}/{name}',
-                                'has_requirements': has_requirements
-                            })
+            projects = [
+                {
+                    'name': entry['name'],
+                    'path': f'{projects_path}/{entry["name"]}',
+                    'has_requirements': entry['has_requirements']
+                }
+                for entry in entries if entry['is_dir']
+            ]
             
-            return jsonify({
+            return jsonify(METADATA_CACHE.put(server, projects_path, 'projects', {
                 'success': True,
                 'projects': projects,
                 'count': len(projects),
                 'server': server
-            }), 200
+            }, cache_generation)), 200
         
         except Exception as e:
             logger.error(f"列出项目时出错: {str(e)}", exc_info=True)
@@ -3149,11 +7772,7 @@ def list_projects():
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -3173,9 +7792,12 @@ def get_project_log():
         - username: 用户名
         - projectname: 项目名称
         - log_file: log文件名（可选，不提供则返回最新的log）
+        - offset: 起始字节偏移（可选，默认 0）
+        - length: 最多读取的字节数（可选，默认读到文件末尾）
+        - tail_lines: 读取最后若干行（可选，指定时忽略 offset）
     
     返回:
-        JSON格式的响应，包含log内容
+        JSON格式的响应，包含log内容（只包含请求的窗口）、offset / next_offset、文件总字节数 size 与 eof
     """
     try:
         data = request.get_json() or {}
@@ -3189,20 +7811,18 @@ def get_project_log():
                 'error': '缺少必需参数: username 或 projectname'
             }), 400
         
-        server104_config = SERVER_CONFIG['server104']
+        offset, length, tail_lines, window_error = parse_read_window(data)
+        if window_error:
+            return jsonify({
+                'success': False,
+                'error': window_error
+            }), 400
+        
         output_path = f'/home/user/{username}/outputs/{projectname}'
         
         ssh_client = None
         try:
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=server104_config['host'],
-                port=server104_config['port'],
-                username=server104_config['user'],
-                password=server104_config['password'],
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire('server104')
             
             if not log_file:
                 # 获取最新的log文件
@@ -3216,22 +7836,21 @@ def get_project_log():
                         'error': '未找到log文件'
                     }), 404
             
-            # 读取log文件内容
-            read_cmd = f'cat "{log_file}" 2>&1'
-            success, content, stderr = execute_ssh_command(ssh_client, read_cmd, use_sudo=False)
-            
-            if success:
-                return jsonify({
-                    'success': True,
-                    'log_file': log_file,
-                    'content': content
-                }), 200
-            else:
+            # 按字节窗口读取log文件内容（SFTP seek，只传输请求的部分）
+            try:
+                window = sftp_read_window(SSH_POOL.open_sftp(ssh_client), log_file, offset, length, tail_lines)
+            except IOError as e:
                 return jsonify({
                     'success': False,
-                    'error': f'读取log文件失败: {stderr}',
+                    'error': f'读取log文件失败: {str(e)}',
                     'log_file': log_file
                 }), 500
+            
+            return jsonify({
+                'success': True,
+                'log_file': log_file,
+                **window
+            }), 200
         
         except Exception as e:
             logger.error(f"获取log文件出错: {str(e)}", exc_info=True)
@@ -3241,11 +7860,7 @@ def get_project_log():
             }), 500
         
         finally:
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -3255,6 +7870,102 @@ def get_project_log():
         }), 500
 
 
+@app.route('/project/log/stream', methods=['GET'])
+def stream_project_log():
+    """
+    以 Server-Sent Events 实时推送日志，只传输新增内容
+
+    查询参数:
+        - job_id: 任务ID（推荐）：跟踪运行中的日志直到任务结束
+        - username / projectname / log_file: 不提供 job_id 时，推送 server104 上指定或最新的 log 文件后结束
+        - offset: 起始字节偏移（可选）；断线重连时浏览器会自动带上 Last-Event-ID 请求头，效果相同
+        - tail: 未指定 offset 时先推送的最后行数（可选，默认 LOG_STREAM_CONFIG['default_tail_lines']，0 表示从头推送）
+
+    事件:
+        - log: data 为若干行日志，id 为这些行之后的字节偏移
+        - end: 日志结束，data 为 JSON（status / exit_code / offset / error）
+        - error: 推送过程中出错
+    """
+    try:
+        job_id = request.args.get('job_id')
+        offset = request.args.get('offset', request.headers.get('Last-Event-ID'))
+        try:
+            offset = int(offset) if offset not in (None, '') else None
+            tail_lines = int(request.args.get('tail', LOG_STREAM_CONFIG['default_tail_lines']))
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'offset / tail 必须是整数'
+            }), 400
+        if offset is not None and offset < 0:
+            return jsonify({
+                'success': False,
+                'error': 'offset 不能为负数'
+            }), 400
+
+        if job_id:
+            if not JOB_REGISTRY.get(job_id):
+                return jsonify({
+                    'success': False,
+                    'error': f'任务不存在: {job_id}'
+                }), 404
+            events = stream_job_log(job_id, offset=offset, tail_lines=tail_lines)
+        else:
+            username = request.args.get('username')
+            projectname = request.args.get('projectname')
+            log_file = request.args.get('log_file')
+            if not username or not projectname:
+                return jsonify({
+                    'success': False,
+                    'error': '缺少必需参数: job_id 或 username + projectname'
+                }), 400
+
+            output_path = f'/home/user/{username}/outputs/{projectname}'
+            if not log_file:
+                ssh_client = SSH_POOL.acquire('server104')
+                try:
+                    list_cmd = f'ls -t "{output_path}"/*.log 2>/dev/null | head -1'
+                    success, stdout, _ = execute_ssh_command(ssh_client, list_cmd, use_sudo=False)
+                finally:
+                    SSH_POOL.release(ssh_client)
+                if not success or not stdout.strip():
+                    return jsonify({
+                        'success': False,
+                        'error': '未找到log文件'
+                    }), 404
+                log_file = stdout.strip()
+
+            def file_events():
+                ssh_client = None
+                try:
+                    ssh_client = STREAM_SSH_POOL.acquire('server104')
+                    sftp = STREAM_SSH_POOL.open_sftp(ssh_client)
+                    start = offset if offset is not None else sftp_tail_offset(sftp, log_file, tail_lines)
+                    end = yield from stream_log_file_events(sftp, log_file, start)
+                    yield format_sse(json.dumps({'log_file': log_file, 'offset': end}, ensure_ascii=False),
+                                     event='end')
+                except Exception as e:
+                    logger.error(f"推送log文件 {log_file} 出错: {str(e)}", exc_info=True)
+                    yield format_sse(str(e), event='error')
+                finally:
+                    STREAM_SSH_POOL.release(ssh_client)
+
+            events = file_events()
+
+        return Response(
+            stream_with_context(events),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    except Exception as e:
+        logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
 @app.route('/test', methods=['GET'])
 def test_page():
     """测试页面"""
@@ -3314,15 +8025,7 @@ def create_user():
 
             ssh_client = None
             try:
-                ssh_client = paramiko.SSHClient()
-                ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh_client.connect(
-                    hostname=config['host'],
-                    port=config['port'],
-                    username=config['user'],
-                    password=config['password'],
-                    timeout=30
-                )
+                ssh_client = SSH_POOL.acquire(server_name)
 
                 # 依次创建目录并设置权限
                 for d in dirs:
@@ -3335,11 +8038,8 @@ def create_user():
                 logger.error(f"在 {server_name} 上创建用户目录失败: {str(e)}", exc_info=True)
                 results[server_name] = f'error: {str(e)}'
             finally:
-                if ssh_client:
-                    try:
-                        ssh_client.close()
-                    except:
-                        pass
+                SSH_POOL.release(ssh_client)
+                METADATA_CACHE.invalidate(server_name, user_root)
 
         # 判断是否全部成功
         all_ok = all(v == 'ok' for v in results.values())
@@ -3371,6 +8071,7 @@ def check_task_and_copy():
         - projectname: 算法项目名
         - taskid: 数据库中的任务ID
         - log_file: 日志文件路径（可选，如果不提供则根据项目名和PID自动查找：/tmp/{projectname}_{pid}.log）
+        - archive_mode: 归档方式（可选，full / changed / dedup，默认使用启动后台任务时指定的方式）
     
     返回:
         JSON格式的响应，包含进程状态和复制结果
@@ -3379,7 +8080,8 @@ def check_task_and_copy():
         1. 查询10.2服务器上PID进程的状态（已完成/运行中）
         2. 如果已完成：
            - 检查10.4服务器的 /home/user/{username}/outputs/{projectname}/{taskid} 目录是否存在
-           - 如果不存在，将10.2服务器的 /home/user/{username}/projects/{projectname} 目录
+           - 如果不存在，将10.2服务器上该任务的运行目录（/tmp/{projectname}_{pid}.workdir 中记录；
+             没有记录时为 /home/user/{username}/projects/{projectname}）
              拷贝到10.4服务器的 /home/user/{username}/outputs/{projectname}/{taskid}
            - 同时将指定的日志文件也复制到目标目录
     """
@@ -3398,6 +8100,7 @@ def check_task_and_copy():
         projectname = data.get('projectname')
         taskid = data.get('taskid')
         log_file = data.get('log_file')  # 可选的日志文件路径
+        archive_mode = data.get('archive_mode')  # 可选，默认使用启动后台任务时指定的方式
         
         # 参数验证
         if not pid:
@@ -3424,6 +8127,12 @@ def check_task_and_copy():
                 'error': '缺少必需参数: taskid'
             }), 400
         
+        if archive_mode and archive_mode not in ARCHIVE_MODES:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 archive_mode: {archive_mode}。可选: {", ".join(ARCHIVE_MODES)}'
+            }), 400
+        
         # 获取服务器配置
         server102_config = SERVER_CONFIG['server102']
         server104_config = SERVER_CONFIG['server104']
@@ -3433,15 +8142,7 @@ def check_task_and_copy():
         
         try:
             # 连接10.2服务器查询进程状态
-            ssh_client_102 = paramiko.SSHClient()
-            ssh_client_102.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client_102.connect(
-                hostname=server102_config['host'],
-                port=server102_config['port'],
-                username=server102_config['user'],
-                password=server102_config['password'],
-                timeout=30
-            )
+            ssh_client_102 = SSH_POOL.acquire('server102')
             
             # 查询进程状态：使用 ps 命令检查进程是否存在
             # 如果进程存在且正在运行，返回"运行中"；如果不存在，返回"已完成"
@@ -3470,19 +8171,16 @@ def check_task_and_copy():
                     'taskid': taskid
                 }), 200
             
-            # 进程已完成，检查10.4服务器上的目录是否存在
+            # 进程已完成：更新任务登记表中的退出码与状态
+            job = JOB_REGISTRY.find_by_pid('server102', pid)
+            if job:
+                job = refresh_background_job(job, ssh_client_102)
+
+            # 检查10.4服务器上的目录是否存在
             output_path = f'/home/user/{username}/outputs/{projectname}/{taskid}'
             
             # 连接10.4服务器
-            ssh_client_104 = paramiko.SSHClient()
-            ssh_client_104.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client_104.connect(
-                hostname=server104_config['host'],
-                port=server104_config['port'],
-                username=server104_config['user'],
-                password=server104_config['password'],
-                timeout=30
-            )
+            ssh_client_104 = SSH_POOL.acquire('server104')
             
             # 检查目录是否存在
             check_dir_cmd = f'test -d "{output_path}" && echo "exists" || echo "not_exists"'
@@ -3511,27 +8209,54 @@ def check_task_and_copy():
                     'dir_exists': True
                 }), 200
             
-            # 目录不存在，需要从10.2服务器复制
+            # 目录不存在，需要从10.2服务器复制：优先使用后台任务启动时记录的运行目录
             source_path = f'/home/user/{username}/projects/{projectname}'
+            workdir_marker = f'/tmp/{projectname}_{pid}.workdir'
+            run_dir = None
+            success, stdout, _ = execute_ssh_command(
+                ssh_client_102, f'cat "{workdir_marker}" 2>/dev/null', use_sudo=False
+            )
+            if success and stdout.strip():
+                run_dir = stdout.strip()
+                source_path = run_dir
             
             logger.info(
                 f"开始复制目录: {server102_config['host']}:{source_path} -> "
                 f"{server104_config['host']}:{output_path}"
             )
             
-            # 使用远程到远程复制函数复制目录
-            copy_success, copy_message = copy_folder_remote_to_remote(
-                server102_config['host'],
-                server102_config['port'],
-                server102_config['user'],
-                server102_config['password'],
-                source_path,
-                server104_config['host'],
-                server104_config['port'],
-                server104_config['user'],
-                server104_config['password'],
-                output_path
-            )
+            archive_stats = None
+            if run_dir:
+                # 按启动时指定（或本次请求覆盖）的 archive_mode 归档运行目录
+                if not archive_mode:
+                    archive_mode = (job or {}).get('archive_mode') or RUN_ARCHIVE_CONFIG['default_mode']
+                copy_success, copy_message, archive_stats = archive_run_to_server104(
+                    run_dir,
+                    output_path,
+                    archive_mode=archive_mode,
+                    source={
+                        'server': 'server101',
+                        'path': f'/home/user/{username}/projects/{projectname}',
+                        'synced_copy': f'server102:/home/user/{username}/projects/{projectname}'
+                    },
+                    username=username,
+                    projectname=projectname,
+                    ignore=SyncIgnore(json.loads((job or {}).get('sync_ignore') or '[]'))
+                )
+            else:
+                # 使用远程到远程复制函数复制目录
+                copy_success, copy_message = copy_folder_remote_to_remote(
+                    server102_config['host'],
+                    server102_config['port'],
+                    server102_config['user'],
+                    server102_config['password'],
+                    source_path,
+                    server104_config['host'],
+                    server104_config['port'],
+                    server104_config['user'],
+                    server104_config['password'],
+                    output_path
+                )
             
             log_file_copied = None
             if copy_success:
@@ -3585,6 +8310,16 @@ def check_task_and_copy():
                 else:
                     logger.info("未找到日志文件，跳过日志文件复制")
             
+            if copy_success and job:
+                JOB_REGISTRY.update(job['job_id'], archive_path=output_path)
+            
+            if copy_success and run_dir:
+                # 归档完成后清理运行目录与记录文件
+                remove_run_workdir(ssh_client_102, run_dir)
+                execute_ssh_command(ssh_client_102, f'rm -f "{workdir_marker}" "{run_dir}.exitcode"', use_sudo=False)
+            
+            METADATA_CACHE.invalidate('server104', output_path)
+            
             if copy_success:
                 response_data = {
                     'success': True,
@@ -3598,6 +8333,11 @@ def check_task_and_copy():
                     'output_path': output_path,
                     'copy_message': copy_message
                 }
+                if job:
+                    response_data['job_id'] = job['job_id']
+                    response_data['exit_code'] = job['exit_code']
+                if archive_stats:
+                    response_data['archive_stats'] = archive_stats
                 if log_file_copied:
                     response_data['log_file_copied'] = log_file_copied
                     response_data['message'] += f'，日志文件已复制'
@@ -3634,16 +8374,8 @@ def check_task_and_copy():
         
         finally:
             # 关闭SSH连接
-            if ssh_client_102:
-                try:
-                    ssh_client_102.close()
-                except:
-                    pass
-            if ssh_client_104:
-                try:
-                    ssh_client_104.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client_102)
+            SSH_POOL.release(ssh_client_104)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -3661,12 +8393,18 @@ def read_file():
     请求参数:
         server: 服务器名称 (server101/server102/server103/server104)
         path: 文件完整路径
+        offset: 起始字节偏移（可选，默认 0）
+        length: 最多读取的字节数（可选，默认读到文件末尾）
+        tail_lines: 读取最后若干行（可选，指定时忽略 offset）
     
     返回:
         success: 是否成功
-        content: 文件内容（字符串）
+        content: 文件内容（字符串，只包含请求的窗口）
         path: 文件路径
         server: 服务器名称
+        offset / next_offset: 本次内容的起止字节偏移，下一次从 next_offset 继续读取
+        size: 文件总字节数
+        eof: 是否已读到文件末尾
     """
     try:
         data = request.get_json()
@@ -3679,6 +8417,13 @@ def read_file():
                 'error': '文件路径不能为空'
             }), 400
         
+        offset, length, tail_lines, window_error = parse_read_window(data)
+        if window_error:
+            return jsonify({
+                'success': False,
+                'error': window_error
+            }), 400
+        
         # 获取服务器配置
         if server not in SERVER_CONFIG:
             return jsonify({
@@ -3686,24 +8431,14 @@ def read_file():
                 'error': f'未知的服务器: {server}'
             }), 400
         
-        config = SERVER_CONFIG[server]
         
         ssh_client = None
-        sftp_client = None
         
         try:
             # 连接服务器
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=config['host'],
-                port=config['port'],
-                username=config['user'],
-                password=config['password'],
-                timeout=30
-            )
+            ssh_client = SSH_POOL.acquire(server)
             
-            sftp_client = ssh_client.open_sftp()
+            sftp_client = SSH_POOL.open_sftp(ssh_client)
             
             # 检查文件是否存在
             try:
@@ -3720,24 +8455,17 @@ def read_file():
                     'error': f'文件不存在: {file_path}'
                 }), 404
             
-            # 读取文件内容
+            # 按字节窗口读取文件内容（只传输请求的部分）
             try:
-                with sftp_client.open(file_path, 'r') as f:
-                    content = f.read()
-                    # 尝试解码为字符串
-                    if isinstance(content, bytes):
-                        content = content.decode('utf-8', errors='replace')
+                window = sftp_read_window(sftp_client, file_path, offset, length, tail_lines)
             except PermissionError:
                 # 尝试使用 sudo 读取
                 logger.warning(f"SFTP 读取权限不足，尝试使用 sudo: {file_path}")
-                read_cmd = f'cat "{file_path}"'
-                success, stdout, stderr = execute_ssh_command(ssh_client, read_cmd, use_sudo=True)
-                if success:
-                    content = stdout
-                else:
+                success, window = sudo_read_window(ssh_client, file_path, offset, length, tail_lines)
+                if not success:
                     return jsonify({
                         'success': False,
-                        'error': f'读取文件失败（权限不足）: {stderr}'
+                        'error': f'读取文件失败（权限不足）: {window}'
                     }), 403
             except Exception as e:
                 return jsonify({
@@ -3747,9 +8475,9 @@ def read_file():
             
             return jsonify({
                 'success': True,
-                'content': content,
                 'path': file_path,
-                'server': server
+                'server': server,
+                **window
             }), 200
         
         except paramiko.AuthenticationException:
@@ -3770,16 +8498,7 @@ def read_file():
             }), 500
         
         finally:
-            if sftp_client:
-                try:
-                    sftp_client.close()
-                except:
-                    pass
-            if ssh_client:
-                try:
-                    ssh_client.close()
-                except:
-                    pass
+            SSH_POOL.release(ssh_client)
     
     except Exception as e:
         logger.error(f"处理请求时出错: {str(e)}", exc_info=True)
@@ -3789,6 +8508,261 @@ def read_file():
         }), 500
 
 
+@app.route('/file/download', methods=['GET'])
+def download_file():
+    """
+    流式下载远程文件（二进制），支持 HTTP Range 断点续传
+
+    查询参数:
+        - server + path: 服务器名称与文件路径
+        - job_id + file: 或者下载某次运行归档在 server104 上的文件（file 为相对运行归档目录的路径）
+        - disposition: attachment（默认，浏览器保存为文件）/ inline（浏览器直接打开，如图片）
+
+    返回:
+        200 整个文件 / 206 Range 指定的区间（Content-Range），带 Content-Length 与 Accept-Ranges
+    """
+    try:
+        server_name = request.args.get('server')
+        remote_path = request.args.get('path')
+        job_id = request.args.get('job_id')
+        disposition = request.args.get('disposition') or 'attachment'
+
+        if disposition not in ('attachment', 'inline'):
+            return jsonify({
+                'success': False,
+                'error': 'disposition 必须为 attachment / inline'
+            }), 400
+
+        if job_id:
+            job = JOB_REGISTRY.get(job_id)
+            if not job:
+                return jsonify({
+                    'success': False,
+                    'error': f'任务不存在: {job_id}'
+                }), 404
+            relative = posixpath.normpath(request.args.get('file') or '')
+            if relative in ('', '.') or relative.startswith('/') or relative.split('/')[0] == '..':
+                return jsonify({
+                    'success': False,
+                    'error': 'file 必须是运行归档目录内的相对路径'
+                }), 400
+            server_name = 'server104'
+            remote_path = f'/home/user/{job["username"]}/outputs/{job["projectname"]}/{job_id}/{relative}'
+
+        if not server_name or not remote_path:
+            return jsonify({
+                'success': False,
+                'error': '缺少必需参数: server + path 或 job_id + file'
+            }), 400
+
+        if server_name not in SERVER_CONFIG:
+            return jsonify({
+                'success': False,
+                'error': f'无效的服务器: {server_name}。可用服务器: {", ".join(SERVER_CONFIG.keys())}'
+            }), 400
+
+        # 先取得文件大小与修改时间（普通用户无权限时用 sudo stat）
+        ssh_client = SSH_POOL.acquire(server_name)
+        try:
+            use_sudo = False
+            try:
+                attr = SSH_POOL.open_sftp(ssh_client).stat(remote_path)
+                mode, size, mtime = attr.st_mode or 0, attr.st_size or 0, int(attr.st_mtime or 0)
+            except IOError as e:
+                if getattr(e, 'errno', None) != errno.EACCES:
+                    return jsonify({
+                        'success': False,
+                        'error': f'文件不存在或无法访问: {remote_path}'
+                    }), 404
+                use_sudo = True
+                success, stdout, stderr = execute_ssh_command(
+                    ssh_client, f'stat -L -c "%f %s %Y" {shlex.quote(remote_path)}', use_sudo=True
+                )
+                if not success:
+                    return jsonify({
+                        'success': False,
+                        'error': f'文件不存在或无法访问: {remote_path}。错误: {stderr}'
+                    }), 404
+                raw_mode, raw_size, raw_mtime = stdout.split()
+                mode, size, mtime = int(raw_mode, 16), int(raw_size), int(raw_mtime)
+        finally:
+            SSH_POOL.release(ssh_client)
+
+        if not stat.S_ISREG(mode):
+            return jsonify({
+                'success': False,
+                'error': f'路径不是文件: {remote_path}'
+            }), 400
+
+        try:
+            byte_range = parse_http_range(request.headers.get('Range'), size)
+        except ValueError:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}', 'Accept-Ranges': 'bytes'})
+        start, end = byte_range or (0, size)
+
+        filename = posixpath.basename(remote_path)
+        headers = {
+            'Content-Length': str(end - start),
+            'Accept-Ranges': 'bytes',
+            'Last-Modified': formatdate(mtime, usegmt=True),
+            'Content-Disposition': f"{disposition}; filename*=UTF-8''{quote(filename)}",
+        }
+        if byte_range:
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+        if not STREAM_SSH_POOL.available(server_name):
+            return jsonify({
+                'success': False,
+                'error': f'{server_name} 上同时进行的下载过多，请稍后重试'
+            }), 503
+
+        stream = sudo_stream_file if use_sudo else sftp_stream_file
+        return Response(
+            stream_with_context(stream(server_name, remote_path, start, end)),
+            status=206 if byte_range else 200,
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            headers=headers,
+            direct_passthrough=True
+        )
+
+    except Exception as e:
+        logger.error(f"下载文件时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+@app.route('/run/archive', methods=['GET'])
+def download_run_archive():
+    """
+    把一次运行在 server104 上的归档目录打包成 tar / zip 流式下载
+
+    边遍历远程目录边打包写入响应，不在任何节点上生成临时压缩包，也不需要逐个文件调用 /list、/file/read。
+
+    查询参数:
+        - job_id: 任务 ID；或者 username + projectname + run_id（outputs/{projectname} 下的运行目录名）
+        - format: tar（默认）/ zip
+        - compression: 压缩方式（可选）：tar 为 none（默认）/ gzip，zip 为 none（默认）/ deflate
+        - include: 只打包匹配的文件（可选，glob，可重复传入或用逗号分隔，如 *.csv,results/*）
+        - exclude: 跳过匹配的文件与目录（可选，格式同 include，如 *.log,__pycache__）
+
+    返回:
+        压缩包数据流（分块传输，不带 Content-Length），压缩包内的顶层目录为运行目录名
+    """
+    try:
+        job_id = request.args.get('job_id')
+        username = request.args.get('username')
+        projectname = request.args.get('projectname')
+        run_id = request.args.get('run_id')
+        archive_format = request.args.get('format') or 'tar'
+
+        if archive_format not in RUN_ARCHIVE_DOWNLOAD_FORMATS:
+            return jsonify({
+                'success': False,
+                'error': f'无效的 format: {archive_format}。可选: {", ".join(RUN_ARCHIVE_DOWNLOAD_FORMATS)}'
+            }), 400
+        compressions = RUN_ARCHIVE_DOWNLOAD_FORMATS[archive_format]
+        compression = request.args.get('compression') or compressions[0]
+        if compression not in compressions:
+            return jsonify({
+                'success': False,
+                'error': f'{archive_format} 不支持 compression={compression}。可选: {", ".join(compressions)}'
+            }), 400
+
+        if job_id:
+            job = JOB_REGISTRY.get(job_id)
+            if not job:
+                return jsonify({
+                    'success': False,
+                    'error': f'任务不存在: {job_id}'
+                }), 404
+            username, projectname, run_id = job['username'], job['projectname'], job_id
+
+        if not username or not projectname or not run_id:
+            return jsonify({
+                'success': False,
+                'error': '缺少必需参数: job_id 或 username + projectname + run_id'
+            }), 400
+
+        if '/' in run_id or run_id in ('.', '..'):
+            return jsonify({
+                'success': False,
+                'error': f'无效的 run_id: {run_id}'
+            }), 400
+
+        include = split_glob_patterns(request.args.getlist('include'))
+        exclude = split_glob_patterns(request.args.getlist('exclude'))
+        run_path = f'/home/user/{username}/outputs/{projectname}/{run_id}'
+
+        # 开始输出数据后就无法再返回错误状态码，先确认运行目录存在
+        ssh_client = SSH_POOL.acquire('server104')
+        try:
+            try:
+                is_dir = stat.S_ISDIR(SSH_POOL.open_sftp(ssh_client).stat(run_path).st_mode or 0)
+            except IOError as e:
+                if getattr(e, 'errno', None) != errno.EACCES:
+                    is_dir = False
+                else:
+                    is_dir, _, _ = execute_ssh_command(
+                        ssh_client, f'test -d {shlex.quote(run_path)}', use_sudo=True
+                    )
+        finally:
+            SSH_POOL.release(ssh_client)
+        if not is_dir:
+            return jsonify({
+                'success': False,
+                'error': f'运行归档目录不存在: server104:{run_path}'
+            }), 404
+
+        if not STREAM_SSH_POOL.available('server104'):
+            return jsonify({
+                'success': False,
+                'error': 'server104 上同时进行的下载过多，请稍后重试'
+            }), 503
+
+        if archive_format == 'zip':
+            filename, mimetype = f'{run_id}.zip', 'application/zip'
+        elif compression == 'gzip':
+            filename, mimetype = f'{run_id}.tar.gz', 'application/gzip'
+        else:
+            filename, mimetype = f'{run_id}.tar', 'application/x-tar'
+
+        logger.info(f"开始打包下载: server104:{run_path} ({archive_format}/{compression})，"
+                    f"include={include or '-'}, exclude={exclude or '-'}")
+        return Response(
+            stream_with_context(stream_run_archive(
+                'server104', run_path, run_id, archive_format, compression, include, exclude
+            )),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"},
+            direct_passthrough=True
+        )
+
+    except Exception as e:
+        logger.error(f"打包下载运行目录时出错: {str(e)}", exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+def start_background_services():
+    """
+    启动后台服务：打开任务 / 上传登记表，恢复上次运行遗留的未结束任务，预热虚拟环境池
+
+    只能在实际处理请求的进程中调用一次；导入模块本身不会连接数据库或远程服务器。
+    """
+    JOB_REGISTRY.open()
+    UPLOAD_REGISTRY.open()
+    threading.Thread(target=recover_jobs, daemon=True).start()
+    ENV_POOL.start()
+
+
 if __name__ == '__main__':
+    # debug 模式下 Werkzeug reloader 的父进程只负责监视文件，不启动后台服务，
+    # 否则两个进程的环境池会互相删除对方正在构建的环境，遗留任务也会被恢复两次
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
     # 开发环境运行
     app.run(host='0.0.0.0', port=5003, debug=True)